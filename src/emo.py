@@ -1,7 +1,12 @@
 import argparse
+import base64
+import hashlib
 import unittest
 import sys
-from emo_spn import emo_encrypt, emo_decrypt
+from emo_spn import emo_encrypt, emo_decrypt, batch_engine, ENGINES, MODES
+import emo_segment
+
+PIPE_CHUNK = 57 * 1024 * 16  # múltiplo de 57: líneas base64 completas de 76 caracteres
 
 def run_tests():
     print("Ejecutando pruebas automáticas...\n")
@@ -14,13 +19,102 @@ def run_tests():
     if not result.wasSuccessful():
         sys.exit(1)
 
+# ------------------------------------------
+# MODO PIPE: bytes por stdin/stdout con memoria acotada
+# Cifrar escribe un contenedor segmentado (emo_segment), el mismo que
+# `emo_spn.py encrypt --segment-size`; con --base64 va en líneas de 76
+# caracteres.
+# ------------------------------------------
+class Base64Writer:
+    """Objeto tipo archivo: codifica en base64 lo escrito, por líneas completas."""
+    def __init__(self, out):
+        self.out = out
+        self.pending = b""
+
+    def write(self, data):
+        data = self.pending + bytes(data)
+        n = len(data) - len(data) % 57
+        self.pending = data[n:]
+        if n:
+            self.out.write(base64.encodebytes(data[:n]))
+
+    def close(self):
+        if self.pending:
+            self.out.write(base64.encodebytes(self.pending))
+            self.pending = b""
+        self.out.flush()
+
+class Base64Reader:
+    """Objeto tipo archivo: read(n) de los bytes decodificados de un flujo base64."""
+    def __init__(self, src, chunk=PIPE_CHUNK):
+        self.src = src
+        self.chunk = chunk
+        self.text = b""   # base64 sin espacios aún no decodificado
+        self.data = bytearray()
+        self.eof = False
+
+    def read(self, n=-1):
+        while not self.eof and (n < 0 or len(self.data) < n):
+            more = self.src.read(self.chunk)
+            if not more:
+                self.eof = True
+                self.data += base64.b64decode(self.text, validate=True)
+                self.text = b""
+                break
+            self.text += b"".join(more.split())
+            k = len(self.text) - len(self.text) % 4
+            self.data += base64.b64decode(self.text[:k], validate=True)
+            self.text = self.text[k:]
+        n = len(self.data) if n < 0 else min(n, len(self.data))
+        out = bytes(self.data[:n])
+        del self.data[:n]
+        return out
+
+def _open_input(path):
+    return sys.stdin.buffer if path == "-" else open(path, "rb")
+
+def pipe_encrypt(args, master_key):
+    src = _open_input(args.input)
+    out = Base64Writer(sys.stdout.buffer) if args.base64 else sys.stdout.buffer
+    try:
+        emo_segment.encrypt_stream(src, out, master_key, args.segment_size, args.mode,
+                                   args.engine, args.workers)
+        if args.base64:
+            out.close()
+        sys.stdout.buffer.flush()
+    finally:
+        if src is not sys.stdin.buffer:
+            src.close()
+
+def pipe_decrypt(args, master_key):
+    src = _open_input(args.input)
+    try:
+        fin = Base64Reader(src) if args.base64 else src
+        emo_segment.decrypt_stream(fin, sys.stdout.buffer, master_key, args.engine, args.workers)
+        sys.stdout.buffer.flush()
+    finally:
+        if src is not sys.stdin.buffer:
+            src.close()
+
 def main():
     parser = argparse.ArgumentParser(description="CLI para EMO-SPN")
     parser.add_argument("command", choices=["encrypt", "decrypt", "test"],
                         help="Comando a ejecutar")
+    parser.add_argument("input", nargs="?",
+                        help="modo pipe: '-' (stdin) o un archivo; la salida va a stdout en binario")
 
     parser.add_argument("--msg", help="Mensaje a cifrar/descifrar")
     parser.add_argument("--key", help="Clave usada")
+    parser.add_argument("--base64", action="store_true",
+                        help="modo pipe: cifrado en base64 (líneas de 76 caracteres) en vez de binario")
+    parser.add_argument("--segment-size", type=int, default=emo_segment.SEGMENT_SIZE,
+                        help="modo pipe: bytes de texto por segmento (default: %(default)s)")
+    parser.add_argument("--mode", choices=sorted(MODES), default=emo_segment.SEGMENT_MODE,
+                        help="modo pipe: modo de cifrado de los segmentos (default: %(default)s)")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default=None,
+                        help="modo pipe: motor de bloques (default: numpy si está instalado)")
+    parser.add_argument("--workers", "-j", type=int, default=1,
+                        help="modo pipe: procesos para los segmentos (0 = uno por núcleo)")
 
     args = parser.parse_args()
 
@@ -28,6 +122,21 @@ def main():
         run_tests()
         return
 
+    if args.input is not None:
+        if not args.key:
+            parser.error("--key es obligatoria")
+        args.engine = args.engine or batch_engine()
+        master_key = hashlib.sha256(args.key.encode()).digest()  # misma derivación que emo_encrypt
+        try:
+            if args.command == "encrypt":
+                pipe_encrypt(args, master_key)
+            else:
+                pipe_decrypt(args, master_key)
+        except (ValueError, OSError) as e:
+            print("Error:", e, file=sys.stderr)
+            sys.exit(1)
+        return
+
     if args.command == "encrypt":
         cifrado, _ = emo_encrypt(args.msg, args.key)
         print(cifrado.hex())
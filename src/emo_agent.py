@@ -0,0 +1,245 @@
+# EMO-SPN key agent
+# Keeps an unlocked master key expanded in memory and serves encrypt /
+# decrypt / verify requests over a Unix domain socket, so short-lived CLI
+# calls skip interpreter-side key setup and the escrow PBKDF2.
+#
+# Framing (both directions): OP|STATUS(1) || ARG(1) || LEN(4, big endian) || PAYLOAD
+#   ENCRYPT  arg = mode (MODE_CBC / MODE_CTR), payload = plaintext
+#   DECRYPT  payload = ciphertext (any format accepted by decrypt_bytes)
+#   VERIFY   payload = ciphertext, empty OK reply when the MAC is valid
+#   PING     empty payload, reply carries agent stats as JSON
+# Replies use STATUS_OK with the result or STATUS_ERROR with a message.
+import os, sys, json, queue, signal, socket, socketserver, struct, threading, time
+import emo_spn
+
+AGENT_SOCKET_ENV = "EMO_AGENT_SOCKET"
+DEFAULT_SOCKET = os.path.join(emo_spn.ESCROW_DIR, "agent.sock")
+AGENT_MAX_PAYLOAD = 64 * 1024 * 1024  # larger files stay on the local path
+
+OP_PING, OP_ENCRYPT, OP_DECRYPT, OP_VERIFY = 0, 1, 2, 3
+STATUS_OK, STATUS_ERROR = 0, 1
+_FRAME = struct.Struct(">BBI")
+
+BATCH_WINDOW = 0.002  # seconds to wait for more requests to coalesce
+BATCH_MAX_ITEMS = 256
+
+def socket_path(path=None):
+    return path or os.environ.get(AGENT_SOCKET_ENV) or DEFAULT_SOCKET
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:])
+        if k == 0:
+            raise ConnectionError("agent connection closed")
+        got += k
+    return bytes(buf)
+
+# ------------------------------------------------------------
+# Server side
+# ------------------------------------------------------------
+class _Job:
+    __slots__ = ("op", "arg", "payload", "status", "result", "done")
+
+    def __init__(self, op, arg, payload):
+        self.op, self.arg, self.payload = op, arg, payload
+        self.status, self.result = STATUS_ERROR, b""
+        self.done = threading.Event()
+
+    def finish(self, status, result):
+        self.status, self.result = status, result
+        self.done.set()
+
+class Batcher:
+    """
+    Single worker thread that drains the request queue in micro-batches:
+    it waits up to `window` seconds for more requests, then runs the
+    encryptions of the batch through one emo_spn.encrypt_many call per
+    mode and its decryptions through one decrypt_many call.
+    """
+    def __init__(self, cipher, window=BATCH_WINDOW, max_items=BATCH_MAX_ITEMS, engine=None):
+        self.cipher = cipher
+        self.window = window
+        self.max_items = max_items
+        self.engine = engine or emo_spn.batch_engine()
+        self.stats = {"requests": 0, "batches": 0, "errors": 0}
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, op, arg, payload):
+        job = _Job(op, arg, payload)
+        self._queue.put(job)
+        job.done.wait()
+        return job.status, job.result
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_items:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(batch)
+            self._run(batch)
+
+    def _run(self, batch):
+        cipher = self.cipher
+        groups = {}  # (op, arg) -> jobs run through one encrypt_many / decrypt_many
+        for job in batch:
+            try:
+                if job.op == OP_PING:
+                    stats = dict(self.stats, engine=self.engine)
+                    job.finish(STATUS_OK, json.dumps(stats).encode())
+                elif job.op == OP_ENCRYPT:
+                    mode = "ctr" if job.arg == emo_spn.MODE_CTR else "cbc"
+                    groups.setdefault((OP_ENCRYPT, mode), []).append(job)
+                elif job.op == OP_VERIFY:
+                    if not emo_spn.verify_bytes(job.payload, cipher):
+                        raise ValueError("MAC verification failed")
+                    job.finish(STATUS_OK, b"")
+                elif job.op == OP_DECRYPT:
+                    groups.setdefault((OP_DECRYPT, None), []).append(job)
+                else:
+                    raise ValueError(f"Unknown agent operation: {job.op}")
+            except Exception as e:
+                self.stats["errors"] += 1
+                job.finish(STATUS_ERROR, str(e).encode())
+        for (op, mode), jobs in groups.items():
+            payloads = [job.payload for job in jobs]
+            try:
+                if op == OP_ENCRYPT:
+                    results = emo_spn.encrypt_many(payloads, cipher, mode, self.engine)
+                else:
+                    results = emo_spn.decrypt_many(payloads, cipher, self.engine)
+            except Exception as e:
+                results = [e] * len(jobs)
+            for job, r in zip(jobs, results):
+                if isinstance(r, Exception):
+                    self.stats["errors"] += 1
+                    job.finish(STATUS_ERROR, str(r).encode())
+                else:
+                    job.finish(STATUS_OK, r)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        batcher = self.server.batcher
+        while True:
+            head = self.rfile.read(_FRAME.size)
+            if len(head) < _FRAME.size:
+                return
+            op, arg, n = _FRAME.unpack(head)
+            if n > AGENT_MAX_PAYLOAD:
+                msg = b"payload too large"
+                self.wfile.write(_FRAME.pack(STATUS_ERROR, 0, len(msg)) + msg)
+                return
+            payload = self.rfile.read(n)
+            if len(payload) < n:
+                return
+            status, out = batcher.submit(op, arg, payload)
+            self.wfile.write(_FRAME.pack(status, 0, len(out)))
+            self.wfile.write(out)
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, master_key, window=BATCH_WINDOW):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.remove(path)  # stale socket from a previous agent
+            else:
+                raise FileExistsError(f"An agent is already listening on {path}")
+            finally:
+                probe.close()
+        old = os.umask(0o177)  # socket only reachable by its owner
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(old)
+        self.path = path
+        self.batcher = Batcher(emo_spn.get_cipher(master_key), window)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def serve(master_key, path=None, window=BATCH_WINDOW):
+    path = socket_path(path)
+    server = AgentServer(path, master_key, window)
+    # SIGTERM unwinds like Ctrl-C so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print("Agent listening on", path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# ------------------------------------------------------------
+# Client side
+# ------------------------------------------------------------
+class AgentClient:
+    def __init__(self, path=None, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path(path))
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, op, payload=b"", arg=0):
+        self.sock.sendall(_FRAME.pack(op, arg, len(payload)))
+        self.sock.sendall(payload)
+        status, _, n = _FRAME.unpack(_recv_exact(self.sock, _FRAME.size))
+        out = _recv_exact(self.sock, n)
+        if status != STATUS_OK:
+            raise ValueError(out.decode(errors="replace"))
+        return out
+
+    def ping(self):
+        return json.loads(self.request(OP_PING))
+
+    def encrypt(self, data, mode="cbc"):
+        return self.request(OP_ENCRYPT, data, emo_spn.MODES[mode])
+
+    def decrypt(self, blob):
+        return self.request(OP_DECRYPT, blob)
+
+    def verify(self, blob):
+        try:
+            self.request(OP_VERIFY, blob)
+            return True
+        except ValueError:
+            return False
+
+def find_agent(path=None):
+    """Connected AgentClient if an agent answers on the socket, else None."""
+    path = socket_path(path)
+    if not os.path.exists(path):
+        return None
+    try:
+        client = AgentClient(path, timeout=5)
+        client.ping()
+        client.sock.settimeout(None)
+        return client
+    except OSError:
+        return None
@@ -0,0 +1,294 @@
+# EMO-SPN append log
+# An encrypted file that grows by appending: each append seals the new
+# data as records chained to the previous record's tag and rewrites only
+# the small trailer, so rolling logs are never re-encrypted.
+#
+#   HEADER   MAGIC(4) || VERSION=3(1) || MODE(1) || FLAGS(2) || FILE_ID(16)
+#   RECORD   LEN(4) || IV(16) || C || TAG(32)       LEN = len(C)
+#   TRAILER  COUNT(8) || LENGTH(8) || "EMOA"(4) || TRAILER_TAG(32)
+#
+# TAG_i = HMAC(HEADER || i || TAG_{i-1} || LEN || IV || C), TAG_{-1} = 0^32,
+# binds a record to this file, its position and everything before it;
+# TRAILER_TAG = HMAC(HEADER || TAG_last || TRAILER) fixes the record count
+# and plaintext length, so truncating, dropping, reordering or splicing
+# records is detected on a full read.
+# An append holds an exclusive flock on the file for its whole run (and
+# a reader a shared one), so appenders never interleave. It overwrites
+# the old trailer, so an interrupted append leaves a file that fails
+# verification; recover() cuts it back to the last record whose tag
+# chains and writes a fresh trailer after it.
+import fcntl, io, os, struct
+import emo_spn
+import emo_instrument as instrument
+
+RECORD_SIZE = 1 << 20  # max plaintext bytes per record
+APPEND_MODE = "ctr"
+_HEADER = struct.Struct(">4sBBH16s")
+_LEN = struct.Struct(">I")
+_TRAILER = struct.Struct(">QQ4s")
+TRAILER_MAGIC = b"EMOA"
+TAG_SIZE = 32
+_TAIL = _TRAILER.size + TAG_SIZE
+_NO_TAG = bytes(TAG_SIZE)
+
+def is_append_log(data):
+    """True if data starts with an append-log header."""
+    return (len(data) >= 5 and data[:4] == emo_spn.HEADER_MAGIC
+            and data[4] == emo_spn.APPEND_VERSION)
+
+def parse_header(data):
+    """Mode of an append-log header; ValueError if invalid."""
+    if len(data) < _HEADER.size or not is_append_log(data):
+        raise ValueError("Not an EMO-SPN append log")
+    _, _, mode, _, _ = _HEADER.unpack(data[:_HEADER.size])
+    if mode not in emo_spn.MODES.values():
+        raise ValueError("Invalid append-log header")
+    return mode
+
+def _record_tag(cipher, header, index, prev, size, iv, body):
+    mac = cipher.hmac_init()
+    for part in (header, struct.pack(">Q", index), prev, size, iv, body):
+        mac.update(part)
+    return cipher.hmac_final(mac)
+
+def _trailer_tag(cipher, header, last, trailer):
+    mac = cipher.hmac_init()
+    for part in (header, last, trailer):
+        mac.update(part)
+    return cipher.hmac_final(mac)
+
+def seal_record(cipher, header, index, prev, plaintext, engine=emo_spn.DEFAULT_ENGINE):
+    """Record LEN || IV || C || TAG of `plaintext` at position `index` after tag `prev`."""
+    iv = os.urandom(16)
+    if parse_header(header) == emo_spn.MODE_CTR:
+        body = emo_spn.ctr_xor(cipher, iv, plaintext, 0, 1, engine)
+    else:
+        body = cipher.cbc_encrypt(emo_spn.pkcs7_pad(plaintext), iv, engine)
+    size = _LEN.pack(len(body))
+    return size + iv + body + _record_tag(cipher, header, index, prev, size, iv, body)
+
+def _plain_len(cipher, mode, iv, body, engine):
+    # plaintext length of a record; CBC only decrypts the last block
+    if mode == emo_spn.MODE_CTR:
+        return len(body)
+    prev = body[-32:-16] if len(body) > 16 else iv
+    return len(body) - 16 + len(emo_spn.pkcs7_unpad(cipher.cbc_decrypt(body[-16:], prev, engine)))
+
+def _open_body(cipher, mode, iv, body, engine):
+    if mode == emo_spn.MODE_CTR:
+        return emo_spn.ctr_xor(cipher, iv, body, 0, 1, engine)
+    return emo_spn.pkcs7_unpad(cipher.cbc_decrypt(body, iv, engine))
+
+def _read_tail(f, cipher, header, size):
+    # (count, length, last tag) from a verified trailer
+    if size < _HEADER.size + _TAIL:
+        raise ValueError("Ciphertext truncated")
+    f.seek(size - _TAIL)
+    trailer, tag = f.read(_TRAILER.size), f.read(TAG_SIZE)
+    count, length, magic = _TRAILER.unpack(trailer)
+    if magic != TRAILER_MAGIC:
+        raise ValueError("Ciphertext truncated or corrupted trailer")
+    last = _NO_TAG
+    if count:
+        if size < _HEADER.size + _TAIL + TAG_SIZE:
+            raise ValueError("Ciphertext truncated")
+        f.seek(size - _TAIL - TAG_SIZE)
+        last = f.read(TAG_SIZE)
+    if _trailer_tag(cipher, header, last, trailer) != tag:
+        raise ValueError("MAC verification failed (trailer)")
+    return count, length, last
+
+def _records(f, cipher, header, mode, size, end=None):
+    # (index, iv, body, tag) of every record, each tag checked against the chain
+    end = size - _TAIL if end is None else end
+    pos, prev, index = _HEADER.size, _NO_TAG, 0
+    f.seek(pos)
+    while pos < end:
+        size_b = f.read(_LEN.size)
+        if len(size_b) < _LEN.size:
+            raise ValueError("Ciphertext truncated")
+        n = _LEN.unpack(size_b)[0]
+        pos += _LEN.size + 16 + n + TAG_SIZE
+        if pos > end or (mode == emo_spn.MODE_CBC and (not n or n % emo_spn.BLOCK_SIZE)):
+            raise ValueError(f"Corrupted record {index}")
+        iv = f.read(16)
+        body = emo_spn._read_full(f, n)
+        tag = f.read(TAG_SIZE)
+        if _record_tag(cipher, header, index, prev, size_b, iv, body) != tag:
+            raise ValueError(f"MAC verification failed (record {index})")
+        yield index, iv, body, tag
+        prev, index = tag, index + 1
+
+def _write_trailer(f, cipher, header, count, length, last):
+    trailer = _TRAILER.pack(count, length, TRAILER_MAGIC)
+    f.write(trailer + _trailer_tag(cipher, header, last, trailer))
+    f.truncate()
+
+def _open_locked(path, create=False):
+    # r+b file object holding an exclusive lock until it is closed
+    fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o666)
+    f = os.fdopen(fd, "r+b")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+class AppendLog:
+    """
+    Reader of an append log. Opening checks the header and the trailer
+    tag; verify() walks the whole tag chain, and records() yields the
+    plaintexts only after a full verification pass. Appends wait until
+    the reader is closed.
+    """
+
+    def __init__(self, path, master_key, engine=emo_spn.DEFAULT_ENGINE):
+        self.engine = engine
+        self.cipher = emo_spn.get_cipher(master_key)
+        self._f = open(path, "rb")
+        try:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_SH)
+            self.size = os.fstat(self._f.fileno()).st_size
+            self.header = self._f.read(_HEADER.size)
+            self.mode = parse_header(self.header)
+            self.count, self.length, self.last_tag = _read_tail(self._f, self.cipher, self.header,
+                                                                self.size)
+        except BaseException:
+            self._f.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self._f.close()
+
+    def verify(self):
+        """Check every record tag, the chain and the trailer; returns the tags."""
+        tags = [tag for _, _, _, tag in _records(self._f, self.cipher, self.header, self.mode,
+                                                   self.size)]
+        if len(tags) != self.count or (tags[-1] if tags else _NO_TAG) != self.last_tag:
+            raise ValueError("Ciphertext truncated or corrupted trailer")
+        return tags
+
+    def records(self):
+        """Plaintext of every record, in order; the tags are checked twice."""
+        tags = self.verify()
+        length = 0
+        for index, iv, body, tag in _records(self._f, self.cipher, self.header, self.mode,
+                                             self.size):
+            if tag != tags[index]:
+                raise ValueError("File changed while reading")
+            p = _open_body(self.cipher, self.mode, iv, body, self.engine)
+            length += len(p)
+            yield p
+        if length != self.length:
+            raise ValueError("Ciphertext truncated or corrupted trailer")
+
+def append_stream(fin, path, master_key, mode=APPEND_MODE, engine=emo_spn.DEFAULT_ENGINE,
+                  record_size=RECORD_SIZE):
+    """
+    Append everything read from fin to the log at `path`, at most
+    `record_size` plaintext bytes per record. A missing or empty file is
+    created with `mode`; an existing log keeps its own mode. Only the
+    existing trailer is verified, not the whole chain; a log left broken
+    by an interrupted append needs recover() first. Returns
+    (count, length) of the log after the append.
+    """
+    if record_size <= 0 or record_size >= 1 << 31:
+        raise ValueError("Record size must be positive and below 2 GiB")
+    cipher = emo_spn.get_cipher(master_key)
+    with _open_locked(path, create=True) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            header = f.read(_HEADER.size)
+            parse_header(header)
+            count, length, prev = _read_tail(f, cipher, header, size)
+            f.seek(size - _TAIL)
+        else:
+            if mode not in emo_spn.MODES:
+                raise ValueError(f"Unknown mode: {mode}")
+            header = _HEADER.pack(emo_spn.HEADER_MAGIC, emo_spn.APPEND_VERSION,
+                                  emo_spn.MODES[mode], 0, os.urandom(16))
+            count, length, prev = 0, 0, _NO_TAG
+            f.write(header)
+        added = 0
+        with instrument.phase("records"):
+            while True:
+                chunk = emo_spn._read_full(fin, record_size)
+                if not chunk:
+                    break
+                record = seal_record(cipher, header, count, prev, chunk, engine)
+                f.write(record)
+                prev, count, length = record[-TAG_SIZE:], count + 1, length + len(chunk)
+                added += len(chunk)
+        _write_trailer(f, cipher, header, count, length, prev)
+    if instrument.enabled:
+        instrument.count("bytes_in", added)
+    return count, length
+
+def recover(path, master_key, engine=emo_spn.DEFAULT_ENGINE):
+    """
+    Repair a log whose last append was interrupted: keep every record up
+    to the last one whose tag chains from the header, drop whatever
+    follows it and write a fresh trailer. Records the append had already
+    finished are kept, so compare the returned (count, length) with the
+    log before the append to see how much of it made it.
+    """
+    cipher = emo_spn.get_cipher(master_key)
+    with _open_locked(path) as f:
+        size = os.fstat(f.fileno()).st_size
+        header = f.read(_HEADER.size)
+        mode = parse_header(header)
+        count, length, prev, end = 0, 0, _NO_TAG, _HEADER.size
+        try:
+            # the walk also runs into the old trailer, which never chains
+            for index, iv, body, tag in _records(f, cipher, header, mode, size, end=size):
+                length += _plain_len(cipher, mode, iv, body, engine)
+                count, prev, end = index + 1, tag, f.tell()
+        except ValueError:
+            pass
+        f.seek(end)
+        _write_trailer(f, cipher, header, count, length, prev)
+    return count, length
+
+def append(path, data, master_key, mode=APPEND_MODE, engine=emo_spn.DEFAULT_ENGINE,
+           record_size=RECORD_SIZE):
+    """append_stream of a bytes-like object."""
+    return append_stream(io.BytesIO(data), path, master_key, mode, engine, record_size)
+
+def append_file(infile, outfile, master_key, mode=APPEND_MODE, engine=emo_spn.DEFAULT_ENGINE,
+                record_size=RECORD_SIZE):
+    """Append the contents of infile to the log at outfile."""
+    emo_spn.abort_if_not_in_sandbox(outfile)
+    with open(infile, "rb") as fin:
+        return append_stream(fin, outfile, master_key, mode, engine, record_size)
+
+def decrypt_file(infile, outfile, master_key, engine=emo_spn.DEFAULT_ENGINE):
+    """
+    Decrypt a whole append log. The tag chain and trailer are verified
+    before any plaintext is written; on any failure the output is removed.
+    """
+    emo_spn.abort_if_not_in_sandbox(outfile)
+    with AppendLog(infile, master_key, engine) as log:
+        try:
+            with open(outfile, "wb") as fout:
+                with instrument.phase("records"):
+                    for p in log.records():
+                        fout.write(p)
+            if instrument.enabled:
+                instrument.count("records", log.count)
+                instrument.count("bytes_out", log.length)
+        except BaseException:
+            os.remove(outfile)
+            raise
+
+def read_log(path, master_key, engine=emo_spn.DEFAULT_ENGINE):
+    """Whole plaintext of an append log, after full verification."""
+    with AppendLog(path, master_key, engine) as log:
+        return b"".join(log.records())
@@ -0,0 +1,236 @@
+# EMO-SPN asyncio API
+# The cipher is CPU-bound, so every call is offloaded to an executor
+# (threads or processes) behind a per-loop semaphore: at most
+# max_concurrency operations run at once and the rest wait their turn
+# (backpressure) instead of piling onto the executor. Key contexts come
+# from emo_spn.get_cipher, cached per process.
+import asyncio, os, weakref
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import emo_spn
+
+def _encrypt_chunk(master_key, mode, chunk, prev, counter, last, engine):
+    cipher = emo_spn.get_cipher(master_key)
+    if mode == "ctr":
+        return emo_spn.ctr_xor(cipher, prev, chunk, counter, 1, engine)
+    if last:
+        chunk = emo_spn.pkcs7_pad(chunk)
+    return cipher.cbc_encrypt(chunk, prev, engine)
+
+def _decrypt_chunk(master_key, ctr, chunk, prev, counter, last, engine):
+    cipher = emo_spn.get_cipher(master_key)
+    if ctr:
+        return emo_spn.ctr_xor(cipher, prev, chunk, counter, 1, engine)
+    p = cipher.cbc_decrypt(chunk, prev, engine)
+    return emo_spn.pkcs7_unpad(p) if last else p
+
+def _read_mac(f, mac, n):
+    chunk = f.read(n)
+    mac.update(chunk)
+    return chunk
+
+def _write_mac(f, mac, data):
+    mac.update(data)
+    f.write(data)
+
+class AsyncEmo:
+    """
+    Executor + concurrency limit for the async API.
+    executor: "thread", "process" or an Executor instance. File I/O always
+    runs on a separate small thread pool so reads and writes never block
+    the event loop. Cancelling a file operation stops it at the next
+    chunk and removes the partial output; a message operation that is
+    already running in the executor finishes but its result is dropped.
+    """
+    def __init__(self, max_concurrency=None, executor="thread", max_workers=None):
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        workers = max_workers or self.max_concurrency
+        self._owns_executor = not isinstance(executor, Executor)
+        if not self._owns_executor:
+            self.executor = executor
+        elif executor == "process":
+            self.executor = ProcessPoolExecutor(workers)
+        elif executor == "thread":
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="emo")
+        else:
+            raise ValueError(f"Unknown executor: {executor}")
+        self._io = ThreadPoolExecutor(4, thread_name_prefix="emo-io")
+        self._semaphores = weakref.WeakKeyDictionary()
+        self.pending = 0  # operations waiting for or holding a slot
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self._io.shutdown(wait=False)
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        sem = self._semaphores.get(loop)
+        if sem is None:
+            sem = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return sem
+
+    async def run(self, fn, *args):
+        """Run fn(*args) on the executor once a concurrency slot is free."""
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            async with self._semaphore():
+                return await loop.run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def _io_call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io, fn, *args)
+
+    async def encrypt(self, message, key, engine=emo_spn.AUTO_ENGINE, mode="cbc"):
+        return await self.run(emo_spn.emo_encrypt, message, key, engine, mode)
+
+    async def decrypt(self, cipher_bytes, key, engine=emo_spn.AUTO_ENGINE):
+        return await self.run(emo_spn.emo_decrypt, cipher_bytes, key, engine)
+
+    async def encrypt_file(self, infile, outfile, master_key, engine=emo_spn.AUTO_ENGINE,
+                           mode="cbc", chunk_size=emo_spn.STREAM_CHUNK_SIZE):
+        """
+        Same output as emo_spn.encrypt_file, one chunk per executor call.
+        engine "auto": the registry's choice for one chunk.
+        """
+        emo_spn.abort_if_not_in_sandbox(outfile)
+        if mode not in emo_spn.MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        bs = emo_spn.BLOCK_SIZE
+        chunk_size = max(bs, chunk_size - chunk_size % bs)
+        size = await self._io_call(os.path.getsize, infile)
+        engine = await self.run(emo_spn.resolve_engine, engine, min(size, chunk_size),
+                                "ctr" if mode == "ctr" else "cbc_encrypt")
+        cipher = await self._io_call(emo_spn.get_cipher, master_key)
+        iv = os.urandom(16)
+        head = iv if mode == "cbc" else emo_spn.pack_header(emo_spn.MODES[mode]) + iv
+        mac = cipher.hmac_init()
+        fin = await self._io_call(open, infile, "rb")
+        try:
+            fout = await self._io_call(open, outfile, "wb")
+            # from here on the output is ours to remove if anything fails
+            try:
+                await self._io_call(_write_mac, fout, mac, head)
+                prev, counter = iv, 0
+                while True:
+                    chunk = await self._io_call(fin.read, chunk_size)
+                    last = len(chunk) < chunk_size
+                    c = await self.run(_encrypt_chunk, master_key, mode, chunk, prev, counter, last, engine)
+                    if mode == "ctr":
+                        counter += len(chunk) // bs
+                    else:
+                        prev = c[-bs:]
+                    await self._io_call(_write_mac, fout, mac, c)
+                    if last:
+                        break
+                await self._io_call(fout.write, cipher.hmac_final(mac))
+            except BaseException:
+                await self._io_call(fout.close)
+                os.remove(outfile)
+                raise
+            await self._io_call(fout.close)
+        finally:
+            await self._io_call(fin.close)
+
+    async def decrypt_file(self, infile, outfile, master_key, engine=emo_spn.AUTO_ENGINE,
+                           chunk_size=emo_spn.STREAM_CHUNK_SIZE):
+        """
+        Same two passes as emo_spn.decrypt_file: verify the MAC, then
+        decrypt. Segmented containers and append logs go to
+        emo_segment.decrypt_file / emo_append.decrypt_file as a single
+        executor call.
+        engine "auto": the registry's choice for one chunk (or segment, record).
+        """
+        emo_spn.abort_if_not_in_sandbox(outfile)
+        bs = emo_spn.BLOCK_SIZE
+        chunk_size = max(bs, chunk_size - chunk_size % bs)
+        size = await self._io_call(os.path.getsize, infile)
+        engine = await self.run(emo_spn._file_engine, engine, infile, size, chunk_size)
+        version = await self._io_call(emo_spn._file_version, infile)
+        if version == emo_spn.SEGMENTED_VERSION:
+            import emo_segment
+            return await self.run(emo_segment.decrypt_file, infile, outfile, master_key, engine)
+        if version == emo_spn.APPEND_VERSION:
+            import emo_append
+            return await self.run(emo_append.decrypt_file, infile, outfile, master_key, engine)
+        cipher = await self._io_call(emo_spn.get_cipher, master_key)
+        fin = await self._io_call(open, infile, "rb")
+        try:
+            header = emo_spn.parse_header(await self._io_call(fin.read, emo_spn.HEADER_SIZE))
+            offset = emo_spn.HEADER_SIZE if header else 0
+            ctr = header is not None and header[0] == emo_spn.MODE_CTR
+            flags = emo_spn._header_flags(header)
+            if size < offset + 16 + 32:
+                raise ValueError("Ciphertext too short")
+            body = size - offset - 16 - 32
+            for check in (True, False):
+                await self._io_call(fin.seek, 0)
+                mac = emo_spn.mac_init(cipher, flags)
+                head = await self._io_call(_read_mac, fin, mac, offset + 16)
+                iv = head[offset:]
+                if not check:
+                    # opened outside the try: a failed open removes nothing
+                    fout = await self._io_call(open, outfile, "wb")
+                try:
+                    prev, counter, remaining = iv, 0, body
+                    while remaining:
+                        chunk = await self._io_call(_read_mac, fin, mac, min(chunk_size, remaining))
+                        if not chunk:
+                            raise ValueError("Ciphertext truncated")
+                        remaining -= len(chunk)
+                        if check:
+                            continue
+                        p = await self.run(_decrypt_chunk, master_key, ctr, chunk, prev, counter,
+                                           remaining == 0, engine)
+                        if ctr:
+                            counter += len(chunk) // bs
+                        else:
+                            prev = chunk[-bs:]
+                        await self._io_call(fout.write, p)
+                    tag = await self._io_call(fin.read, 32)
+                    if emo_spn.mac_final(cipher, mac) != tag:
+                        raise ValueError("MAC verification failed")
+                    if check and not ctr and (body == 0 or body % bs):
+                        raise ValueError("Invalid padding length")
+                except BaseException:
+                    if not check:
+                        await self._io_call(fout.close)
+                        os.remove(outfile)
+                    raise
+                if not check:
+                    await self._io_call(fout.close)
+        finally:
+            await self._io_call(fin.close)
+
+_default = None
+
+def configure_async(max_concurrency=None, executor="thread", max_workers=None):
+    """Replace the shared AsyncEmo used by the module-level functions."""
+    global _default
+    if _default is not None:
+        _default.close()
+    _default = AsyncEmo(max_concurrency, executor, max_workers)
+    return _default
+
+def _shared():
+    global _default
+    if _default is None:
+        _default = AsyncEmo()
+    return _default
+
+async def emo_encrypt_async(message: str, key: str, engine: str = emo_spn.AUTO_ENGINE, mode: str = "cbc"):
+    """Versión asíncrona de emo_encrypt: devuelve (cipher_bytes, elapsed_seconds)."""
+    return await _shared().encrypt(message, key, engine, mode)
+
+async def emo_decrypt_async(cipher_bytes: bytes, key: str, engine: str = emo_spn.AUTO_ENGINE):
+    """Versión asíncrona de emo_decrypt: devuelve (plaintext_str, elapsed_seconds)."""
+    return await _shared().decrypt(cipher_bytes, key, engine)
+
+async def encrypt_file_async(infile, outfile, master_key, engine=emo_spn.AUTO_ENGINE, mode="cbc",
+                             chunk_size=emo_spn.STREAM_CHUNK_SIZE):
+    return await _shared().encrypt_file(infile, outfile, master_key, engine, mode, chunk_size)
+
+async def decrypt_file_async(infile, outfile, master_key, engine=emo_spn.AUTO_ENGINE,
+                             chunk_size=emo_spn.STREAM_CHUNK_SIZE):
+    return await _shared().decrypt_file(infile, outfile, master_key, engine, chunk_size)
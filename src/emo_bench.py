@@ -0,0 +1,317 @@
+# EMO-SPN benchmark suite
+# Times key setup, single-block latency, bulk encrypt/decrypt per engine
+# and mode, and the file CLI end to end. Every case runs warmups, then
+# `repeat` timed repetitions (key setup excluded unless it is what is
+# measured), and one extra run under tracemalloc for the peak memory.
+# Results go to JSON with machine metadata; `compare` flags cases whose
+# median got slower than a saved baseline.
+#
+#   python src/emo_bench.py run --out bench.json
+#   python src/emo_bench.py compare baseline.json bench.json --threshold 0.10
+import os, sys, argparse, json, platform, shutil, subprocess, tempfile, time, tracemalloc
+import emo_spn
+
+DEFAULT_SIZES = [1 << 10, 1 << 14, 1 << 20]
+ALL_SIZES = [1 << 10, 1 << 14, 1 << 20, 1 << 24, 1 << 30]
+DEFAULT_REPEAT = 5
+DEFAULT_WARMUP = 1
+DEFAULT_THRESHOLD = 0.10  # relative slowdown of the median that counts as a regression
+REFERENCE_MAX_SIZE = 1 << 14  # the bit-list engine is only run on small inputs
+BITSLICE_LANES = [64, 128, 512]  # lane widths timed besides the engine default
+BITSLICE_BYTES = 1 << 14  # input of the lane-width cases
+# seconds a fresh interpreter may spend importing each module; heavy
+# dependencies (numpy, matplotlib) must stay lazy for these to hold
+IMPORT_BUDGET_S = {"emo_spn": 0.25, "logging_tools": 0.25, "plotting_tools": 0.25}
+BENCH_KEY = bytes(range(emo_spn.MASTER_KEY_SIZE))
+BENCH_PASSPHRASE = "emo-bench"
+
+def percentile(values, q):
+    """q-th percentile (0-100) with linear interpolation."""
+    s = sorted(values)
+    if not s:
+        return 0.0
+    k = (len(s) - 1) * q / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+def _peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(fn, repeat=DEFAULT_REPEAT, warmup=DEFAULT_WARMUP, memory=True):
+    """
+    Time fn() `repeat` times after `warmup` untimed calls. Returns the
+    stats dict stored for each case.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    stats = {
+        "repeat": repeat,
+        "warmup": warmup,
+        "median_s": percentile(times, 50),
+        "p90_s": percentile(times, 90),
+        "p99_s": percentile(times, 99),
+        "min_s": min(times),
+        "max_s": max(times),
+        "mean_s": sum(times) / len(times),
+    }
+    stats["peak_mem_bytes"] = _peak_memory(fn) if memory else None
+    return stats
+
+def machine_metadata():
+    meta = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "engines": emo_spn.available_engines(),
+    }
+    try:
+        meta["numpy"] = emo_spn._numpy().__version__
+    except ImportError:
+        meta["numpy"] = None
+    try:
+        meta["git_commit"] = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        meta["git_commit"] = None
+    return meta
+
+_IMPORT_PROBE = """
+import sys, time
+t0 = time.perf_counter()
+import {module}
+print(time.perf_counter() - t0, *sorted(m for m in ("numpy", "matplotlib") if m in sys.modules))
+"""
+
+def import_time(module, repeat=3):
+    """
+    Seconds to import `module` in a fresh interpreter (best of `repeat`)
+    and the heavy dependencies it loaded on the way.
+    """
+    src = os.path.dirname(os.path.abspath(__file__))
+    best, loaded = None, []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", _IMPORT_PROBE.format(module=module)], cwd=src,
+                             capture_output=True, text=True, check=True).stdout.split()
+        if best is None or float(out[0]) < best:
+            best, loaded = float(out[0]), out[1:]
+    return best, loaded
+
+# ------------------------------------------------------------
+# Cases. Each yields (name, params, fn); inputs are prepared up front.
+# ------------------------------------------------------------
+def import_cases():
+    # timed end to end, interpreter start included; run_suite adds the
+    # import seconds alone (import_time) and whether they exceed the budget
+    for module in IMPORT_BUDGET_S:
+        yield (f"import/{module}", {"module": module, "budget_s": IMPORT_BUDGET_S[module]},
+               lambda m=module: import_time(m, 1))
+
+def key_setup_cases():
+    # EmoCipher directly, so the cipher cache never hides the setup
+    yield "key_setup", {}, lambda: emo_spn.EmoCipher(BENCH_KEY)
+
+def block_latency_cases(engines):
+    cipher = emo_spn.get_cipher(BENCH_KEY)
+    block = bytes(emo_spn.BLOCK_SIZE)
+    for engine in engines:
+        for op, fn in (("encrypt", cipher.encrypt_blocks), ("decrypt", cipher.decrypt_blocks)):
+            yield (f"block/{op}/{engine}", {"op": op, "engine": engine},
+                   lambda fn=fn, engine=engine: fn(block, engine))
+
+def bulk_cases(engines, sizes, modes):
+    cipher = emo_spn.get_cipher(BENCH_KEY)
+    for size in sizes:
+        data = os.urandom(size)
+        for engine in engines:
+            if engine == "reference" and size > REFERENCE_MAX_SIZE:
+                continue
+            for mode in modes:
+                params = {"op": "encrypt", "engine": engine, "mode": mode, "bytes": size}
+                yield (f"bulk/encrypt/{mode}/{engine}/{size}", params,
+                       lambda d=data, m=mode, e=engine: emo_spn.encrypt_bytes(d, cipher, m, e))
+                blob = emo_spn.encrypt_bytes(data, cipher, mode, engine)
+                params = dict(params, op="decrypt")
+                yield (f"bulk/decrypt/{mode}/{engine}/{size}", params,
+                       lambda b=blob, e=engine: emo_spn.decrypt_bytes(b, cipher, e))
+
+def bitslice_cases(lanes=None):
+    # same input for every width: throughput as a function of the lane count
+    cipher = emo_spn.get_cipher(BENCH_KEY)
+    data = os.urandom(BITSLICE_BYTES)
+    for width in (lanes or BITSLICE_LANES + [emo_spn.BITSLICE_LANES]):
+        params = {"op": "encrypt", "engine": "bitslice", "lanes": width, "bytes": len(data)}
+        yield (f"bitslice/encrypt/{width}", params,
+               lambda w=width: emo_spn.bitslice_encrypt_blocks(data, cipher, w))
+
+def _cli(workdir, *args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "emo_spn.py")
+    subprocess.run([sys.executable, script, *args], cwd=workdir, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def cli_cases(workdir, sizes, modes):
+    # end to end: interpreter start, escrow unlock, file I/O, cipher, MAC
+    _cli(workdir, "init", "-p", BENCH_PASSPHRASE)
+    sandbox = os.path.join(workdir, "sandbox")
+    for size in sizes:
+        src = os.path.join(sandbox, f"bench_{size}.bin")
+        with open(src, "wb") as f:
+            f.write(os.urandom(size))
+        for mode in modes:
+            enc = os.path.join(sandbox, f"bench_{size}_{mode}.enc")
+            dec = os.path.join(sandbox, f"bench_{size}_{mode}.dec")
+            common = ["-p", BENCH_PASSPHRASE, "--no-agent"]
+            params = {"op": "encrypt", "mode": mode, "bytes": size}
+            yield (f"cli/encrypt/{mode}/{size}", params,
+                   lambda s=src, e=enc, m=mode: _cli(workdir, "encrypt", s, e, "--mode", m, *common))
+            _cli(workdir, "encrypt", src, enc, "--mode", mode, *common)
+            yield (f"cli/decrypt/{mode}/{size}", dict(params, op="decrypt"),
+                   lambda e=enc, d=dec: _cli(workdir, "decrypt", e, d, *common))
+
+def run_suite(engines=None, sizes=None, modes=None, repeat=DEFAULT_REPEAT, warmup=DEFAULT_WARMUP,
+              cli=True, cli_sizes=None, progress=None):
+    """Run every case and return {"meta": ..., "results": [...]}."""
+    engines = engines or emo_spn.available_engines()
+    sizes = sizes or DEFAULT_SIZES
+    modes = modes or sorted(emo_spn.MODES)
+    groups = [key_setup_cases(), block_latency_cases(engines), bulk_cases(engines, sizes, modes)]
+    if "bitslice" in engines:
+        groups.append(bitslice_cases())
+    workdir = None
+    if cli:
+        groups.append(import_cases())
+        workdir = tempfile.mkdtemp(prefix="emo_bench_")
+        groups.append(cli_cases(workdir, cli_sizes or [sizes[0], sizes[-1]], modes))
+    results = []
+    try:
+        for cases in groups:
+            for name, params, fn in cases:
+                # subprocess memory is not visible to tracemalloc
+                stats = measure(fn, repeat, warmup, memory=not name.startswith(("cli/", "import/")))
+                if "bytes" in params and stats["median_s"] > 0:
+                    stats["mb_per_s"] = params["bytes"] / stats["median_s"] / 1e6
+                if "budget_s" in params:
+                    seconds, loaded = import_time(params["module"])
+                    stats.update(import_s=seconds, heavy_loaded=loaded,
+                                 over_budget=seconds > params["budget_s"])
+                results.append(dict(name=name, params=params, **stats))
+                if progress:
+                    progress(results[-1])
+    finally:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    meta = machine_metadata()
+    meta.update(repeat=repeat, warmup=warmup, sizes=sizes, modes=modes)
+    return {"meta": meta, "results": results}
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Rows (name, baseline median, current median, ratio, status) for the
+    cases present in both runs; status is "regression" when the current
+    median is more than `threshold` slower, "improved" when it is more
+    than `threshold` faster.
+    """
+    base = {r["name"]: r for r in baseline["results"]}
+    rows = []
+    for r in current["results"]:
+        b = base.get(r["name"])
+        if b is None or not b["median_s"]:
+            continue
+        ratio = r["median_s"] / b["median_s"]
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 - threshold:
+            status = "improved"
+        else:
+            status = "ok"
+        rows.append((r["name"], b["median_s"], r["median_s"], ratio, status))
+    return rows
+
+def _format_result(r):
+    line = f"{r['name']:<40} median {r['median_s']*1e3:10.3f} ms  p90 {r['p90_s']*1e3:10.3f} ms"
+    if "mb_per_s" in r:
+        line += f"  {r['mb_per_s']:8.3f} MB/s"
+    if r.get("peak_mem_bytes") is not None:
+        line += f"  peak {r['peak_mem_bytes']/1024:9.1f} KiB"
+    if "import_s" in r:
+        line += f"  import {r['import_s']*1e3:8.3f} ms"
+        if r["over_budget"]:
+            line += " OVER BUDGET"
+        if r["heavy_loaded"]:
+            line += " loaded " + ",".join(r["heavy_loaded"])
+    return line
+
+def _size(text):
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+    text = text.strip().lower().rstrip("b")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def cmd_run(args):
+    sizes = [_size(s) for s in args.sizes.split(",")] if args.sizes else DEFAULT_SIZES
+    if args.max_size:
+        sizes = [s for s in ALL_SIZES if s <= _size(args.max_size)]
+    engines = args.engines.split(",") if args.engines else None
+    modes = args.modes.split(",") if args.modes else None
+    report = run_suite(engines, sizes, modes, args.repeat, args.warmup, cli=not args.no_cli,
+                       progress=lambda r: print(_format_result(r), flush=True))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("Results at:", args.out)
+
+def cmd_compare(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    rows = compare(baseline, current, args.threshold)
+    for name, b, c, ratio, status in rows:
+        print(f"{name:<40} {b*1e3:10.3f} ms -> {c*1e3:10.3f} ms  x{ratio:6.3f}  {status}")
+    regressions = [r for r in rows if r[4] == "regression"]
+    print(f"{len(rows)} cases compared, {len(regressions)} regressions")
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(prog="emo_bench")
+    sub = parser.add_subparsers(dest="cmd")
+    p_run = sub.add_parser("run", help="run the benchmark suite")
+    p_run.add_argument("--out", default="bench.json", help="JSON results (default: %(default)s)")
+    p_run.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    p_run.add_argument("--warmup", type=int, default=DEFAULT_WARMUP)
+    p_run.add_argument("--sizes", help="comma-separated bulk sizes, e.g. 1k,64k,1m")
+    p_run.add_argument("--max-size", help="all standard sizes up to this one (1k ... 1g)")
+    p_run.add_argument("--engines", help="comma-separated engines (default: all available)")
+    p_run.add_argument("--modes", help="comma-separated modes (default: all)")
+    p_run.add_argument("--no-cli", action="store_true", help="skip the end-to-end CLI cases")
+    p_cmp = sub.add_parser("compare", help="compare a run against a baseline")
+    p_cmp.add_argument("baseline")
+    p_cmp.add_argument("current")
+    p_cmp.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                       help="relative median slowdown reported as a regression (default: %(default)s)")
+    args = parser.parse_args()
+    if args.cmd == "run":
+        cmd_run(args)
+    elif args.cmd == "compare":
+        sys.exit(cmd_compare(args))
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# EMO-SPN bulk commands: encrypt-tree / decrypt-tree
+# Unlock the key once, then process every file of a directory (or glob)
+# under sandbox/ on a process pool, with a per-file JSON-lines manifest
+# that lets an interrupted run resume where it stopped.
+import os, glob, json, time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import emo_spn
+
+MANIFEST_NAME = "manifest.jsonl"
+ENC_SUFFIX = ".enc"
+DEC_SUFFIX = ".dec"
+MAX_INFLIGHT_BYTES = 256 * 1024 * 1024
+
+_worker_key = None
+
+def _init_worker(master_key):
+    # each worker builds (or, after fork, inherits) the expanded key once
+    global _worker_key
+    _worker_key = master_key
+    emo_spn.preload_cipher(master_key)
+    emo_spn.get_cipher(master_key)
+
+def _process_one(op, src, dst, engine, mode, chunk_size):
+    t0 = time.perf_counter()
+    part = dst + ".part"
+    entry = {"src": src, "dst": dst, "size": os.path.getsize(src),
+             "mtime": os.path.getmtime(src)}
+    try:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if op == "encrypt":
+            emo_spn.encrypt_file(src, part, _worker_key, engine=engine, chunk_size=chunk_size, mode=mode)
+        else:
+            emo_spn.decrypt_file(src, part, _worker_key, engine=engine, chunk_size=chunk_size)
+        os.replace(part, dst)  # only complete outputs get the final name
+        entry.update(status="ok", out_size=os.path.getsize(dst))
+    except Exception as e:
+        if os.path.exists(part):
+            os.remove(part)
+        entry.update(status="error", error=str(e))
+    entry["seconds"] = round(time.perf_counter() - t0, 6)
+    return entry
+
+def _glob_base(pattern):
+    # longest leading directory of the pattern without wildcards
+    parts = []
+    for p in os.path.normpath(pattern).split(os.sep):
+        if any(c in p for c in "*?["):
+            break
+        parts.append(p)
+    return os.sep.join(parts) or "."
+
+def list_inputs(source, skip_dir=None):
+    """(path, relative path) pairs for a directory or a glob pattern."""
+    if os.path.isdir(source):
+        base = source
+        paths = [os.path.join(root, name) for root, _, names in os.walk(source) for name in names]
+    else:
+        base = _glob_base(source)
+        paths = [p for p in glob.glob(source, recursive=True) if os.path.isfile(p)]
+    skip = os.path.abspath(skip_dir) + os.sep if skip_dir else None
+    out = []
+    for p in sorted(paths):
+        ap = os.path.abspath(p)
+        if skip and ap.startswith(skip):
+            continue
+        if p.endswith(".part"):
+            continue
+        out.append((ap, os.path.relpath(ap, os.path.abspath(base))))
+    return out
+
+def _output_name(op, rel):
+    if op == "encrypt":
+        return rel + ENC_SUFFIX
+    if rel.endswith(ENC_SUFFIX):
+        return rel[:-len(ENC_SUFFIX)]
+    return rel + DEC_SUFFIX
+
+def load_manifest(path):
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn last line of an interrupted run
+                done[entry["src"]] = entry
+    return done
+
+def _is_complete(entry, src):
+    return (entry is not None and entry.get("status") == "ok"
+            and os.path.exists(entry["dst"])
+            and os.path.getsize(entry["dst"]) == entry.get("out_size")
+            and os.path.getsize(src) == entry.get("size")
+            and os.path.getmtime(src) == entry.get("mtime"))
+
+def process_tree(op, source, dest, master_key, workers=None, engine=emo_spn.DEFAULT_ENGINE,
+                 mode="cbc", manifest=None, max_inflight_bytes=MAX_INFLIGHT_BYTES,
+                 chunk_size=emo_spn.STREAM_CHUNK_SIZE):
+    """
+    Encrypt or decrypt (op) every input file into dest, keeping relative
+    paths. Files already recorded as complete in the manifest are skipped.
+    At most max_inflight_bytes of input (and 2 tasks per worker) are
+    queued at once. Returns {"ok", "skipped", "error"} counts.
+    """
+    emo_spn.abort_if_not_in_sandbox(dest)
+    workers = emo_spn.resolve_workers(workers)
+    manifest = manifest or os.path.join(dest, MANIFEST_NAME)
+    os.makedirs(dest, exist_ok=True)
+    done = load_manifest(manifest)
+    counts = {"ok": 0, "skipped": 0, "error": 0}
+    todo = []
+    for src, rel in list_inputs(source, skip_dir=dest):
+        emo_spn.abort_if_not_in_sandbox(src)
+        if _is_complete(done.get(src), src):
+            counts["skipped"] += 1
+            continue
+        todo.append((src, os.path.join(os.path.abspath(dest), _output_name(op, rel))))
+    emo_spn.get_cipher(master_key)  # warm the cache so forked workers inherit it
+    with open(manifest, "a", encoding="utf-8") as log, \
+         ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(master_key,)) as pool:
+        pending = {}
+        inflight = 0
+
+        def drain(block):
+            nonlocal inflight
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED) if block else (
+                [f for f in pending if f.done()], None)
+            for f in finished:
+                inflight -= pending.pop(f)
+                entry = f.result()
+                counts[entry["status"]] += 1
+                log.write(json.dumps(entry) + "\n")
+                log.flush()
+
+        for src, dst in todo:
+            size = os.path.getsize(src)
+            while pending and (len(pending) >= 2 * workers or inflight + size > max_inflight_bytes):
+                drain(True)
+            pending[pool.submit(_process_one, op, src, dst, engine, mode, chunk_size)] = size
+            inflight += size
+            drain(False)
+        while pending:
+            drain(True)
+    return counts
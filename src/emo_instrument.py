@@ -0,0 +1,374 @@
+# EMO-SPN instrumentation
+# Opt-in per-phase timings and counters. Code marks an operation
+# (operation("emo_encrypt")), the phases inside it (phase("kdf")) and
+# counters (count("blocks", n)); when the operation ends, one record
+#   {"op", "start", "elapsed", "phases": {name: seconds}, "counters": {name: n}, "error"}
+# goes to every sink. Disabled (the default), phase() returns a shared
+# no-op object and count() returns at once, so instrumented hot paths pay
+# one global check. Phases and counters outside an operation are dropped;
+# a nested operation is also added to its parent as a phase, together
+# with its counters.
+#
+# Sinks are objects with emit(record): StatsRegistry (in process),
+# JsonLinesSink, PrometheusSink (text exposition format, for the node
+# exporter textfile collector); logging_tools.LogSink writes execution.log.
+# Line-oriented output (JSON lines, the execution log) goes through a
+# BatchWriter, which buffers lines and writes them in batches.
+import os, sys, json, threading, time, contextvars
+
+enabled = False
+_sinks = []
+_current = contextvars.ContextVar("emo_operation", default=None)
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase:
+    __slots__ = ("op", "name", "t0")
+
+    def __init__(self, op, name):
+        self.op, self.name = op, name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.op.add_phase(self.name, time.perf_counter() - self.t0)
+        return False
+
+class Operation:
+    """
+    Times itself even when instrumentation is disabled (elapsed is what
+    emo_encrypt and measure_time return); records and sinks only when
+    enabled at entry.
+    """
+    __slots__ = ("name", "start", "elapsed", "phases", "counters", "_t0", "_token")
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = 0.0
+        self.phases = {}
+        self.counters = {}
+        self._token = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.time()
+            self._token = _current.set(self)
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self._t0
+        if self._token is None:
+            return False
+        _current.reset(self._token)
+        self._token = None
+        parent = _current.get()
+        if parent is not None:
+            parent.add_phase(self.name, self.elapsed)
+            for k, v in self.counters.items():
+                parent.count(k, v)
+        _emit(self.record(exc_type))
+        return False
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, exc_type=None):
+        rec = {"op": self.name, "start": self.start, "elapsed": self.elapsed,
+               "phases": self.phases, "counters": self.counters}
+        if exc_type is not None:
+            rec["error"] = exc_type.__name__
+        return rec
+
+def operation(name):
+    return Operation(name)
+
+def phase(name):
+    """Context manager timing `name` inside the current operation."""
+    if not enabled:
+        return _NULL_PHASE
+    op = _current.get()
+    return _NULL_PHASE if op is None else _Phase(op, name)
+
+def count(name, n=1):
+    if not enabled:
+        return
+    op = _current.get()
+    if op is not None:
+        op.count(name, n)
+
+def _emit(record):
+    for sink in list(_sinks):
+        try:
+            sink.emit(record)
+        except Exception as e:  # a broken sink must not break the cipher
+            print(f"emo_instrument: {type(sink).__name__} failed: {e}", file=sys.stderr)
+
+def enable(*sinks):
+    """Turn instrumentation on with these sinks (default: the REGISTRY)."""
+    global enabled
+    _sinks[:] = sinks or [REGISTRY]
+    enabled = True
+
+def disable():
+    """Turn instrumentation off and close the sinks."""
+    global enabled
+    enabled = False
+    sinks, _sinks[:] = list(_sinks), []
+    for sink in sinks:
+        close = getattr(sink, "close", None)
+        if close:
+            close()
+
+# ------------------------------------------------------------
+# Sinks
+# ------------------------------------------------------------
+class StatsRegistry:
+    """Aggregates records in process: calls, errors and seconds per operation
+    and per phase, counter totals per operation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.ops = {}       # op -> {"calls", "errors", "seconds", "max"}
+            self.phases = {}    # (op, phase) -> {"calls", "seconds", "max"}
+            self.counters = {}  # (op, counter) -> total
+
+    def emit(self, record):
+        op = record["op"]
+        with self._lock:
+            s = self.ops.setdefault(op, {"calls": 0, "errors": 0, "seconds": 0.0, "max": 0.0})
+            s["calls"] += 1
+            s["errors"] += "error" in record
+            s["seconds"] += record["elapsed"]
+            s["max"] = max(s["max"], record["elapsed"])
+            for name, sec in record["phases"].items():
+                p = self.phases.setdefault((op, name), {"calls": 0, "seconds": 0.0, "max": 0.0})
+                p["calls"] += 1
+                p["seconds"] += sec
+                p["max"] = max(p["max"], sec)
+            for name, n in record["counters"].items():
+                self.counters[(op, name)] = self.counters.get((op, name), 0) + n
+
+    def snapshot(self):
+        with self._lock:
+            out = {}
+            for op, s in self.ops.items():
+                out[op] = dict(s, phases={}, counters={})
+            for (op, name), p in self.phases.items():
+                out[op]["phases"][name] = dict(p)
+            for (op, name), n in self.counters.items():
+                out[op]["counters"][name] = n
+            return out
+
+    def summary(self):
+        """Human-readable table of the snapshot."""
+        lines = []
+        for op, s in sorted(self.snapshot().items()):
+            lines.append(f"{op}: {s['calls']} calls, {s['errors']} errors, "
+                         f"{s['seconds']:.6f}s total, {s['max']:.6f}s max")
+            for name, p in sorted(s["phases"].items(), key=lambda kv: -kv[1]["seconds"]):
+                share = p["seconds"] / s["seconds"] * 100 if s["seconds"] else 0.0
+                lines.append(f"  {name:<16} {p['seconds']:.6f}s ({share:5.1f}%)")
+            for name, n in sorted(s["counters"].items()):
+                lines.append(f"  {name:<16} {n}")
+        return "\n".join(lines)
+
+REGISTRY = StatsRegistry()
+
+class BatchWriter:
+    """
+    Thread-safe buffered line writer for a path (opened for append on the
+    first write and kept open) or a stream. Lines are written `batch` at a
+    time, on flush() and on close(). With background=True a daemon thread
+    does the writing, woken when a batch fills and every `interval`
+    seconds, so write() only appends to a list.
+    """
+
+    def __init__(self, target, batch=64, background=False, interval=0.5):
+        self.target = target
+        self.batch = max(1, batch)
+        self.interval = interval
+        self._own = isinstance(target, str)
+        self._stream = None if self._own else target
+        self._lines = []
+        self._lock = threading.Lock()     # guards _lines
+        self._io_lock = threading.Lock()  # keeps batches in order
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, name="emo-writer", daemon=True)
+            self._thread.start()
+
+    def write(self, line):
+        with self._lock:
+            if self._closed:
+                raise ValueError("write to a closed BatchWriter")
+            self._lines.append(line)
+            full = len(self._lines) >= self.batch
+        if full:
+            if self._thread is not None:
+                self._wake.set()
+            else:
+                self.flush()
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                lines, self._lines = self._lines, []
+            if not lines:
+                return
+            if self._stream is None:
+                self._stream = open(self.target, "a", encoding="utf-8")
+            self._stream.write("\n".join(lines) + "\n")
+            self._stream.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"emo_instrument: writer for {self.target} failed: {e}", file=sys.stderr)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None:
+            self._wake.set()
+            self._thread.join()
+        self.flush()
+        if self._own and self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+class JsonLinesSink:
+    """
+    One JSON object per record, appended to a path or written to a stream,
+    in batches of `batch` records (see BatchWriter); close() writes the rest.
+    """
+
+    def __init__(self, target, batch=64, background=False):
+        self.writer = BatchWriter(target, batch, background)
+
+    def emit(self, record):
+        self.writer.write(json.dumps(record))
+
+    def close(self):
+        self.writer.close()
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _metric_name(name):
+    return "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+
+def prometheus_text(registry=None):
+    """The registry in the Prometheus text exposition format."""
+    snap = (registry or REGISTRY).snapshot()
+    out = []
+
+    def family(name, help_text, samples):
+        if samples:
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} counter")
+            out.extend(f"{name}{{{labels}}} {value}" for labels, value in samples)
+
+    ops = sorted(snap.items())
+    family("emo_operations_total", "Finished operations.",
+           [(f'op="{_label(op)}"', s["calls"]) for op, s in ops])
+    family("emo_operation_errors_total", "Operations that raised.",
+           [(f'op="{_label(op)}"', s["errors"]) for op, s in ops])
+    family("emo_operation_seconds_total", "Wall time spent in operations.",
+           [(f'op="{_label(op)}"', repr(s["seconds"])) for op, s in ops])
+    family("emo_phase_seconds_total", "Wall time spent per phase.",
+           [(f'op="{_label(op)}",phase="{_label(name)}"', repr(p["seconds"]))
+            for op, s in ops for name, p in sorted(s["phases"].items())])
+    names = sorted({name for _, s in ops for name in s["counters"]})
+    for name in names:
+        family(f"emo_{_metric_name(name)}_total", f"Counter {name}.",
+               [(f'op="{_label(op)}"', s["counters"][name]) for op, s in ops if name in s["counters"]])
+    return "\n".join(out) + "\n"
+
+class PrometheusSink:
+    """
+    Keeps its own registry and rewrites `path` (atomically) with its text
+    format at most every `interval` seconds, and on close().
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.registry = StatsRegistry()
+        self._last = 0.0
+
+    def emit(self, record):
+        self.registry.emit(record)
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.write()
+
+    def write(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(prometheus_text(self.registry))
+        os.replace(tmp, self.path)
+
+    def close(self):
+        self.write()
+
+class _SummarySink:
+    # "stats" spec: registry summary on stderr when closed
+    def __init__(self):
+        self.registry = StatsRegistry()
+
+    def emit(self, record):
+        self.registry.emit(record)
+
+    def close(self):
+        print(self.registry.summary(), file=sys.stderr)
+
+def configure(spec):
+    """
+    Enable the sinks of a spec string, comma separated:
+      stats        summary of the run on stderr
+      jsonl:PATH   JSON lines appended to PATH ("jsonl:-" for stderr)
+      prom:PATH    Prometheus text file rewritten at PATH
+    An empty spec leaves instrumentation disabled. Returns the sinks.
+    """
+    sinks = []
+    for item in filter(None, (s.strip() for s in (spec or "").split(","))):
+        kind, _, arg = item.partition(":")
+        if kind == "stats":
+            sinks.append(_SummarySink())
+        elif kind == "jsonl" and arg:
+            sinks.append(JsonLinesSink(sys.stderr if arg == "-" else arg))
+        elif kind == "prom" and arg:
+            sinks.append(PrometheusSink(arg))
+        else:
+            raise ValueError(f"Unknown metrics sink: {item}")
+    if sinks:
+        enable(*sinks)
+    return sinks
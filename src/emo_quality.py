@@ -0,0 +1,226 @@
+# EMO-SPN S-box / P-layer quality analyzer
+# Every master key derives its own S-box and bit permutation; this module
+# measures how good a key's instance is and screens many keys at once.
+#   S-box:   DDT (differential uniformity), LAT via the Walsh-Hadamard
+#            transform (nonlinearity, linearity), algebraic degree, fixed
+#            points
+#   P-layer: fixed bits, bits kept inside their byte, the number of
+#            distinct bytes each byte's bits reach (spread) and the rounds
+#            until every input byte affects every output byte
+# Tables are computed for a batch of keys in one set of numpy operations;
+# screening splits the keys into batches over a process pool.
+#
+#   python src/emo_quality.py --keys 20000 -j 0 --out quality.json
+import sys, argparse, hashlib, json, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import emo_spn
+
+DEFAULT_BATCH = 32  # keys per task; the tables take about 1 MiB per key
+_X = np.arange(256)
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# what counts as weak: (kind, bound) per metric, kind "max" or "min".
+# The S-boxes of random keys have differential uniformity 10-14,
+# nonlinearity 86-96, about one fixed point and degree 6-7; the bounds
+# only catch the tails (about 1% of keys).
+WEAK_LIMITS = {
+    "differential_uniformity": ("max", 14),
+    "nonlinearity": ("min", 84),
+    "algebraic_degree": ("min", 6),
+    "fixed_points": ("max", 5),
+    "same_byte_bits": ("max", 20),
+    "spread_min": ("min", 4),
+    "diffusion_rounds": ("max", 3),
+}
+
+def key_for(seed, index):
+    """Master key `index` of a screening run; derived from the seed so runs repeat."""
+    return hashlib.sha256(f"emo-quality:{seed}:{index}".encode()).digest()
+
+def instances(keys):
+    """(S, P): S-boxes (K, 256) uint8 and bit permutations (K, 128) of the keys."""
+    S = np.array([list(emo_spn.sbox_gen(k)[0]) for k in keys], dtype=np.uint8).reshape(-1, 256)
+    P = np.array([emo_spn.player_gen(k)[0] for k in keys], dtype=np.int64).reshape(-1, 128)
+    return S, P
+
+def ddt(S):
+    """Difference distribution tables (K, 256, 256): [k, dx, dy] = #{x : S(x) ^ S(x ^ dx) = dy}."""
+    S = np.asarray(S, dtype=np.int64).reshape(-1, 256)
+    k = len(S)
+    dy = S[:, _X[:, None] ^ _X[None, :]] ^ S[:, None, :]
+    idx = (np.arange(k)[:, None, None] * 256 + _X[None, :, None]) * 256 + dy
+    return np.bincount(idx.ravel(), minlength=k * 65536).reshape(k, 256, 256)
+
+def walsh(S):
+    """
+    Walsh spectra (K, 256, 256): [k, b, a] = sum_x (-1)^(b.S(x) ^ a.x),
+    i.e. twice the LAT entry of input mask a and output mask b.
+    """
+    S = np.asarray(S, dtype=np.int64).reshape(-1, 256)
+    f = 1 - 2 * (POPCOUNT[_X[None, :, None] & S[:, None, :]] & 1).astype(np.int16)  # |W| <= 256
+    k, n, h = len(S), 256, 1
+    while h < n:
+        f = f.reshape(k, n, n // (2 * h), 2, h)
+        a, b = f[..., 0, :], f[..., 1, :]
+        f = np.stack((a + b, a - b), axis=-2)
+        h *= 2
+    return f.reshape(k, n, n)
+
+def lat(S):
+    """Linear approximation tables (K, 256, 256): [k, a, b] = #{x : a.x = b.S(x)} - 128."""
+    return walsh(S).transpose(0, 2, 1) // 2
+
+def algebraic_degree(S):
+    """Minimum algebraic degree over the non-zero component functions, per key."""
+    S = np.asarray(S, dtype=np.uint8).reshape(-1, 256)
+    # ANF of every coordinate bit by the Moebius transform, (K, 8, 256)
+    a = ((S[:, None, :] >> np.arange(8)[None, :, None]) & 1).astype(np.uint8)
+    for i in range(8):
+        bit = 1 << i
+        hi = _X[_X & bit != 0]
+        a[:, :, hi] ^= a[:, :, hi ^ bit]
+    # component b.S has the XOR of the coordinate ANFs picked by b
+    masks = ((_X[:, None] >> np.arange(8)[None, :]) & 1).astype(np.uint8)  # (256, 8)
+    comp = (np.matmul(masks[None, :, :], a) & 1)[:, 1:, :]
+    deg = np.where(comp == 1, POPCOUNT[None, None, :], 0).max(axis=2)
+    return deg.min(axis=1)
+
+def player_metrics(P):
+    """P-layer metrics per key (dict of (K,) arrays); outbit i = inbit P[i]."""
+    P = np.asarray(P, dtype=np.int64).reshape(-1, 128)
+    k = len(P)
+    dst = np.arange(128)
+    src_byte, dst_byte = P // 8, dst[None, :] // 8
+    # M[k, s, d]: some bit of byte s lands in byte d
+    M = np.zeros((k, 16, 16), dtype=np.int64)
+    M[np.repeat(np.arange(k), 128), src_byte.ravel(), np.tile(dst_byte[0], k)] = 1
+    # an S-box mixes its whole byte, so byte reach grows by M each round
+    reach = np.broadcast_to(np.eye(16, dtype=np.int64), (k, 16, 16))
+    rounds = np.full(k, emo_spn.R + 1)
+    for r in range(1, emo_spn.R + 1):
+        reach = np.minimum(reach @ M, 1)
+        full = reach.all(axis=(1, 2)) & (rounds > emo_spn.R)
+        rounds[full] = r
+        if (rounds <= emo_spn.R).all():
+            break
+    return {
+        "player_fixed_bits": (P == dst[None, :]).sum(axis=1),
+        "same_byte_bits": (src_byte == dst_byte).sum(axis=1),
+        "spread_min": M.sum(axis=2).min(axis=1),
+        "diffusion_rounds": rounds,
+    }
+
+def analyze(keys):
+    """Metrics of each key as a dict of (K,) arrays."""
+    S, P = instances(keys)
+    d = ddt(S)
+    w = np.abs(walsh(S)[:, 1:, :])
+    out = {
+        "differential_uniformity": d[:, 1:, :].max(axis=(1, 2)),
+        "nonlinearity": 128 - w.max(axis=(1, 2)) // 2,
+        "linearity": w.max(axis=(1, 2)) // 2,
+        "algebraic_degree": algebraic_degree(S),
+        "fixed_points": (S == _X[None, :]).sum(axis=1),
+    }
+    out.update(player_metrics(P))
+    return out
+
+def problems(metrics, limits=None):
+    """For each key, the list of metrics outside `limits` (default WEAK_LIMITS)."""
+    limits = WEAK_LIMITS if limits is None else limits
+    n = len(next(iter(metrics.values())))
+    out = [[] for _ in range(n)]
+    for name, (kind, bound) in limits.items():
+        values = metrics[name]
+        bad = values > bound if kind == "max" else values < bound
+        for i in np.flatnonzero(bad):
+            out[i].append(f"{name}={int(values[i])} ({kind} {bound})")
+    return out
+
+def key_problems(master_key, limits=None):
+    """Why this key's S-box / P-layer is weak; an empty list if it is not."""
+    return problems(analyze([master_key]), limits)[0]
+
+def screen_batch(seed, start, n, limits=None):
+    """(metrics as lists, [(key index, problems)]) of keys start..start+n-1."""
+    metrics = analyze([key_for(seed, i) for i in range(start, start + n)])
+    weak = [(start + i, p) for i, p in enumerate(problems(metrics, limits)) if p]
+    return {name: v.tolist() for name, v in metrics.items()}, weak
+
+def distribution(values):
+    v = np.asarray(values)
+    counts = np.bincount(v - v.min())
+    return {
+        "min": int(v.min()), "max": int(v.max()), "mean": float(v.mean()),
+        "p01": float(np.percentile(v, 1)), "p99": float(np.percentile(v, 99)),
+        "histogram": {str(int(v.min()) + i): int(c) for i, c in enumerate(counts) if c},
+    }
+
+def run_screen(keys=1000, workers=1, batch=DEFAULT_BATCH, seed=0, limits=None, progress=None):
+    """
+    Analyze `keys` derived keys; returns {"params", "distribution": per
+    metric, "weak": count, "weak_keys": [{"key_index", "key_id", "problems"}]}.
+    """
+    workers = emo_spn.resolve_workers(workers)
+    tasks = [(seed, a, min(batch, keys - a), limits) for a in range(0, keys, batch)]
+    columns, weak = {}, []
+    done = 0
+    t0 = time.perf_counter()
+
+    def collect(result, n):
+        nonlocal done
+        metrics, bad = result
+        for name, values in metrics.items():
+            columns.setdefault(name, []).extend(values)
+        weak.extend(bad)
+        done += n
+        if progress:
+            progress(done, keys)
+
+    if workers == 1:
+        for task in tasks:
+            collect(screen_batch(*task), task[2])
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = {pool.submit(screen_batch, *task): task[2] for task in tasks}
+            for f in as_completed(futures):
+                collect(f.result(), futures[f])
+    elapsed = time.perf_counter() - t0
+    weak.sort()
+    return {
+        "params": {"keys": keys, "workers": workers, "batch": batch, "seed": seed,
+                   "limits": limits or WEAK_LIMITS, "seconds": elapsed,
+                   "keys_per_s": keys / elapsed if elapsed else None},
+        "distribution": {name: distribution(v) for name, v in columns.items()},
+        "weak": len(weak),
+        "weak_keys": [{"key_index": i, "key_id": key_for(seed, i)[:4].hex(), "problems": p}
+                      for i, p in weak],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(prog="emo_quality",
+                                     description="S-box / P-layer quality screening for EMO-SPN keys")
+    parser.add_argument("--keys", type=int, default=1000, help="keys to analyze (default: %(default)s)")
+    parser.add_argument("--workers", "-j", type=int, default=0, help="processes (0 = one per core)")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH,
+                        help="keys per task (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the keys (default: %(default)s)")
+    parser.add_argument("--out", default="quality.json", help="JSON report (default: %(default)s)")
+    args = parser.parse_args()
+
+    def progress(done, total):
+        print(f"\r{done}/{total} keys", end="", file=sys.stderr, flush=True)
+
+    result = run_screen(args.keys, args.workers, args.batch, args.seed, progress=progress)
+    print(file=sys.stderr)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=1)
+    for name, d in result["distribution"].items():
+        print(f"{name:24s} min {d['min']:4d}  mean {d['mean']:7.2f}  max {d['max']:4d}")
+    print(f"Weak keys: {result['weak']} of {args.keys} "
+          f"({result['params']['keys_per_s']:.0f} keys/s)")
+    print("Report at:", args.out)
+
+if __name__ == "__main__":
+    main()
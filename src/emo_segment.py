@@ -0,0 +1,356 @@
+# EMO-SPN segmented container
+# The plaintext is cut into fixed-size segments, each encrypted and MACed
+# on its own, so a byte range can be read by decrypting only the segments
+# it touches and segments can be processed on several cores.
+#
+#   HEADER   MAGIC(4) || VERSION=2(1) || MODE(1) || FLAGS(2) || SEGMENT_SIZE(4) || FILE_ID(16)
+#   SEGMENT  IV(16) || C || TAG(32)          one per segment, in order
+#   INDEX    TAG_0 || TAG_1 || ...           the segment tags again
+#   TRAILER  COUNT(8) || LENGTH(8) || "EMOF"(4) || FOOTER_TAG(32)
+#
+# TAG_i = HMAC(HEADER || i || IV || C) binds a segment to its position and
+# to this file; FOOTER_TAG = HMAC(HEADER || INDEX || TRAILER) fixes the
+# number of segments and the plaintext length, so dropping, reordering or
+# splicing segments is detected. Every segment has SEGMENT_SIZE plaintext
+# bytes but the last; CBC segments are padded, CTR segments are not.
+import os, struct
+from collections import deque
+import emo_spn
+import emo_instrument as instrument
+
+SEGMENT_SIZE = 1 << 20  # plaintext bytes per segment
+SEGMENT_MODE = "ctr"
+_HEADER = struct.Struct(">4sBBHI16s")
+_TRAILER = struct.Struct(">QQ4s")
+TRAILER_MAGIC = b"EMOF"
+TAG_SIZE = 32
+
+def is_segmented(data):
+    """True if data starts with a segmented-container header."""
+    return (len(data) >= 5 and data[:4] == emo_spn.HEADER_MAGIC
+            and data[4] == emo_spn.SEGMENTED_VERSION)
+
+def parse_header(data):
+    """(mode, segment_size) of a segmented header; ValueError if invalid."""
+    if len(data) < _HEADER.size or not is_segmented(data):
+        raise ValueError("Not a segmented EMO-SPN file")
+    _, _, mode, _, segment_size, _ = _HEADER.unpack(data[:_HEADER.size])
+    if mode not in emo_spn.MODES.values() or not segment_size or segment_size % emo_spn.BLOCK_SIZE:
+        raise ValueError("Invalid segmented header")
+    return mode, segment_size
+
+def _body_size(mode, n):
+    if mode == emo_spn.MODE_CBC:
+        return n - n % emo_spn.BLOCK_SIZE + emo_spn.BLOCK_SIZE
+    return n
+
+def record_size(mode, n):
+    """Bytes of a segment record holding n plaintext bytes."""
+    return 16 + _body_size(mode, n) + TAG_SIZE
+
+def container_size(length, segment_size, mode=emo_spn.MODE_CTR):
+    """Total size of the container of a `length`-byte plaintext."""
+    count = -(-length // segment_size)
+    size = _HEADER.size + count * TAG_SIZE + _TRAILER.size + TAG_SIZE
+    if count:
+        size += (count - 1) * record_size(mode, segment_size)
+        size += record_size(mode, length - (count - 1) * segment_size)
+    return size
+
+def _segment_tag(cipher, header, index, iv, body):
+    mac = cipher.hmac_init()
+    mac.update(header)
+    mac.update(struct.pack(">Q", index))
+    mac.update(iv)
+    mac.update(body)
+    return cipher.hmac_final(mac)
+
+def seal_segment(master_key, header, index, plaintext, engine=emo_spn.DEFAULT_ENGINE):
+    """Record IV || C || TAG of segment `index`."""
+    cipher = emo_spn.get_cipher(master_key)
+    mode, _ = parse_header(header)
+    iv = os.urandom(16)
+    if mode == emo_spn.MODE_CTR:
+        body = emo_spn.ctr_xor(cipher, iv, plaintext, 0, 1, engine)
+    else:
+        body = cipher.cbc_encrypt(emo_spn.pkcs7_pad(plaintext), iv, engine)
+    return iv + body + _segment_tag(cipher, header, index, iv, body)
+
+def check_segment(master_key, header, index, record, expected_tag):
+    """Raise ValueError unless the record carries the expected, valid tag."""
+    cipher = emo_spn.get_cipher(master_key)
+    iv, body, tag = record[:16], record[16:-TAG_SIZE], record[-TAG_SIZE:]
+    if tag != expected_tag or _segment_tag(cipher, header, index, iv, body) != tag:
+        raise ValueError(f"MAC verification failed (segment {index})")
+
+def open_segment(master_key, header, index, record, expected_tag, engine=emo_spn.DEFAULT_ENGINE):
+    """Plaintext of a segment record; ValueError if its tag does not match."""
+    cipher = emo_spn.get_cipher(master_key)
+    mode, _ = parse_header(header)
+    check_segment(master_key, header, index, record, expected_tag)
+    iv, body = record[:16], record[16:-TAG_SIZE]
+    if mode == emo_spn.MODE_CTR:
+        return emo_spn.ctr_xor(cipher, iv, body, 0, 1, engine)
+    if not body or len(body) % emo_spn.BLOCK_SIZE:
+        raise ValueError("Invalid padding length")
+    return emo_spn.pkcs7_unpad(cipher.cbc_decrypt(body, iv, engine))
+
+def _ordered(fn, jobs, workers):
+    # fn(*job) for every job, results in job order; with workers > 1 at most
+    # 2 * workers jobs are queued on the shared pool at once
+    workers = emo_spn.resolve_workers(workers)
+    if workers == 1:
+        for job in jobs:
+            yield fn(*job)
+        return
+    pool = emo_spn.process_pool(workers)
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.submit(fn, *job))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def encrypt_stream(fin, fout, master_key, segment_size=SEGMENT_SIZE, mode=SEGMENT_MODE,
+                   engine=emo_spn.DEFAULT_ENGINE, workers=1):
+    """
+    Encrypt everything read from fin into a segmented container written
+    sequentially to fout (pipes are fine), `segment_size` plaintext bytes
+    per segment (a multiple of 16), segments sealed on `workers`
+    processes. Memory stays bounded to a few segments per worker plus the
+    32-byte tag of each segment. Returns the plaintext length.
+    """
+    if mode not in emo_spn.MODES:
+        raise ValueError(f"Unknown mode: {mode}")
+    if segment_size <= 0 or segment_size % emo_spn.BLOCK_SIZE or segment_size >= 1 << 32:
+        raise ValueError("Segment size must be a positive multiple of 16 below 4 GiB")
+    cipher = emo_spn.get_cipher(master_key)
+    header = _HEADER.pack(emo_spn.HEADER_MAGIC, emo_spn.SEGMENTED_VERSION, emo_spn.MODES[mode], 0,
+                          segment_size, os.urandom(16))
+    key = cipher.master_key
+    tags = []
+    length = 0
+
+    def jobs():
+        nonlocal length
+        index = 0
+        while True:
+            with instrument.phase("read"):
+                chunk = emo_spn._read_full(fin, segment_size)
+            if not chunk:
+                return
+            length += len(chunk)
+            yield key, header, index, chunk, engine
+            index += 1
+
+    fout.write(header)
+    with instrument.phase("segments"):
+        for record in _ordered(seal_segment, jobs(), workers):
+            tags.append(record[-TAG_SIZE:])
+            fout.write(record)
+    trailer = _TRAILER.pack(len(tags), length, TRAILER_MAGIC)
+    index = b"".join(tags)
+    fout.write(index + trailer + _footer_tag(cipher, header, index, trailer))
+    if instrument.enabled:
+        instrument.count("segments", len(tags))
+        instrument.count("bytes_in", length)
+        instrument.count("bytes_out", container_size(length, segment_size, emo_spn.MODES[mode]))
+    return length
+
+def encrypt_file(infile, outfile, master_key, segment_size=SEGMENT_SIZE, mode=SEGMENT_MODE,
+                 engine=emo_spn.DEFAULT_ENGINE, workers=1):
+    """encrypt_stream from infile to outfile; the output is removed on failure."""
+    emo_spn.abort_if_not_in_sandbox(outfile)
+    try:
+        with open(infile, "rb") as fin, open(outfile, "wb") as fout:
+            encrypt_stream(fin, fout, master_key, segment_size, mode, engine, workers)
+    except BaseException:
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        raise
+
+def decrypt_stream(fin, fout, master_key, engine=emo_spn.DEFAULT_ENGINE, workers=1,
+                   read_size=emo_spn.STREAM_CHUNK_SIZE):
+    """
+    Decrypt a container read sequentially from fin (a pipe is fine) into
+    fout. Each segment's tag is checked before its plaintext is written;
+    the footer (segment count, length, tag index) is only reached at the
+    end, so a truncated or spliced stream raises ValueError after the
+    segments before the damage were written. Callers that must not see
+    unauthenticated output should use decrypt_file on a seekable file.
+    Returns the plaintext length.
+    """
+    cipher = emo_spn.get_cipher(master_key)
+    header = emo_spn._read_full(fin, _HEADER.size)
+    mode, segment_size = parse_header(header)
+    full = record_size(mode, segment_size)
+    tail = _TRAILER.size + TAG_SIZE
+    key = cipher.master_key
+    buf = bytearray()
+    tags = []
+    footer = []
+
+    def fill(n):
+        while len(buf) < n:
+            chunk = fin.read(max(n - len(buf), read_size))
+            if not chunk:
+                return False
+            buf.extend(chunk)
+        return True
+
+    def jobs():
+        # record i is a full segment, and not the last one, as soon as
+        # there is room behind it for at least one more (non-empty) record
+        # and the index of i + 2 tags; otherwise the rest of the stream is
+        # the last record, the index and the trailer
+        i = 0
+        while fill(full + record_size(mode, 1) + (i + 2) * TAG_SIZE + tail):
+            record = bytes(buf[:full])
+            del buf[:full]
+            tags.append(record[-TAG_SIZE:])
+            yield key, header, i, record, record[-TAG_SIZE:], engine
+            i += 1
+        if len(buf) < tail:
+            raise ValueError("Ciphertext truncated")
+        trailer, tag = bytes(buf[-tail:-TAG_SIZE]), bytes(buf[-TAG_SIZE:])
+        count, length, magic = _TRAILER.unpack(trailer)
+        if (magic != TRAILER_MAGIC or count not in (i, i + 1) or count != -(-length // segment_size)
+                or container_size(length, segment_size, mode)
+                != _HEADER.size + i * full + len(buf)):
+            raise ValueError("Ciphertext truncated or corrupted footer")
+        if count == i + 1:
+            last = record_size(mode, length - i * segment_size)
+            record = bytes(buf[:last])
+            del buf[:last]
+            tags.append(record[-TAG_SIZE:])
+            yield key, header, i, record, record[-TAG_SIZE:], engine
+        footer.extend((bytes(buf[:-tail]), trailer, tag, length))
+
+    written = 0
+    with instrument.phase("segments"):
+        for p in _ordered(open_segment, jobs(), workers):
+            fout.write(p)
+            written += len(p)
+    index, trailer, tag, length = footer
+    if (index != b"".join(tags) or written != length
+            or _footer_tag(cipher, header, index, trailer) != tag):
+        raise ValueError("MAC verification failed (footer)")
+    if instrument.enabled:
+        instrument.count("segments", len(tags))
+        instrument.count("bytes_out", written)
+    return written
+
+class SegmentedFile:
+    """
+    Random access to a segmented container. Opening checks the header,
+    the total size and the footer tag (so a truncated or reordered file is
+    rejected up front); each segment's own tag is checked when it is read.
+    """
+
+    def __init__(self, path, master_key, engine=emo_spn.DEFAULT_ENGINE, workers=1):
+        self.engine = engine
+        self.workers = workers
+        self.cipher = emo_spn.get_cipher(master_key)
+        self._f = open(path, "rb")
+        try:
+            self._load_footer(os.fstat(self._f.fileno()).st_size)
+        except BaseException:
+            self._f.close()
+            raise
+
+    def _load_footer(self, size):
+        self.header = self._f.read(_HEADER.size)
+        self.mode, self.segment_size = parse_header(self.header)
+        tail = _TRAILER.size + TAG_SIZE
+        if size < _HEADER.size + tail:
+            raise ValueError("Ciphertext truncated")
+        self._f.seek(size - tail)
+        trailer = self._f.read(_TRAILER.size)
+        tag = self._f.read(TAG_SIZE)
+        self.count, self.length, magic = _TRAILER.unpack(trailer)
+        if (magic != TRAILER_MAGIC or self.count != -(-self.length // self.segment_size)
+                or container_size(self.length, self.segment_size, self.mode) != size):
+            raise ValueError("Ciphertext truncated or corrupted footer")
+        self._f.seek(size - tail - self.count * TAG_SIZE)
+        index = self._f.read(self.count * TAG_SIZE)
+        if _footer_tag(self.cipher, self.header, index, trailer) != tag:
+            raise ValueError("MAC verification failed (footer)")
+        self.tags = [index[i:i+TAG_SIZE] for i in range(0, len(index), TAG_SIZE)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self._f.close()
+
+    def _record(self, i):
+        n = min(self.segment_size, self.length - i * self.segment_size)
+        self._f.seek(_HEADER.size + i * record_size(self.mode, self.segment_size))
+        return emo_spn._read_full(self._f, record_size(self.mode, n))
+
+    def segments(self, first=0, last=None):
+        """Plaintexts of segments first..last (inclusive), in order."""
+        last = self.count - 1 if last is None else last
+        key = self.cipher.master_key
+        jobs = ((key, self.header, i, self._record(i), self.tags[i], self.engine)
+                for i in range(first, last + 1))
+        return _ordered(open_segment, jobs, self.workers)
+
+    def verify(self):
+        """Check every segment tag without decrypting; ValueError on the first bad one."""
+        key = self.cipher.master_key
+        jobs = ((key, self.header, i, self._record(i), self.tags[i]) for i in range(self.count))
+        with instrument.phase("verify"):
+            for _ in _ordered(check_segment, jobs, self.workers):
+                pass
+
+    def read_range(self, offset, length):
+        """Plaintext bytes [offset, offset + length), clipped to the file."""
+        if offset < 0 or length < 0:
+            raise ValueError("Offset and length must be non-negative")
+        end = min(offset + length, self.length)
+        if offset >= end:
+            return b""
+        first, last = offset // self.segment_size, (end - 1) // self.segment_size
+        with instrument.phase("segments"):
+            data = b"".join(self.segments(first, last))
+        instrument.count("segments", last - first + 1)
+        start = offset - first * self.segment_size
+        return data[start:start + end - offset]
+
+def _footer_tag(cipher, header, index, trailer):
+    mac = cipher.hmac_init()
+    for part in (header, index, trailer):
+        mac.update(part)
+    return cipher.hmac_final(mac)
+
+def decrypt_file(infile, outfile, master_key, engine=emo_spn.DEFAULT_ENGINE, workers=1):
+    """
+    Decrypt a whole segmented container. The footer is checked first and
+    every segment before its plaintext is written; on any failure the
+    output is removed.
+    """
+    emo_spn.abort_if_not_in_sandbox(outfile)
+    with SegmentedFile(infile, master_key, engine, workers) as sf:
+        try:
+            with open(outfile, "wb") as fout:
+                with instrument.phase("segments"):
+                    for p in sf.segments():
+                        fout.write(p)
+            if instrument.enabled:
+                instrument.count("segments", sf.count)
+                instrument.count("bytes_out", sf.length)
+        except BaseException:
+            os.remove(outfile)
+            raise
+
+def read_range(path, offset, length, master_key, engine=emo_spn.DEFAULT_ENGINE, workers=1):
+    """Decrypt plaintext bytes [offset, offset + length) of a segmented file."""
+    with instrument.operation("read_range"):
+        with SegmentedFile(path, master_key, engine, workers) as sf:
+            return sf.read_range(offset, length)
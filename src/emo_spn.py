@@ -1,12 +1,34 @@
 
 # EMO-SPN
-import os, sys, argparse, hashlib, struct, time
+import os, sys, argparse, hashlib, struct, time, threading, atexit, mmap
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import emo_instrument as instrument
 
 SANDBOX_DIR = os.path.abspath("sandbox")
 ESCROW_DIR = os.path.abspath("escrow")
 R = 32  # rounds
 BLOCK_SIZE = 16  # bytes (128 bits)
 MASTER_KEY_SIZE = 32  # bytes (256 bits)
+DEFAULT_ENGINE = "table"  # see ENGINES
+STREAM_CHUNK_SIZE = 1 << 20  # file I/O buffer, bytes
+METRICS_ENV = "EMO_METRICS"  # CLI instrumentation sinks, see emo_instrument.configure
+
+# Optional header in front of IV/nonce: MAGIC(4) || VERSION(1) || MODE(1) || FLAGS(2).
+# Files without it are the original CBC format IV || C || TAG.
+HEADER_MAGIC = b"EMOS"
+HEADER_VERSION = 1
+HEADER_SIZE = 8
+MODE_CBC = 0
+MODE_CTR = 1
+MODES = {"cbc": MODE_CBC, "ctr": MODE_CTR}
+FLAG_TREE_MAC = 0x0001  # TAG is a tree of leaf HMACs (see TreeMac), not one HMAC
+TREE_LEAF_SIZE = 1 << 20
+# Segmented containers (emo_segment) start with the same magic and
+# version 2, append logs (emo_append) with version 3; parse_header does
+# not accept them.
+SEGMENTED_VERSION = 2
+APPEND_VERSION = 3
 
 def ensure_dirs():
     os.makedirs(SANDBOX_DIR, exist_ok=True)
@@ -31,19 +53,32 @@ class XORShift64:
         x ^= (x << 17) & ((1<<64)-1)
         self.state = x & ((1<<64)-1)
         return self.state
+    def words(self, n):
+        # the next n outputs of next64, generated in one tight loop
+        mask = (1<<64)-1
+        x = self.state & mask
+        out = [0]*n
+        for i in range(n):
+            x ^= (x << 13) & mask
+            x ^= x >> 7
+            x ^= (x << 17) & mask
+            out[i] = x
+        self.state = x
+        return out
     def randbytes(self, n):
-        out = bytearray()
-        while len(out) < n:
-            v = self.next64()
-            out += v.to_bytes(8, 'big')
-        return bytes(out[:n])
+        k = -(-n // 8)
+        return struct.pack(f">{k}Q", *self.words(k))[:n]
 
-def sbox_gen(master_key):
-    prng = XORShift64(master_key + b"SBOX")
-    arr = list(range(256))
-    for i in range(255, 0, -1):
-        r = int.from_bytes(prng.next64().to_bytes(8,'big')[:8], 'big') % (i+1)
+def _shuffle(n, words):
+    # Fisher-Yates over range(n), one PRNG word per swap
+    arr = list(range(n))
+    for i, w in zip(range(n-1, 0, -1), words):
+        r = w % (i+1)
         arr[i], arr[r] = arr[r], arr[i]
+    return arr
+
+def sbox_gen(master_key):
+    arr = _shuffle(256, XORShift64(master_key + b"SBOX").words(255))
     sbox = bytes(arr)
     inv = [0]*256
     for i,v in enumerate(sbox):
@@ -51,11 +86,7 @@ def sbox_gen(master_key):
     return sbox, bytes(inv)
 
 def player_gen(master_key):
-    prng = XORShift64(master_key + b"PLAYER")
-    arr = list(range(128))
-    for i in range(127, 0, -1):
-        r = int.from_bytes(prng.next64().to_bytes(8,'big')[:8], 'big') % (i+1)
-        arr[i], arr[r] = arr[r], arr[i]
+    arr = _shuffle(128, XORShift64(master_key + b"PLAYER").words(127))
     inv = [0]*128
     for i,v in enumerate(arr):
         inv[v] = i
@@ -78,11 +109,14 @@ def apply_player(block_bytes, perm):
     return bytes(out)
 
 def key_schedule(master_key):
-    prng = XORShift64(master_key + b"KS")
-    keys = []
-    for _ in range(R+1):
-        keys.append(prng.randbytes(16))
-    return keys
+    stream = XORShift64(master_key + b"KS").randbytes(16 * (R+1))
+    return [stream[i:i+16] for i in range(0, len(stream), 16)]
+
+def expand_key(master_key):
+    """(sbox, inv_sbox, player, inv_player, subkeys) for a master key."""
+    sbox, inv_sbox = sbox_gen(master_key)
+    player, inv_player = player_gen(master_key)
+    return sbox, inv_sbox, player, inv_player, key_schedule(master_key)
 
 def sub_bytes(block_bytes, sbox):
     return bytes(sbox[b] for b in block_bytes)
@@ -124,6 +158,138 @@ def decrypt_block(block, keys, inv_sbox, inv_player):
     x = xor_bytes(x, keys[0])
     return x
 
+# ------------------------------------------------------------
+# Table-driven engine: SubBytes + P-layer folded into 128-bit masks.
+# The state is kept as a single int (bit 127 = MSB of byte 0) and a
+# round is 16 table lookups OR-ed together instead of a bit list.
+# ------------------------------------------------------------
+def _bit_masks(perm):
+    # masks[j]: where input bit j lands after apply_player(x, perm)
+    inv = [0]*128
+    for i, v in enumerate(perm):
+        inv[v] = i
+    return [1 << (127 - inv[j]) for j in range(128)]
+
+def _byte_tables(values, masks):
+    # tables[pos][b]: mask of values[b] placed at byte pos, then permuted
+    tables = []
+    for pos in range(BLOCK_SIZE):
+        # base[v] for v < 2**k is the OR of the masks of the k low bits of v
+        base = [0]
+        for j in range(pos*8 + 7, pos*8 - 1, -1):
+            m = masks[j]
+            base += [b | m for b in base]
+        tables.append([base[v] for v in values])
+    return tables
+
+def _apply_tables(x, tables):
+    y = 0
+    for t, b in zip(tables, x.to_bytes(BLOCK_SIZE, 'big')):
+        y |= t[b]
+    return y
+
+def build_tables(sbox, inv_sbox, player, inv_player, keys):
+    """
+    Precompute the round tables for a key.
+    Encryption: x = T(x) ^ k[r], with T = P-layer(SubBytes(x)).
+    Decryption uses Pinv(Sinv(y) ^ k) = TI(y) ^ Pinv(k), so the inverse
+    round is also one lookup pass; only the first Pinv and last Sinv
+    are done on their own.
+    """
+    identity = [1 << (127 - j) for j in range(128)]
+    enc = _byte_tables(sbox, _bit_masks(player))
+    dec = _byte_tables(inv_sbox, _bit_masks(inv_player))
+    perm_inv = _byte_tables(range(256), _bit_masks(inv_player))
+    sub_inv = _byte_tables(inv_sbox, identity)
+    ks = [int.from_bytes(k, 'big') for k in keys]
+    ks_perm = [_apply_tables(k, perm_inv) for k in ks]
+    return enc, ks, dec, perm_inv, sub_inv, ks_perm
+
+def encrypt_int(x, tables):
+    enc, ks = tables[0], tables[1]
+    x ^= ks[0]
+    for r in range(1, R+1):
+        y = 0
+        for t, b in zip(enc, x.to_bytes(BLOCK_SIZE, 'big')):
+            y |= t[b]
+        x = y ^ ks[r]
+    return x
+
+def decrypt_int(x, tables):
+    _, ks, dec, perm_inv, sub_inv, ks_perm = tables
+    x = _apply_tables(x, perm_inv) ^ ks_perm[R]
+    for r in range(R-1, 0, -1):
+        y = 0
+        for t, b in zip(dec, x.to_bytes(BLOCK_SIZE, 'big')):
+            y |= t[b]
+        x = y ^ ks_perm[r]
+    return _apply_tables(x, sub_inv) ^ ks[0]
+
+def encrypt_block_fast(block, tables):
+    x = encrypt_int(int.from_bytes(block, 'big'), tables)
+    return x.to_bytes(BLOCK_SIZE, 'big')
+
+def decrypt_block_fast(block, tables):
+    x = decrypt_int(int.from_bytes(block, 'big'), tables)
+    return x.to_bytes(BLOCK_SIZE, 'big')
+
+def cbc_encrypt(padded, iv, tables):
+    out = bytearray(len(padded))
+    prev = int.from_bytes(iv, 'big')
+    for i in range(0, len(padded), BLOCK_SIZE):
+        prev = encrypt_int(int.from_bytes(padded[i:i+BLOCK_SIZE], 'big') ^ prev, tables)
+        out[i:i+BLOCK_SIZE] = prev.to_bytes(BLOCK_SIZE, 'big')
+    return bytes(out)
+
+def cbc_decrypt(ciphertext, iv, tables):
+    out = bytearray(len(ciphertext))
+    prev = int.from_bytes(iv, 'big')
+    for i in range(0, len(ciphertext), BLOCK_SIZE):
+        c = int.from_bytes(ciphertext[i:i+BLOCK_SIZE], 'big')
+        out[i:i+BLOCK_SIZE] = (decrypt_int(c, tables) ^ prev).to_bytes(BLOCK_SIZE, 'big')
+        prev = c
+    return bytes(out)
+
+# In-place kernels for the table engine: read and write caller buffers
+# (anything with the buffer protocol) without building bytes per block.
+_HALVES = struct.Struct(">QQ")
+_MASK64 = (1 << 64) - 1
+
+def cbc_encrypt_into(src, dst, iv, tables):
+    """CBC over len(src) bytes (multiple of 16) into dst; returns the last block as int."""
+    unpack, pack = _HALVES.unpack_from, _HALVES.pack_into
+    prev = int.from_bytes(iv, 'big')
+    for i in range(0, len(src), BLOCK_SIZE):
+        hi, lo = unpack(src, i)
+        prev = encrypt_int(((hi << 64) | lo) ^ prev, tables)
+        pack(dst, i, prev >> 64, prev & _MASK64)
+    return prev
+
+def cbc_decrypt_into(src, dst, iv, tables):
+    unpack, pack = _HALVES.unpack_from, _HALVES.pack_into
+    prev = int.from_bytes(iv, 'big')
+    for i in range(0, len(src), BLOCK_SIZE):
+        hi, lo = unpack(src, i)
+        c = (hi << 64) | lo
+        p = decrypt_int(c, tables) ^ prev
+        pack(dst, i, p >> 64, p & _MASK64)
+        prev = c
+
+def ctr_xor_into(src, dst, nonce, start, tables):
+    # full blocks in place, a trailing partial block through a 16-byte buffer
+    unpack, pack = _HALVES.unpack_from, _HALVES.pack_into
+    n = int.from_bytes(nonce, 'big') + start
+    mask = (1 << 128) - 1
+    full = len(src) - len(src) % BLOCK_SIZE
+    for i in range(0, full, BLOCK_SIZE):
+        hi, lo = unpack(src, i)
+        x = encrypt_int(n & mask, tables) ^ ((hi << 64) | lo)
+        pack(dst, i, x >> 64, x & _MASK64)
+        n += 1
+    if full < len(src):
+        ks = encrypt_int(n & mask, tables).to_bytes(BLOCK_SIZE, 'big')
+        dst[full:len(src)] = bytes(a ^ b for a, b in zip(src[full:], ks))
+
 def hmac_sha256(key, data):
     block_size = 64
     if len(key) > block_size:
@@ -133,72 +299,1630 @@ def hmac_sha256(key, data):
     i_key = bytes((b ^ 0x36) for b in key)
     return hashlib.sha256(o_key + hashlib.sha256(i_key + data).digest()).digest()
 
-def create_escrow(master_key, passphrase, outpath):
+# ------------------------------------------------------------
+# Cipher context: everything derived from a master key, built once
+# ------------------------------------------------------------
+class EmoCipher:
+    """
+    Expanded key context: S-box, P-layer, subkeys, round tables and the
+    HMAC ipad/opad states for one master key. Reuse it (or get_cipher)
+    instead of redoing the key setup on every call.
+    """
+    __slots__ = ("master_key", "sbox", "inv_sbox", "player", "inv_player",
+                 "keys", "tables", "size", "_hmac_inner", "_hmac_outer", "_np", "_bs")
+
+    def __init__(self, master_key, schedule=None):
+        # schedule: (sbox, inv_sbox, player, inv_player, keys) when already
+        # known, e.g. from an expanded-key file
+        self.master_key = bytes(master_key)
+        if schedule is None:
+            with instrument.phase("expand_key"):
+                schedule = expand_key(self.master_key)
+        self.sbox, self.inv_sbox, self.player, self.inv_player, self.keys = schedule
+        with instrument.phase("tables"):
+            self.tables = build_tables(self.sbox, self.inv_sbox, self.player,
+                                       self.inv_player, self.keys)
+        key = self.master_key
+        if len(key) > 64:
+            key = hashlib.sha256(key).digest()
+        key = key.ljust(64, b'\x00')
+        self._hmac_inner = hashlib.sha256(bytes((b ^ 0x36) for b in key))
+        self._hmac_outer = hashlib.sha256(bytes((b ^ 0x5c) for b in key))
+        self.size = _tables_size(self.tables)
+        self._np = None
+        self._bs = None
+
+    def encrypt_block(self, block):
+        return encrypt_block_fast(block, self.tables)
+
+    def decrypt_block(self, block):
+        return decrypt_block_fast(block, self.tables)
+
+    def encrypt_blocks(self, data, engine=DEFAULT_ENGINE):
+        # independent blocks (ECB-style), len(data) multiple of BLOCK_SIZE
+        return _engine(engine)[0](self, data)
+
+    def decrypt_blocks(self, data, engine=DEFAULT_ENGINE):
+        return _engine(engine)[1](self, data)
+
+    def cbc_encrypt(self, padded, iv, engine=DEFAULT_ENGINE):
+        # CBC encryption is serial: a batch engine would only ever see one
+        # block, so everything but the bit-list reference uses the tables
+        if engine != "reference":
+            _engine(engine)
+            return cbc_encrypt(padded, iv, self.tables)
+        enc = _engine(engine)[0]
+        out = bytearray(len(padded))
+        prev = iv
+        for i in range(0, len(padded), BLOCK_SIZE):
+            prev = enc(self, xor_bytes(padded[i:i+BLOCK_SIZE], prev))
+            out[i:i+BLOCK_SIZE] = prev
+        return bytes(out)
+
+    def cbc_decrypt(self, ciphertext, iv, engine=DEFAULT_ENGINE):
+        if engine == "table":
+            return cbc_decrypt(ciphertext, iv, self.tables)
+        # every block decrypts independently, then XOR with IV || C[:-1]
+        blocks = _engine(engine)[1](self, ciphertext)
+        return xor_long(blocks, iv + ciphertext[:len(ciphertext)-BLOCK_SIZE])
+
+    def numpy_tables(self):
+        # round tables split into high/low uint64 halves, built on first use
+        if self._np is None:
+            enc, ks, dec, perm_inv, sub_inv, ks_perm = self.tables
+            (ks_hi,), (ks_lo,) = _np_split([ks])
+            (kp_hi,), (kp_lo,) = _np_split([ks_perm])
+            self._np = (_np_split(enc), ks_hi, ks_lo, _np_split(dec),
+                        _np_split(perm_inv), _np_split(sub_inv), kp_hi, kp_lo)
+        return self._np
+
+    def bitslice_circuits(self):
+        # S-box circuits and per-round key plane lists, built on first use
+        if self._bs is None:
+            keybits = [[b for b in range(128) if k[b // 8] & (0x80 >> (b % 8))] for k in self.keys]
+            self._bs = (sbox_circuit(self.sbox), sbox_circuit(self.inv_sbox), keybits)
+        return self._bs
+
+    def hmac(self, data):
+        # same result as hmac_sha256(master_key, data)
+        inner = self.hmac_init()
+        inner.update(data)
+        return self.hmac_final(inner)
+
+    def hmac_init(self):
+        # incremental HMAC: update() the returned object, then hmac_final()
+        return self._hmac_inner.copy()
+
+    def hmac_final(self, inner):
+        outer = self._hmac_outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+def xor_long(a, b):
+    # XOR of two equal-length byte strings in one big-int operation
+    n = len(a)
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(n, 'big')
+
+# ------------------------------------------------------------
+# Block engines. Each one maps (cipher, data) -> bytes for data made of
+# independent 16-byte blocks; all of them give identical results.
+# ------------------------------------------------------------
+def _numpy():
+    # numpy is only needed by the batched engine, import it lazily
+    import numpy
+    return numpy
+
+def _np_split(tables):
+    # lists of 128-bit ints -> (high, low) uint64 arrays of the same shape,
+    # through their 16-byte big-endian encoding
+    np = _numpy()
+    raw = b"".join(v.to_bytes(BLOCK_SIZE, 'big') for t in tables for v in t)
+    halves = np.frombuffer(raw, dtype='>u8').reshape(len(tables), -1, 2).astype(np.uint64)
+    return np.ascontiguousarray(halves[:, :, 0]), np.ascontiguousarray(halves[:, :, 1])
+
+def _np_lookup(st, tables, out):
+    # one pass of the 16 byte-position tables over a (2, N) uint64 state
+    np = _numpy()
+    hi, lo = tables
+    n = st.shape[1]
+    tmp = np.empty(n, dtype=np.uint64)
+    view = st.view(np.uint8).reshape(2, n, 8)
+    little = sys.byteorder == "little"
+    for pos in range(BLOCK_SIZE):
+        b = view[pos // 8, :, 7 - pos % 8 if little else pos % 8]
+        if pos == 0:
+            hi[0].take(b, out=out[0])
+            lo[0].take(b, out=out[1])
+        else:
+            hi[pos].take(b, out=tmp)
+            out[0] |= tmp
+            lo[pos].take(b, out=tmp)
+            out[1] |= tmp
+    return out
+
+def _np_load(blocks):
+    # (N, 16) uint8 -> (2, N) native uint64 holding the big-endian halves
+    np = _numpy()
+    halves = np.ascontiguousarray(blocks, dtype=np.uint8).view('>u8').astype(np.uint64)
+    return np.ascontiguousarray(halves.T)
+
+def _np_store(st):
+    np = _numpy()
+    return np.ascontiguousarray(st.T).astype('>u8').view(np.uint8).reshape(-1, BLOCK_SIZE)
+
+def np_encrypt_blocks(blocks, cipher):
+    """Encrypt an (N, 16) uint8 array, all rows through the rounds together."""
+    np = _numpy()
+    enc, ks_hi, ks_lo = cipher.numpy_tables()[:3]
+    st = _np_load(blocks)
+    st[0] ^= ks_hi[0]
+    st[1] ^= ks_lo[0]
+    out = np.empty_like(st)
+    for r in range(1, R+1):
+        _np_lookup(st, enc, out)
+        np.bitwise_xor(out[0], ks_hi[r], out=st[0])
+        np.bitwise_xor(out[1], ks_lo[r], out=st[1])
+    return _np_store(st)
+
+def np_decrypt_blocks(blocks, cipher):
+    """Decrypt an (N, 16) uint8 array, inverse of np_encrypt_blocks."""
+    np = _numpy()
+    _, ks_hi, ks_lo, dec, perm_inv, sub_inv, kp_hi, kp_lo = cipher.numpy_tables()
+    st = _np_load(blocks)
+    out = np.empty_like(st)
+    _np_lookup(st, perm_inv, out)
+    np.bitwise_xor(out[0], kp_hi[R], out=st[0])
+    np.bitwise_xor(out[1], kp_lo[R], out=st[1])
+    for r in range(R-1, 0, -1):
+        _np_lookup(st, dec, out)
+        np.bitwise_xor(out[0], kp_hi[r], out=st[0])
+        np.bitwise_xor(out[1], kp_lo[r], out=st[1])
+    _np_lookup(st, sub_inv, out)
+    np.bitwise_xor(out[0], ks_hi[0], out=st[0])
+    np.bitwise_xor(out[1], ks_lo[0], out=st[1])
+    return _np_store(st)
+
+# Bitsliced engine: 128 bit planes, plane b holding bit b (0 = MSB of byte
+# 0) of every block in the batch, one block per bit of a Python int. The
+# P-layer is then a reordering of the plane list, a subkey XOR is a
+# complement of the planes where the subkey bit is 1, and the S-box runs
+# as a boolean circuit over the 8 planes of each byte position, so a
+# round costs the same number of big-int operations whatever the lane count.
+BITSLICE_LANES = 1 << 16  # blocks per batch (= bits per plane)
+
+def _anf(sbox):
+    # algebraic normal form of each output bit t (value bit, 0 = LSB):
+    # coefficient lists a[t][u] over the monomials u, by Moebius transform
+    out = []
+    for t in range(8):
+        a = [(sbox[v] >> t) & 1 for v in range(256)]
+        for i in range(8):
+            bit = 1 << i
+            for v in range(256):
+                if v & bit:
+                    a[v] ^= a[v ^ bit]
+        out.append(a)
+    return out
+
+def sbox_circuit(sbox):
+    """
+    The S-box as a circuit over bit planes. The ANF is factored as
+    y = XOR_h H_h & (XOR_l a[h,l] L_l) with H_h and L_l the monomials of the
+    high and low nibble; the inner sums are looked up 4 monomials at a time.
+    Returns, for each output plane (MSB first), the (h, (m0, m1, m2, m3))
+    terms with the 4-bit masks of the low monomials taken from each group.
+    """
+    a = _anf(sbox)
+    circuit = []
+    for t in range(7, -1, -1):
+        terms = []
+        for h in range(16):
+            masks = tuple(sum(a[t][h << 4 | 4*g + j] << j for j in range(4)) for g in range(4))
+            if any(masks):
+                terms.append((h, masks))
+        circuit.append(terms)
+    return circuit
+
+_SUBSETS = (3, 5, 6, 7, 9, 10, 11, 12, 13, 14, 15)  # 4-bit masks with 2+ bits set
+
+def _bs_subsets(v, first, op):
+    # all 16 combinations of the 4 planes in v under op, indexed by mask
+    out = [first, v[0], v[1], None, v[2], None, None, None, v[3], None, None, None, None, None, None, None]
+    for u in _SUBSETS:
+        low = u & -u
+        out[u] = op(out[u ^ low], out[low])
+    return out
+
+def _bs_sbox(x, circuit, ones):
+    # 8 planes of one byte position (x[k] = value bit 7-k) -> 8 output planes
+    low = _bs_subsets((x[7], x[6], x[5], x[4]), ones, int.__and__)
+    high = _bs_subsets((x[3], x[2], x[1], x[0]), ones, int.__and__)
+    g0, g1, g2, g3 = (_bs_subsets(low[4*g:4*g+4], 0, int.__xor__) for g in range(4))
+    y = []
+    for terms in circuit:
+        acc = 0
+        for h, (m0, m1, m2, m3) in terms:
+            s = g0[m0] ^ g1[m1] ^ g2[m2] ^ g3[m3]
+            acc ^= s & high[h] if h else s
+        y.append(acc)
+    return y
+
+def _bs_sub_layer(planes, circuit, ones):
+    out = []
+    for pos in range(0, 128, 8):
+        out += _bs_sbox(planes[pos:pos+8], circuit, ones)
+    return out
+
+def bitslice_load(data):
+    """Bytes of N blocks -> (128 planes, N): bit i of plane b is bit b of block i."""
+    np = _numpy()
+    blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    bits = np.unpackbits(blocks, axis=1).T
+    packed = np.packbits(bits, axis=1, bitorder='little')
+    return [int.from_bytes(row.tobytes(), 'little') for row in packed], blocks.shape[0]
+
+def bitslice_store(planes, n):
+    """Inverse of bitslice_load."""
+    np = _numpy()
+    width = (n + 7) // 8
+    raw = b"".join(p.to_bytes(width, 'little') for p in planes)
+    packed = np.frombuffer(raw, dtype=np.uint8).reshape(len(planes), width)
+    bits = np.unpackbits(packed, axis=1, count=n, bitorder='little')
+    return np.packbits(bits.T, axis=1).tobytes()
+
+def bitslice_encrypt_planes(planes, n, cipher):
+    enc, _, keybits = cipher.bitslice_circuits()
+    perm = cipher.player
+    ones = (1 << n) - 1
+    x = list(planes)
+    for b in keybits[0]:
+        x[b] ^= ones
+    for r in range(1, R+1):
+        s = _bs_sub_layer(x, enc, ones)
+        x = [s[p] for p in perm]
+        for b in keybits[r]:
+            x[b] ^= ones
+    return x
+
+def bitslice_decrypt_planes(planes, n, cipher):
+    _, dec, keybits = cipher.bitslice_circuits()
+    perm = cipher.inv_player
+    ones = (1 << n) - 1
+    x = list(planes)
+    for r in range(R, 0, -1):
+        for b in keybits[r]:
+            x[b] ^= ones
+        x = _bs_sub_layer([x[p] for p in perm], dec, ones)
+    for b in keybits[0]:
+        x[b] ^= ones
+    return x
+
+def _bitslice_blocks(cipher, data, lanes, fn):
+    step = max(1, lanes) * BLOCK_SIZE
+    out = []
+    for a in range(0, len(data), step):
+        planes, n = bitslice_load(data[a:a+step])
+        out.append(bitslice_store(fn(planes, n, cipher), n))
+    return b"".join(out)
+
+def bitslice_encrypt_blocks(data, cipher, lanes=BITSLICE_LANES):
+    """Encrypt independent blocks, `lanes` blocks per pass through the rounds."""
+    return _bitslice_blocks(cipher, data, lanes, bitslice_encrypt_planes)
+
+def bitslice_decrypt_blocks(data, cipher, lanes=BITSLICE_LANES):
+    return _bitslice_blocks(cipher, data, lanes, bitslice_decrypt_planes)
+
+def _reference_encrypt_blocks(cipher, data):
+    return b"".join(encrypt_block(data[i:i+BLOCK_SIZE], cipher.keys, cipher.sbox, cipher.player)
+                    for i in range(0, len(data), BLOCK_SIZE))
+
+def _reference_decrypt_blocks(cipher, data):
+    return b"".join(decrypt_block(data[i:i+BLOCK_SIZE], cipher.keys, cipher.inv_sbox, cipher.inv_player)
+                    for i in range(0, len(data), BLOCK_SIZE))
+
+def _table_encrypt_blocks(cipher, data):
+    tables = cipher.tables
+    return b"".join(encrypt_int(int.from_bytes(data[i:i+BLOCK_SIZE], 'big'), tables).to_bytes(BLOCK_SIZE, 'big')
+                    for i in range(0, len(data), BLOCK_SIZE))
+
+def _table_decrypt_blocks(cipher, data):
+    tables = cipher.tables
+    return b"".join(decrypt_int(int.from_bytes(data[i:i+BLOCK_SIZE], 'big'), tables).to_bytes(BLOCK_SIZE, 'big')
+                    for i in range(0, len(data), BLOCK_SIZE))
+
+def _numpy_encrypt_blocks(cipher, data):
+    np = _numpy()
+    blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    return np_encrypt_blocks(blocks, cipher).tobytes()
+
+def _numpy_decrypt_blocks(cipher, data):
+    np = _numpy()
+    blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    return np_decrypt_blocks(blocks, cipher).tobytes()
+
+def _bitslice_encrypt_blocks(cipher, data):
+    return bitslice_encrypt_blocks(data, cipher)
+
+def _bitslice_decrypt_blocks(cipher, data):
+    return bitslice_decrypt_blocks(data, cipher)
+
+ENGINES = {
+    "reference": (_reference_encrypt_blocks, _reference_decrypt_blocks),
+    "table": (_table_encrypt_blocks, _table_decrypt_blocks),
+    "numpy": (_numpy_encrypt_blocks, _numpy_decrypt_blocks),
+    "bitslice": (_bitslice_encrypt_blocks, _bitslice_decrypt_blocks),
+}
+
+def _engine(name):
+    try:
+        return ENGINES[name]
+    except KeyError:
+        raise ValueError(f"Unknown engine: {name}") from None
+
+# ------------------------------------------------------------
+# Multi-process helpers. Workers receive the master key and rebuild the
+# context through their own get_cipher cache.
+# ------------------------------------------------------------
+PARALLEL_MIN_BLOCKS = 1024  # smallest range worth shipping to a worker
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+def resolve_workers(workers):
+    # None/0 -> one worker per core
+    return workers if workers and workers > 0 else (os.cpu_count() or 1)
+
+def process_pool(workers):
+    """Shared process pool, recreated when the worker count changes."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_workers = workers
+        return _pool
+
+@atexit.register
+def _shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+def block_ranges(nblocks, workers):
+    # split nblocks into (start, end) block ranges, a few per worker
+    if nblocks == 0:
+        return []
+    step = max(PARALLEL_MIN_BLOCKS, -(-nblocks // (workers * 4)))
+    return [(i, min(i + step, nblocks)) for i in range(0, nblocks, step)]
+
+def _cbc_decrypt_range(master_key, prev, chunk, engine):
+    return get_cipher(master_key).cbc_decrypt(chunk, prev, engine)
+
+def cbc_decrypt_parallel(cipher, ciphertext, iv, workers=None, engine=DEFAULT_ENGINE):
+    """
+    CBC decryption split into block ranges over a process pool. Each range
+    only needs the ciphertext block before it (or the IV) for the final XOR.
+    """
+    workers = resolve_workers(workers)
+    nblocks = len(ciphertext) // BLOCK_SIZE
+    if workers == 1 or nblocks < 2 * PARALLEL_MIN_BLOCKS:
+        return cipher.cbc_decrypt(ciphertext, iv, engine)
+    pool = process_pool(workers)
+    futures = []
+    for start, end in block_ranges(nblocks, workers):
+        a, b = start * BLOCK_SIZE, end * BLOCK_SIZE
+        prev = ciphertext[a-BLOCK_SIZE:a] if start else iv
+        futures.append(pool.submit(_cbc_decrypt_range, cipher.master_key,
+                                   bytes(prev), bytes(ciphertext[a:b]), engine))
+    return b"".join(f.result() for f in futures)
+
+# ------------------------------------------------------------
+# CTR mode: keystream block i = E(nonce + i mod 2^128). Every block is
+# independent, so the keystream is generated in batches or across cores.
+# ------------------------------------------------------------
+def counter_blocks(nonce, start, nblocks):
+    n = int.from_bytes(nonce, 'big') + start
+    mask = (1 << 128) - 1
+    return b"".join(((n + i) & mask).to_bytes(BLOCK_SIZE, 'big') for i in range(nblocks))
+
+def ctr_keystream(cipher, nonce, start, nblocks, engine=DEFAULT_ENGINE):
+    return cipher.encrypt_blocks(counter_blocks(nonce, start, nblocks), engine)
+
+def _ctr_keystream_range(master_key, nonce, start, nblocks, engine):
+    return ctr_keystream(get_cipher(master_key), nonce, start, nblocks, engine)
+
+def ctr_keystream_parallel(cipher, nonce, start, nblocks, workers=None, engine=DEFAULT_ENGINE):
+    workers = resolve_workers(workers)
+    if workers == 1 or nblocks < 2 * PARALLEL_MIN_BLOCKS:
+        return ctr_keystream(cipher, nonce, start, nblocks, engine)
+    pool = process_pool(workers)
+    futures = [pool.submit(_ctr_keystream_range, cipher.master_key, bytes(nonce),
+                           start + a, b - a, engine)
+               for a, b in block_ranges(nblocks, workers)]
+    return b"".join(f.result() for f in futures)
+
+def ctr_xor(cipher, nonce, data, start=0, workers=1, engine=DEFAULT_ENGINE):
+    """Encrypt or decrypt data (any length) starting at keystream block start."""
+    if not data:
+        return b""
+    nblocks = -(-len(data) // BLOCK_SIZE)
+    ks = ctr_keystream_parallel(cipher, nonce, start, nblocks, workers, engine)
+    return xor_long(data, ks[:len(data)])
+
+# ------------------------------------------------------------
+# Headers and whole-buffer encryption shared by the message API
+# ------------------------------------------------------------
+def pack_header(mode, flags=0):
+    return struct.pack(">4sBBH", HEADER_MAGIC, HEADER_VERSION, mode, flags)
+
+def parse_header(data):
+    """Return (mode, flags) if data starts with a known header, else None (legacy CBC)."""
+    if len(data) < HEADER_SIZE or data[:4] != HEADER_MAGIC:
+        return None
+    _, version, mode, flags = struct.unpack(">4sBBH", data[:HEADER_SIZE])
+    if version != HEADER_VERSION or mode not in MODES.values():
+        return None
+    return mode, flags
+
+# ------------------------------------------------------------
+# Tree MAC (FLAG_TREE_MAC): the data before the tag is cut into
+# TREE_LEAF_SIZE leaves, HMACed on their own so they can run on several
+# threads (hashlib releases the GIL), and the root HMAC covers the total
+# length and every leaf tag in order:
+#   LEAF_i = HMAC(0x00 || i(8) || chunk_i)
+#   TAG    = HMAC(0x01 || LENGTH(8) || LEAF_0 || LEAF_1 || ...)
+# ------------------------------------------------------------
+class TreeMac:
+    """Incremental tree MAC with the update()/digest() interface of hashlib."""
+
+    def __init__(self, cipher, workers=1, leaf_size=None):
+        self.cipher = cipher
+        self.leaf_size = leaf_size or TREE_LEAF_SIZE
+        self.workers = resolve_workers(workers)
+        self.pool = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+        self.pending = bytearray()
+        self.leaves = []  # leaf tags, or futures of them
+        self.done = 0     # leaves known to be finished
+        self.length = 0
+
+    def _leaf(self, index, data):
+        mac = self.cipher.hmac_init()
+        mac.update(b"\x00" + struct.pack(">Q", index))
+        mac.update(data)
+        return self.cipher.hmac_final(mac)
+
+    def _submit(self, data):
+        index = len(self.leaves)
+        if self.pool is None:
+            self.leaves.append(self._leaf(index, data))
+            return
+        self.leaves.append(self.pool.submit(self._leaf, index, data))
+        # bound the leaves (and their data) in flight
+        while len(self.leaves) - self.done > 2 * self.workers:
+            self.leaves[self.done] = self.leaves[self.done].result()
+            self.done += 1
+
+    def update(self, data):
+        data = memoryview(data).cast('B')
+        self.length += len(data)
+        if self.pending:
+            take = min(len(data), self.leaf_size - len(self.pending))
+            self.pending += data[:take]
+            data = data[take:]
+            if len(self.pending) < self.leaf_size:
+                return
+            self._submit(bytes(self.pending))
+            self.pending = bytearray()
+        full = len(data) - len(data) % self.leaf_size
+        for a in range(0, full, self.leaf_size):
+            self._submit(data[a:a+self.leaf_size])
+        self.pending += data[full:]
+
+    def digest(self):
+        if self.pending or not self.leaves:
+            self._submit(bytes(self.pending))
+            self.pending = bytearray()
+        root = self.cipher.hmac_init()
+        root.update(b"\x01" + struct.pack(">Q", self.length))
+        if self.pool is not None:
+            self.leaves[self.done:] = [f.result() for f in self.leaves[self.done:]]
+            self.pool.shutdown()
+        for leaf in self.leaves:
+            root.update(leaf)
+        return self.cipher.hmac_final(root)
+
+def mac_init(cipher, flags=0, workers=1):
+    """Incremental tag of a file with these header flags; finish with mac_final."""
+    return TreeMac(cipher, workers) if flags & FLAG_TREE_MAC else cipher.hmac_init()
+
+def mac_final(cipher, mac):
+    return mac.digest() if isinstance(mac, TreeMac) else cipher.hmac_final(mac)
+
+def compute_tag(cipher, data, flags=0, workers=1):
+    """TAG over data (everything before the tag): HMAC-SHA256, or the tree MAC."""
+    mac = mac_init(cipher, flags, workers)
+    mac.update(data)
+    return mac_final(cipher, mac)
+
+def _header_flags(header):
+    return header[1] if header else 0
+
+# ------------------------------------------------------------
+# Buffer API: encrypt/decrypt from any buffer (bytes, bytearray,
+# memoryview, mmap) into a caller-provided output buffer. The table
+# engine works block by block in place; batch engines and multi-process
+# runs go through bounded STREAM_CHUNK_SIZE pieces.
+# ------------------------------------------------------------
+def encrypted_size(n, mode="cbc", tree_mac=False):
+    if mode == "cbc":
+        # only the tree MAC needs a header in front of CBC
+        return (HEADER_SIZE if tree_mac else 0) + 16 + (n - n % BLOCK_SIZE + BLOCK_SIZE) + 32
+    if mode == "ctr":
+        return HEADER_SIZE + 16 + n + 32
+    raise ValueError(f"Unknown mode: {mode}")
+
+def _chunked(n):
+    step = _chunk_size(STREAM_CHUNK_SIZE)
+    for a in range(0, n, step):
+        yield a, min(a + step, n)
+
+def _cbc_encrypt_region(cipher, src, dst, iv, engine):
+    # returns the last ciphertext block, the chaining value for what follows
+    if engine != "reference":  # serial chain, see EmoCipher.cbc_encrypt
+        _engine(engine)
+        return cbc_encrypt_into(src, dst, iv, cipher.tables).to_bytes(BLOCK_SIZE, 'big')
+    prev = iv
+    for a, b in _chunked(len(src)):
+        c = cipher.cbc_encrypt(src[a:b], prev, engine)
+        dst[a:b] = c
+        prev = c[-BLOCK_SIZE:]
+    return prev
+
+def _cbc_decrypt_region(cipher, src, dst, iv, workers, engine):
+    if engine == "table" and resolve_workers(workers) == 1:
+        cbc_decrypt_into(src, dst, iv, cipher.tables)
+        return
+    for a, b in _chunked(len(src)):
+        prev = bytes(src[a-BLOCK_SIZE:a]) if a else iv
+        dst[a:b] = cbc_decrypt_parallel(cipher, src[a:b], prev, workers, engine)
+
+def _ctr_xor_region(cipher, nonce, src, dst, workers, engine):
+    if engine == "table" and resolve_workers(workers) == 1:
+        ctr_xor_into(src, dst, nonce, 0, cipher.tables)
+        return
+    for a, b in _chunked(len(src)):
+        dst[a:b] = ctr_xor(cipher, nonce, src[a:b], a // BLOCK_SIZE, workers, engine)
+
+def pkcs7_unpad_len(buf, n):
+    """Unpadded length of the n padded bytes at the start of buf (checks like pkcs7_unpad)."""
+    if n == 0 or n % BLOCK_SIZE != 0:
+        raise ValueError("Invalid padding length")
+    pad = buf[n-1]
+    if pad < 1 or pad > BLOCK_SIZE:
+        raise ValueError("Invalid padding value")
+    if bytes(buf[n-pad:n]) != bytes([pad])*pad:
+        raise ValueError("Invalid padding bytes")
+    return n - pad
+
+def encrypt_into(src, dst, cipher, mode="cbc", engine=DEFAULT_ENGINE, workers=1, tree_mac=False):
+    """
+    Encrypt src into dst, which needs at least
+    encrypted_size(len(src), mode, tree_mac) bytes. Returns the number of
+    bytes written.
+    cbc: IV || C || TAG (original format, no header)
+    ctr: HEADER || NONCE || C || TAG, no padding
+    TAG is HMAC-SHA256 over everything before it; with tree_mac the header
+    (also in front of CBC) sets FLAG_TREE_MAC and TAG is the TreeMac root,
+    its leaves HMACed on `workers` threads.
+    """
+    src = memoryview(src).cast('B')
+    dst = memoryview(dst).cast('B')
+    n = len(src)
+    total = encrypted_size(n, mode, tree_mac)
+    if len(dst) < total:
+        raise ValueError("Output buffer too small")
+    flags = FLAG_TREE_MAC if tree_mac else 0
+    iv = os.urandom(16)
+    if mode == "ctr":
+        dst[:HEADER_SIZE] = pack_header(MODE_CTR, flags)
+        body = HEADER_SIZE + 16
+        with instrument.phase("rounds"):
+            _ctr_xor_region(cipher, iv, src, dst[body:body+n], workers, engine)
+    else:
+        body = 16
+        if tree_mac:
+            dst[:HEADER_SIZE] = pack_header(MODE_CBC, flags)
+            body += HEADER_SIZE
+        full = n - n % BLOCK_SIZE
+        with instrument.phase("rounds"):
+            prev = _cbc_encrypt_region(cipher, src[:full], dst[body:body+full], iv, engine)
+        with instrument.phase("pad"):
+            last = cipher.cbc_encrypt(pkcs7_pad(bytes(src[full:])), prev, engine)
+            dst[body+full:body+full+BLOCK_SIZE] = last
+    dst[body-16:body] = iv
+    with instrument.phase("mac"):
+        dst[total-32:total] = compute_tag(cipher, dst[:total-32], flags, workers)
+    if instrument.enabled:
+        instrument.count("blocks", -(-(total - body - 32) // BLOCK_SIZE))
+        instrument.count("bytes_in", n)
+        instrument.count("bytes_out", total)
+    return total
+
+def decrypt_into(src, dst, cipher, engine=DEFAULT_ENGINE, workers=1):
+    """
+    Decrypt src (output of encrypt_into) into dst, which needs room for the
+    whole ciphertext body (len(src) - 48, or - 56 with a header). The MAC is
+    checked before decrypting. Returns the plaintext length.
+    """
+    src = memoryview(src).cast('B')
+    dst = memoryview(dst).cast('B')
+    header = parse_header(src)
+    offset = HEADER_SIZE if header else 0
+    if len(src) < offset + 16 + 32:
+        raise ValueError("Ciphertext too short")
+    with instrument.phase("mac"):
+        valid = compute_tag(cipher, src[:-32], _header_flags(header), workers) == src[-32:]
+    if not valid:
+        instrument.count("mac_failures")
+        raise ValueError("MAC verification failed")
+    iv = bytes(src[offset:offset+16])
+    ciphertext = src[offset+16:-32]
+    n = len(ciphertext)
+    if len(dst) < n:
+        raise ValueError("Output buffer too small")
+    if instrument.enabled:
+        instrument.count("blocks", -(-n // BLOCK_SIZE))
+        instrument.count("bytes_in", len(src))
+    if header and header[0] == MODE_CTR:
+        with instrument.phase("rounds"):
+            _ctr_xor_region(cipher, iv, ciphertext, dst[:n], workers, engine)
+        instrument.count("bytes_out", n)
+        return n
+    if n % BLOCK_SIZE:
+        raise ValueError("Invalid padding length")
+    with instrument.phase("rounds"):
+        _cbc_decrypt_region(cipher, ciphertext, dst[:n], iv, workers, engine)
+    with instrument.phase("pad"):
+        m = pkcs7_unpad_len(dst, n)
+    instrument.count("bytes_out", m)
+    return m
+
+def encrypt_bytes(data, cipher, mode="cbc", engine=DEFAULT_ENGINE, workers=1, tree_mac=False):
+    """encrypt_into a fresh buffer; see encrypt_into for the formats."""
+    out = bytearray(encrypted_size(len(data), mode, tree_mac))
+    encrypt_into(data, out, cipher, mode, engine, workers, tree_mac)
+    with instrument.phase("copy"):
+        return bytes(out)
+
+def verify_bytes(blob, cipher, workers=1):
+    """True if blob (any of the formats above) carries a valid tag."""
+    if len(blob) < 16 + 32:
+        return False
+    flags = _header_flags(parse_header(blob))
+    return compute_tag(cipher, memoryview(blob)[:-32], flags, workers) == blob[-32:]
+
+def decrypt_bytes(blob, cipher, engine=DEFAULT_ENGINE, workers=1):
+    """Inverse of encrypt_bytes; the MAC is checked before decrypting."""
+    out = bytearray(max(0, len(blob) - 16 - 32))
+    n = decrypt_into(blob, out, cipher, engine, workers)
+    with instrument.phase("copy"):
+        del out[n:]
+        return bytes(out)
+
+# ------------------------------------------------------------
+# Many independent messages under one key. CBC chains inside a message
+# but not across messages, so block i of every message goes through one
+# engine call; CTR keystreams and CBC decryption need one call in total.
+# ------------------------------------------------------------
+def batch_engine():
+    """Engine for batched work: numpy when available, else the tables."""
+    try:
+        _numpy()
+        return "numpy"
+    except ImportError:
+        return "table"
+
+def _encrypt_rows(cipher, rows, engine):
+    # (k, 16) uint8 -> (k, 16) uint8 through any engine
+    np = _numpy()
+    if engine == "numpy":
+        return np_encrypt_blocks(rows, cipher)
+    out = _engine(engine)[0](cipher, rows.tobytes())
+    return np.frombuffer(out, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+
+def _cbc_encrypt_many(cipher, padded, ivs, engine):
+    # messages sorted longest first, so the ones still running at block i
+    # are a prefix; each step gathers block i of those and chains it
+    np = _numpy()
+    n = len(padded)
+    nblocks = np.array([len(p) // BLOCK_SIZE for p in padded], dtype=np.int64)
+    order = np.argsort(-nblocks, kind="stable")
+    lengths = nblocks[order]
+    starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    flat = np.frombuffer(b"".join(padded[j] for j in order), dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+    out = np.empty_like(flat)
+    prev = np.frombuffer(b"".join(ivs[j] for j in order), dtype=np.uint8).reshape(n, BLOCK_SIZE).copy()
+    for i in range(int(lengths[0])):
+        k = int(np.count_nonzero(lengths > i))
+        rows = starts[:k] + i
+        c = _encrypt_rows(cipher, flat[rows] ^ prev[:k], engine)
+        out[rows] = c
+        prev[:k] = c
+    raw = out.tobytes()
+    bodies = [None] * n
+    for pos, j in enumerate(order):
+        a = int(starts[pos]) * BLOCK_SIZE
+        bodies[j] = raw[a:a + len(padded[j])]
+    return bodies
+
+def encrypt_many(messages, cipher, mode="cbc", engine=None):
+    """
+    encrypt_bytes for each message (same formats, a fresh IV each), in
+    input order. Messages are processed together block by block, so a
+    batch of short messages costs a few engine calls instead of one
+    per block. engine: default batch_engine().
+    """
+    engine = engine or batch_engine()
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode: {mode}")
+    messages = [bytes(m) for m in messages]
+    if not messages:
+        return []
+    ivs = [os.urandom(16) for _ in messages]
+    with instrument.phase("rounds"):
+        if mode == "ctr":
+            head = pack_header(MODE_CTR)
+            counters = [counter_blocks(iv, 0, -(-len(m) // BLOCK_SIZE)) for m, iv in zip(messages, ivs)]
+            ks = cipher.encrypt_blocks(b"".join(counters), engine)
+            bodies, a = [], 0
+            for m, c in zip(messages, counters):
+                bodies.append(xor_long(m, ks[a:a+len(m)]))
+                a += len(c)
+        else:
+            head = b""
+            padded = [pkcs7_pad(m) for m in messages]
+            if batch_engine() != "numpy":  # no numpy: one message at a time
+                bodies = [cipher.cbc_encrypt(p, iv, engine) for p, iv in zip(padded, ivs)]
+            else:
+                bodies = _cbc_encrypt_many(cipher, padded, ivs, engine)
+    out = []
+    with instrument.phase("mac"):
+        for iv, body in zip(ivs, bodies):
+            blob = head + iv + body
+            out.append(blob + cipher.hmac(blob))
+    if instrument.enabled:
+        instrument.count("messages", len(out))
+        instrument.count("bytes_in", sum(map(len, messages)))
+        instrument.count("bytes_out", sum(map(len, out)))
+    return out
+
+def decrypt_many(blobs, cipher, engine=None):
+    """
+    decrypt_bytes for each blob, in input order. Each result is the
+    plaintext bytes or the ValueError of that item (bad MAC, bad padding,
+    too short); one bad item does not stop the others. Every MAC is
+    checked first; all CBC blocks then go through one decrypt_blocks
+    call and all CTR counters through one encrypt_blocks call.
+    """
+    engine = engine or batch_engine()
+    results = [None] * len(blobs)
+    parts = []
+    cbc_in, ctr_in = [], []
+    cbc_len = ctr_len = 0
+    with instrument.phase("mac"):
+        for i, blob in enumerate(blobs):
+            blob = bytes(blob)
+            header = parse_header(blob)
+            offset = HEADER_SIZE if header else 0
+            if len(blob) < offset + 16 + 32:
+                results[i] = ValueError("Ciphertext too short")
+                continue
+            if compute_tag(cipher, memoryview(blob)[:-32], _header_flags(header)) != blob[-32:]:
+                instrument.count("mac_failures")
+                results[i] = ValueError("MAC verification failed")
+                continue
+            iv, ct = blob[offset:offset+16], blob[offset+16:-32]
+            if header and header[0] == MODE_CTR:
+                counters = counter_blocks(iv, 0, -(-len(ct) // BLOCK_SIZE))
+                ctr_in.append(counters)
+                parts.append((i, True, iv, ct, ctr_len))
+                ctr_len += len(counters)
+            elif not ct or len(ct) % BLOCK_SIZE:
+                results[i] = ValueError("Invalid padding length")
+            else:
+                cbc_in.append(ct)
+                parts.append((i, False, iv, ct, cbc_len))
+                cbc_len += len(ct)
+    with instrument.phase("rounds"):
+        cbc_out = cipher.decrypt_blocks(b"".join(cbc_in), engine) if cbc_in else b""
+        ctr_out = cipher.encrypt_blocks(b"".join(ctr_in), engine) if ctr_in else b""
+    for i, ctr, iv, ct, start in parts:
+        if ctr:
+            results[i] = xor_long(ct, ctr_out[start:start+len(ct)])
+            continue
+        d = cbc_out[start:start+len(ct)]
+        try:
+            results[i] = pkcs7_unpad(xor_long(d, iv + ct[:-BLOCK_SIZE]))
+        except ValueError as e:
+            results[i] = e
+    instrument.count("messages", len(results))
+    return results
+
+# ------------------------------------------------------------
+# Engine registry: engine="auto" picks, per call, the engine that is
+# fastest on this host for the payload size and operation:
+#   "ctr"          keystream blocks (CTR encryption and decryption)
+#   "cbc_decrypt"  CBC decryption (blocks decrypt independently)
+#   "cbc_encrypt"  serial, always the tables (see EmoCipher.cbc_encrypt)
+# Each engine is first checked against known-answer vectors; the ones
+# that pass are timed at two sizes on first use and modelled as
+# seconds = fixed + per_byte * n. The profile is kept for the process and
+# can be saved (CLI `engines --save`) so later runs skip the measurement.
+# $EMO_ENGINE pins the engine "auto" resolves to.
+# ------------------------------------------------------------
+AUTO_ENGINE = "auto"
+ENGINE_ENV = "EMO_ENGINE"
+ENGINE_PROFILE_ENV = "EMO_ENGINE_PROFILE"  # profile path, default ENGINE_PROFILE_FILE
+ENGINE_PROFILE_FILE = os.path.join(ESCROW_DIR, "engines.json")
+ENGINE_PROFILE_VERSION = 1
+ENGINE_OPS = ("ctr", "cbc_decrypt")
+ENGINE_PROBE_SIZES = (256, 1 << 20)  # smallest and largest timed payload
+AUTO_TABLE_MAX = 256  # bytes; smaller payloads use the tables even before profiling
+# reference (the bit-list spec) is only a candidate when pinned
+AUTO_CANDIDATES = ("table", "numpy", "bitslice")
+# known answers: key bytes(range(32)), blocks bytes(range(256)), nonce bytes(range(16))
+KAT_ECB_SHA256 = "f6db5817f5e541e967c37816aa6c2808f460bc3d7872b6ab7f4a682c89590356"
+KAT_CTR_SHA256 = "933468b91f77774aa5c9bec58bc95658818f2b01e9ba152ce6d0c010cffadada"
+_engine_profile = None
+_engine_profile_lock = threading.Lock()
+
+def check_engines(names=None):
+    """
+    Run every engine (default: all of ENGINES) on the known-answer vectors:
+    blocks, CTR keystream and a decrypt round trip. Returns {name: None if
+    it passes, else the reason}; engines missing a dependency report it.
+    """
+    cipher = get_cipher(bytes(range(32)))
+    data, nonce = bytes(range(256)), bytes(range(16))
+    out = {}
+    for name in names or ENGINES:
+        try:
+            enc = cipher.encrypt_blocks(data, name)
+            if hashlib.sha256(enc).hexdigest() != KAT_ECB_SHA256:
+                out[name] = "block encryption does not match the known answer"
+            elif hashlib.sha256(ctr_xor(cipher, nonce, data, 0, 1, name)).hexdigest() != KAT_CTR_SHA256:
+                out[name] = "CTR keystream does not match the known answer"
+            elif cipher.cbc_decrypt(cipher.cbc_encrypt(data, nonce, name), nonce, name) != data:
+                out[name] = "CBC round trip failed"
+            else:
+                out[name] = None
+        except ImportError as e:
+            out[name] = f"unavailable ({e})"
+    return out
+
+def _time_engine(cipher, op, engine, n):
+    data, iv = bytes(n), bytes(16)
+    t0 = time.perf_counter()
+    if op == "ctr":
+        ctr_xor(cipher, iv, data, 0, 1, engine)
+    else:
+        cipher.cbc_decrypt(data, iv, engine)
+    return time.perf_counter() - t0
+
+def _engine_model(cipher, op, engine):
+    # [fixed_s, per_byte_s]: the smallest probe gives the fixed cost, then
+    # the size grows until the time clearly rises above it, for the slope
+    small = ENGINE_PROBE_SIZES[0]
+    _time_engine(cipher, op, engine, small)  # warm up (numpy tables, bitslice circuits)
+    t_small = _time_engine(cipher, op, engine, small)
+    n, t = small, t_small
+    while n < ENGINE_PROBE_SIZES[1] and t < max(2 * t_small, 0.005):
+        n *= 4
+        t = _time_engine(cipher, op, engine, n)
+    per_byte = max(t - t_small, 0.0) / (n - small) if n > small else 0.0
+    return [max(t_small - per_byte * small, 0.0), per_byte]
+
+def measure_engines(candidates=AUTO_CANDIDATES):
+    """A fresh profile: KAT results and, per op, {engine: [fixed_s, per_byte_s]}."""
+    import platform
+    kat = check_engines(candidates)
+    cipher = get_cipher(bytes(range(32)))
+    models = {op: {name: _engine_model(cipher, op, name) for name in candidates if kat[name] is None}
+              for op in ENGINE_OPS}
+    return {"version": ENGINE_PROFILE_VERSION, "host": platform.node(),
+            "python": platform.python_version(), "kat": kat, "models": models}
+
+def available_engines():
+    """Names of the engines whose dependencies are installed."""
+    names = []
+    for name in sorted(ENGINES):
+        try:
+            if name in ("numpy", "bitslice"):
+                _numpy()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def _profile_usable(profile):
+    # same format, and every engine it picks from can still run here
+    if profile.get("version") != ENGINE_PROFILE_VERSION or set(profile.get("models", ())) != set(ENGINE_OPS):
+        return False
+    available = set(available_engines())
+    return all(models and set(models) <= available for models in profile["models"].values())
+
+def load_engine_profile(path=None):
+    """The saved profile, or None if there is none or it no longer fits this host."""
+    import json
+    path = path or os.environ.get(ENGINE_PROFILE_ENV) or ENGINE_PROFILE_FILE
+    try:
+        with open(path, encoding="utf-8") as f:
+            profile = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return profile if _profile_usable(profile) else None
+
+def save_engine_profile(profile=None, path=None):
+    import json
+    path = path or os.environ.get(ENGINE_PROFILE_ENV) or ENGINE_PROFILE_FILE
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(profile or engine_profile(), f, indent=1)
+    return path
+
+def engine_profile():
+    """The process-wide profile: loaded if saved, else measured once."""
+    global _engine_profile
+    with _engine_profile_lock:
+        if _engine_profile is None:
+            _engine_profile = load_engine_profile() or measure_engines()
+        return _engine_profile
+
+def set_engine_profile(profile):
+    """Replace (or with None, forget) the process-wide profile."""
+    global _engine_profile
+    with _engine_profile_lock:
+        _engine_profile = profile
+
+def select_engine(nbytes, op="ctr", profile=None):
+    """Fastest engine for `nbytes` of `op` (see ENGINE_OPS); $EMO_ENGINE wins."""
+    pinned = os.environ.get(ENGINE_ENV)
+    if pinned and pinned != AUTO_ENGINE:
+        _engine(pinned)
+        return pinned
+    if op == "cbc_encrypt":
+        return DEFAULT_ENGINE
+    if profile is None and _engine_profile is None and nbytes <= AUTO_TABLE_MAX:
+        # no batch engine beats the tables on a few blocks: skip measuring
+        return DEFAULT_ENGINE
+    models = (profile or engine_profile())["models"][op]
+    return min(models, key=lambda name: models[name][0] + models[name][1] * nbytes)
+
+def _decrypt_op(head):
+    header = parse_header(head)
+    return "ctr" if header and header[0] == MODE_CTR else "cbc_decrypt"
+
+def resolve_engine(engine, nbytes, op="ctr"):
+    """`engine` itself, or the registry's choice when it is "auto" (or None)."""
+    if engine is None or engine == AUTO_ENGINE:
+        return select_engine(nbytes, op)
+    return engine
+
+_INT128_SIZE = sys.getsizeof(1 << 127)
+
+def _tables_size(tables):
+    # rough memory footprint of the expanded key, in bytes
+    size = 0
+    for part in tables:
+        for t in (part if isinstance(part[0], list) else [part]):
+            size += sys.getsizeof(t) + len(t) * _INT128_SIZE
+    return size
+
+# LRU cache of cipher contexts used by the module-level API
+CIPHER_CACHE_MAX_ENTRIES = 256
+CIPHER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+_cipher_cache = OrderedDict()
+_cipher_cache_lock = threading.Lock()
+_cipher_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+def configure_cipher_cache(max_entries=None, max_bytes=None):
+    global CIPHER_CACHE_MAX_ENTRIES, CIPHER_CACHE_MAX_BYTES
+    with _cipher_cache_lock:
+        if max_entries is not None:
+            CIPHER_CACHE_MAX_ENTRIES = max_entries
+        if max_bytes is not None:
+            CIPHER_CACHE_MAX_BYTES = max_bytes
+        _evict_ciphers()
+
+def cipher_cache_stats():
+    with _cipher_cache_lock:
+        stats = dict(_cipher_cache_stats)
+        stats["entries"] = len(_cipher_cache)
+    return stats
+
+def clear_cipher_cache():
+    with _cipher_cache_lock:
+        _cipher_cache.clear()
+        _cipher_cache_stats.update(hits=0, misses=0, evictions=0, bytes=0)
+
+def _evict_ciphers():
+    # caller holds _cipher_cache_lock
+    while _cipher_cache and (len(_cipher_cache) > CIPHER_CACHE_MAX_ENTRIES or
+                             _cipher_cache_stats["bytes"] > CIPHER_CACHE_MAX_BYTES):
+        _, old = _cipher_cache.popitem(last=False)
+        _cipher_cache_stats["bytes"] -= old.size
+        _cipher_cache_stats["evictions"] += 1
+
+def get_cipher(master_key):
+    master_key = bytes(master_key)
+    with _cipher_cache_lock:
+        cipher = _cipher_cache.get(master_key)
+        if cipher is not None:
+            _cipher_cache.move_to_end(master_key)
+            _cipher_cache_stats["hits"] += 1
+            instrument.count("cache_hits")
+            return cipher
+        _cipher_cache_stats["misses"] += 1
+    instrument.count("cache_misses")
+    return _cache_cipher(EmoCipher(master_key))
+
+def _cache_cipher(cipher):
+    # insert unless another thread cached the same key first
+    with _cipher_cache_lock:
+        cached = _cipher_cache.get(cipher.master_key)
+        if cached is not None:
+            return cached
+        _cipher_cache[cipher.master_key] = cipher
+        _cipher_cache_stats["bytes"] += cipher.size
+        _evict_ciphers()
+    return cipher
+
+# ------------------------------------------------------------
+# Expanded-key file: the key schedule of one master key, encrypted and
+# authenticated with keys derived from it, so a process that already
+# unlocked the escrow skips the PRNG part of the key setup.
+#   MAGIC(4) || VERSION(1) || 0(1) || FLAGS(2) || KEY_ID(8) || NONCE(16) || BODY || TAG(32)
+#   BODY = sbox(256) || inv_sbox(256) || player(128) || inv_player(128) || subkeys((R+1)*16)
+# BODY is XORed with SHAKE-256(file key || NONCE); TAG is the HMAC of
+# everything before it. KEY_ID rejects a file of another key cheaply.
+# The round tables are not stored: rebuilding them from the S-box and
+# P-layer is faster than decrypting and parsing 256 KiB of entries.
+# ------------------------------------------------------------
+EXPANDED_KEY_MAGIC = b"EMOX"
+EXPANDED_KEY_VERSION = 1
+EXPANDED_KEY_FILE = os.path.join(ESCROW_DIR, "expanded.key")
+_EXPANDED_HEADER = struct.Struct(">4sBBH8s16s")
+_SCHEDULE_SIZE = 256 + 256 + 128 + 128 + (R+1) * 16
+
+def _expanded_key_ids(master_key):
+    # (key id, file key) derived from the master key
+    return (hmac_sha256(master_key, b"EMO-SPN expanded key id")[:8],
+            hmac_sha256(master_key, b"EMO-SPN expanded key"))
+
+def save_expanded_key(cipher, path=None):
+    """Write the expanded key of cipher to path (owner-only permissions)."""
+    path = path or EXPANDED_KEY_FILE
+    key_id, file_key = _expanded_key_ids(cipher.master_key)
+    body = b"".join([cipher.sbox, cipher.inv_sbox, bytes(cipher.player),
+                     bytes(cipher.inv_player)] + cipher.keys)
+    nonce = os.urandom(16)
+    head = _EXPANDED_HEADER.pack(EXPANDED_KEY_MAGIC, EXPANDED_KEY_VERSION, 0, 0, key_id, nonce)
+    blob = head + xor_long(body, hashlib.shake_256(file_key + nonce).digest(len(body)))
+    _write_private(path, blob + hmac_sha256(file_key, blob))
+    return path
+
+def _write_private(path, data):
+    # owner-only file, written beside path and renamed over it, so a crash
+    # leaves either the old file or the new one, never a torn one
+    tmp = path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def load_expanded_key(master_key, path=None):
+    """
+    EmoCipher for master_key from an expanded-key file, authenticated
+    before use. ValueError if the file belongs to another key, is damaged
+    or has an unknown version.
+    """
+    master_key = bytes(master_key)
+    key_id, file_key = _expanded_key_ids(master_key)
+    with open(path or EXPANDED_KEY_FILE, "rb") as f:
+        data = f.read()
+    hs = _EXPANDED_HEADER.size
+    if len(data) != hs + _SCHEDULE_SIZE + 32:
+        raise ValueError("Not an expanded-key file")
+    magic, version, _, _, file_id, nonce = _EXPANDED_HEADER.unpack_from(data)
+    if magic != EXPANDED_KEY_MAGIC or version != EXPANDED_KEY_VERSION:
+        raise ValueError("Not an expanded-key file")
+    if file_id != key_id:
+        raise ValueError("Expanded-key file belongs to another key")
+    if hmac_sha256(file_key, data[:-32]) != data[-32:]:
+        raise ValueError("Expanded-key file MAC verification failed")
+    body = xor_long(data[hs:-32], hashlib.shake_256(file_key + nonce).digest(_SCHEDULE_SIZE))
+    sbox, inv_sbox = body[:256], body[256:512]
+    player, inv_player = list(body[512:640]), list(body[640:768])
+    keys = [body[768+16*i:784+16*i] for i in range(R+1)]
+    return EmoCipher(master_key, (sbox, inv_sbox, player, inv_player, keys))
+
+def preload_cipher(master_key, path=None):
+    """
+    Put the cipher of master_key in the get_cipher cache from its
+    expanded-key file, if there is one for this key. Returns True when
+    the file was used.
+    """
+    path = path or EXPANDED_KEY_FILE
+    if not os.path.exists(path):
+        return False
+    try:
+        _cache_cipher(load_expanded_key(master_key, path))
+    except ValueError:
+        return False
+    return True
+
+# ------------------------------------------------------------
+# Escrow: the master key XORed with a passphrase-derived key, plus a MAC.
+# Version 2 is self-describing, so the KDF and its cost can change per
+# deployment (calibrate) without breaking existing escrows:
+#   MAGIC(4) || VERSION(1) || KDF(1) || FLAGS(2) || PARAMS(12) || SALT(16) || BLOB(32) || MAC(32)
+#   pbkdf2: PARAMS = iterations || 0 || 0   scrypt: PARAMS = n || r || p
+# The KDF output is 64 bytes: the first half masks the key, the second
+# keys the MAC over everything before it. Version 1 files (no header,
+# SALT || BLOB || MAC, PBKDF2-SHA256 with 200000 iterations) still unlock.
+# ------------------------------------------------------------
+ESCROW_MAGIC = b"EMOE"
+ESCROW_VERSION = 2
+KDF_IDS = {"pbkdf2": 1, "scrypt": 2}
+_ESCROW_HEADER = struct.Struct(">4sBBHIII16s")
+LEGACY_KDF = {"kdf": "pbkdf2", "iterations": 200000}
+DEFAULT_KDF = LEGACY_KDF  # until `calibrate --save` writes KDF_CONFIG_FILE
+KDF_CONFIG_FILE = os.path.join(ESCROW_DIR, "kdf.json")
+SCRYPT_MAX_N = 1 << 20
+_ESCROW_SIZE = _ESCROW_HEADER.size + MASTER_KEY_SIZE + 32
+_LEGACY_ESCROW_SIZE = 16 + MASTER_KEY_SIZE + 32
+
+def _scrypt_maxmem(n, r, p):
+    return 128 * r * (n + p + 2) + (1 << 20)
+
+def derive_key(passphrase, salt, params, dklen=32):
+    """Passphrase-derived key for KDF params {"kdf": "pbkdf2", "iterations"} or {"kdf": "scrypt", "n", "r", "p"}."""
+    secret = passphrase.encode()
+    if params["kdf"] == "pbkdf2":
+        return hashlib.pbkdf2_hmac("sha256", secret, salt, params["iterations"], dklen=dklen)
+    if params["kdf"] == "scrypt":
+        n, r, p = params["n"], params["r"], params["p"]
+        return hashlib.scrypt(secret, salt=salt, n=n, r=r, p=p, dklen=dklen, maxmem=_scrypt_maxmem(n, r, p))
+    raise ValueError(f"Unknown KDF: {params['kdf']}")
+
+def _pack_kdf(params):
+    if params["kdf"] == "scrypt":
+        return KDF_IDS["scrypt"], (params["n"], params["r"], params["p"])
+    return KDF_IDS["pbkdf2"], (params["iterations"], 0, 0)
+
+def _unpack_kdf(kdf_id, a, b, c):
+    if kdf_id == KDF_IDS["pbkdf2"]:
+        return {"kdf": "pbkdf2", "iterations": a}
+    if kdf_id == KDF_IDS["scrypt"]:
+        return {"kdf": "scrypt", "n": a, "r": b, "p": c}
+    raise ValueError(f"Unknown escrow KDF id: {kdf_id}")
+
+def load_kdf_params(path=None):
+    """KDF params for new escrows: the saved calibration, else DEFAULT_KDF."""
+    import json
+    try:
+        with open(path or KDF_CONFIG_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict(DEFAULT_KDF)
+
+def save_kdf_params(params, path=None):
+    import json
+    path = path or KDF_CONFIG_FILE
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(params, f)
+    return path
+
+def _time_kdf(params, repeat=2):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        derive_key("calibrate", b"\x00" * 16, params, 64)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+def calibrate_kdf(kdf="scrypt", target=0.5, max_mem=256 * 1024 * 1024):
+    """
+    KDF params whose cost on this host is close to (not above) `target`
+    seconds, and their measured time. PBKDF2 scales the iterations
+    linearly from a probe run; scrypt (r=8, p=1) takes the largest power
+    of two n that fits the time and `max_mem` bytes.
+    """
+    if kdf == "pbkdf2":
+        probe = {"kdf": "pbkdf2", "iterations": 20000}
+        per = _time_kdf(probe) / probe["iterations"]
+        iterations = max(10000, int(target / per) // 1000 * 1000)
+        params = {"kdf": "pbkdf2", "iterations": iterations}
+    elif kdf == "scrypt":
+        r, p = 8, 1
+        n = 1 << 12
+        t = _time_kdf({"kdf": "scrypt", "n": n, "r": r, "p": p})
+        while (n < SCRYPT_MAX_N and t * 2 <= target
+               and _scrypt_maxmem(2 * n, r, p) <= max_mem):
+            n *= 2
+            t = _time_kdf({"kdf": "scrypt", "n": n, "r": r, "p": p})
+        params = {"kdf": "scrypt", "n": n, "r": r, "p": p}
+    else:
+        raise ValueError(f"Unknown KDF: {kdf}")
+    return params, _time_kdf(params, 1)
+
+def _escrow_blob(master_key, passphrase, params):
     salt = os.urandom(16)
-    dk = hashlib.pbkdf2_hmac("sha256", passphrase.encode(), salt, 200000, dklen=32)
-    blob = bytes(a^b for a,b in zip(master_key, dk))
-    mac = hmac_sha256(dk, salt+blob)
-    with open(outpath, "wb") as f:
-        f.write(salt + blob + mac)
+    dk = derive_key(passphrase, salt, params, 64)
+    kdf_id, args = _pack_kdf(params)
+    head = _ESCROW_HEADER.pack(ESCROW_MAGIC, ESCROW_VERSION, kdf_id, 0, *args, salt)
+    body = head + xor_long(master_key, dk[:32])
+    return body + hmac_sha256(dk[32:], body)
+
+def create_escrow(master_key, passphrase, outpath, params=None):
+    """
+    Write a version 2 escrow of master_key (KDF params default to
+    load_kdf_params()). An existing escrow is only replaced once the new
+    one is complete, so rewrap never loses the recovery copy.
+    """
+    _write_private(outpath, _escrow_blob(master_key, passphrase, params or load_kdf_params()))
+
+def create_escrows(master_key, passphrase, paths, params=None):
+    """
+    create_escrow for several paths, each with its own salt. The KDF runs
+    concurrently on threads: hashlib releases the GIL while it works.
+    """
+    params = params or load_kdf_params()
+    with ThreadPoolExecutor(len(paths)) as pool:
+        for f in [pool.submit(create_escrow, master_key, passphrase, p, params) for p in paths]:
+            f.result()
+
+def escrow_params(data):
+    """KDF params recorded in an escrow (bytes), LEGACY_KDF for version 1."""
+    if len(data) == _ESCROW_SIZE and data[:4] == ESCROW_MAGIC:
+        magic, version, kdf_id, _, a, b, c, _ = _ESCROW_HEADER.unpack_from(data)
+        if version != ESCROW_VERSION:
+            raise ValueError(f"Unknown escrow version: {version}")
+        return _unpack_kdf(kdf_id, a, b, c)
+    if len(data) == _LEGACY_ESCROW_SIZE:
+        return dict(LEGACY_KDF)
+    raise ValueError("Not an escrow file")
 
 def recover_from_escrow(passphrase, inpath):
     with open(inpath, "rb") as f:
         data = f.read()
+    params = escrow_params(data)
+    if len(data) == _ESCROW_SIZE:
+        hs = _ESCROW_HEADER.size
+        dk = derive_key(passphrase, data[hs-16:hs], params, 64)
+        body, mac = data[:-32], data[-32:]
+        if hmac_sha256(dk[32:], body) != mac:
+            raise ValueError("Escrow MAC mismatch or wrong passphrase")
+        return xor_long(body[hs:], dk[:32])
     salt = data[:16]
     blob = data[16:16+MASTER_KEY_SIZE]
     mac = data[16+MASTER_KEY_SIZE:]
-    dk = hashlib.pbkdf2_hmac("sha256", passphrase.encode(), salt, 200000, dklen=32)
+    dk = derive_key(passphrase, salt, params)
     if hmac_sha256(dk, salt+blob) != mac:
         raise ValueError("Escrow MAC mismatch or wrong passphrase")
     master_key = bytes(a^b for a,b in zip(blob, dk))
     return master_key
 
-def encrypt_file(infile, outfile, master_key):
+def _chunk_size(chunk_size):
+    return max(BLOCK_SIZE, chunk_size - chunk_size % BLOCK_SIZE)
+
+def _read_full(f, n):
+    # like f.read(n) but keeps reading on short reads (pipes)
+    data = f.read(n)
+    while data and len(data) < n:
+        more = f.read(n - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+def _read_range(f, length, chunk_size):
+    while length > 0:
+        chunk = _read_full(f, min(chunk_size, length))
+        if not chunk:
+            raise ValueError("Ciphertext truncated")
+        length -= len(chunk)
+        yield chunk
+
+def _map_input(f):
+    # read-only mmap of an open file; empty files cannot be mapped
+    size = os.fstat(f.fileno()).st_size
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+def _map_output(f, size):
+    f.truncate(size)
+    return mmap.mmap(f.fileno(), size) if size else bytearray()
+
+def _close_maps(*maps):
+    for m in maps:
+        if isinstance(m, mmap.mmap):
+            try:
+                m.close()
+            except BufferError:
+                # views still held by an exception traceback; the map is
+                # unmapped when they are collected
+                pass
+
+def _encrypt_file_mmap(infile, outfile, cipher, mode, engine, workers, tree_mac):
+    with open(infile, "rb") as fin, open(outfile, "w+b") as fout:
+        src = _map_input(fin)
+        dst = _map_output(fout, encrypted_size(len(src), mode, tree_mac))
+        try:
+            encrypt_into(src, dst, cipher, mode, engine, workers, tree_mac)
+        finally:
+            _close_maps(src, dst)
+
+def _decrypt_file_mmap(infile, outfile, cipher, engine, workers):
+    try:
+        with open(infile, "rb") as fin, open(outfile, "w+b") as fout:
+            src = _map_input(fin)
+            dst = _map_output(fout, max(0, len(src) - 16 - 32))
+            try:
+                n = decrypt_into(src, dst, cipher, engine, workers)
+            finally:
+                _close_maps(src, dst)
+            fout.truncate(n)
+    except BaseException:
+        os.remove(outfile)
+        raise
+
+def encrypt_file(infile, outfile, master_key, engine=AUTO_ENGINE, chunk_size=STREAM_CHUNK_SIZE,
+                 mode="cbc", workers=1, use_mmap=False, segment_size=0, tree_mac=False):
+    """
+    Streaming encryption, read and written in chunks of chunk_size bytes so
+    memory stays bounded whatever the file size.
+    cbc: IV || C || TAG. ctr: HEADER || NONCE || C || TAG, keystream
+    generated on `workers` processes.
+    tree_mac: tag with the tree MAC (FLAG_TREE_MAC, header also on CBC), so
+    verification spreads over `workers` threads.
+    use_mmap: map input and output instead and encrypt_into them directly.
+    segment_size: write an emo_segment container instead, with segments of
+    this many plaintext bytes sealed on `workers` processes.
+    engine "auto": the registry's choice for one chunk (or segment).
+    """
     abort_if_not_in_sandbox(outfile)
-    sbox, inv_sbox = sbox_gen(master_key)
-    player, inv_player = player_gen(master_key)
-    keys = key_schedule(master_key)
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode: {mode}")
+    with instrument.operation("encrypt_file"):
+        with instrument.phase("key_setup"):
+            cipher = get_cipher(master_key)
+        piece = min(os.path.getsize(infile), segment_size or _chunk_size(chunk_size))
+        engine = resolve_engine(engine, piece, "ctr" if mode == "ctr" else "cbc_encrypt")
+        if segment_size:
+            import emo_segment
+            emo_segment.encrypt_file(infile, outfile, master_key, segment_size, mode, engine, workers)
+            return
+        if use_mmap:
+            _encrypt_file_mmap(infile, outfile, cipher, mode, engine, workers, tree_mac)
+            return
+        _encrypt_file_stream(infile, outfile, cipher, mode, engine, workers, _chunk_size(chunk_size),
+                             tree_mac)
+
+def _encrypt_file_stream(infile, outfile, cipher, mode, engine, workers, chunk_size, tree_mac=False):
     iv = os.urandom(16)
-    with open(infile, "rb") as f:
-        data = f.read()
-    padded = pkcs7_pad(data)
-    ciphertext = bytearray()
+    flags = FLAG_TREE_MAC if tree_mac else 0
+    head = iv if mode == "cbc" and not tree_mac else pack_header(MODES[mode], flags) + iv
+    mac = mac_init(cipher, flags, workers)
+    mac.update(head)
     prev = iv
-    for i in range(0, len(padded), BLOCK_SIZE):
-        block = padded[i:i+BLOCK_SIZE]
-        block = xor_bytes(block, prev)
-        c = encrypt_block(block, keys, sbox, player)
-        ciphertext += c
-        prev = c
-    tag = hmac_sha256(master_key, iv + ciphertext)
-    with open(outfile, "wb") as f:
-        f.write(iv + ciphertext + tag)
+    counter = 0
+    with open(infile, "rb") as fin, open(outfile, "wb") as fout:
+        fout.write(head)
+        while True:
+            with instrument.phase("read"):
+                chunk = _read_full(fin, chunk_size)
+            instrument.count("bytes_in", len(chunk))
+            last = len(chunk) < chunk_size
+            with instrument.phase("rounds"):
+                if mode == "ctr":
+                    c = ctr_xor(cipher, iv, chunk, counter, workers, engine)
+                    counter += len(chunk) // BLOCK_SIZE
+                else:
+                    if last:
+                        chunk = pkcs7_pad(chunk)
+                    c = cipher.cbc_encrypt(chunk, prev, engine)
+                    prev = c[-BLOCK_SIZE:]
+            instrument.count("blocks", -(-len(c) // BLOCK_SIZE))
+            with instrument.phase("mac"):
+                mac.update(c)
+            with instrument.phase("write"):
+                fout.write(c)
+            if last:
+                break
+        fout.write(mac_final(cipher, mac))
+        instrument.count("bytes_out", fout.tell())
 
-def decrypt_file(infile, outfile, master_key):
+def decrypt_file(infile, outfile, master_key, engine=AUTO_ENGINE, workers=1,
+                 chunk_size=STREAM_CHUNK_SIZE, use_mmap=False):
+    """
+    Streaming decryption in two passes: the whole MAC is verified first
+    and only then the file is decrypted chunk by chunk. The second pass
+    re-MACs what it reads and removes the output if the file changed.
+    The mode (CBC or CTR) comes from the header, legacy files are CBC;
+    segmented containers go to emo_segment.decrypt_file and append logs
+    to emo_append.decrypt_file.
+    use_mmap: map input and output and decrypt_into them (MAC checked first).
+    engine "auto": the registry's choice for one chunk (or segment, record).
+    """
     abort_if_not_in_sandbox(outfile)
+    size = os.path.getsize(infile)
+    with instrument.operation("decrypt_file"):
+        with instrument.phase("key_setup"):
+            cipher = get_cipher(master_key)
+        engine = _file_engine(engine, infile, size, _chunk_size(chunk_size))
+        if is_segmented_file(infile):
+            import emo_segment
+            emo_segment.decrypt_file(infile, outfile, master_key, engine, workers)
+            return
+        if is_append_log(infile):
+            import emo_append
+            emo_append.decrypt_file(infile, outfile, master_key, engine)
+            return
+        if use_mmap:
+            _decrypt_file_mmap(infile, outfile, cipher, engine, workers)
+            return
+        _decrypt_file_stream(infile, outfile, cipher, size, engine, workers, _chunk_size(chunk_size))
+
+def _file_engine(engine, infile, size, chunk_size):
+    # resolve "auto" for the pieces decrypt_file works through
+    if engine is not None and engine != AUTO_ENGINE:
+        return engine
     with open(infile, "rb") as f:
-        data = f.read()
-    if len(data) < 16 + 32:
-        raise ValueError("Ciphertext too short")
-    iv = data[:16]
-    tag = data[-32:]
-    ciphertext = data[16:-32]
-    if hmac_sha256(master_key, iv + ciphertext) != tag:
-        raise ValueError("MAC verification failed")
-    sbox, inv_sbox = sbox_gen(master_key)
-    player, inv_player = player_gen(master_key)
-    keys = key_schedule(master_key)
-    plaintext_padded = bytearray()
-    prev = iv
-    for i in range(0, len(ciphertext), BLOCK_SIZE):
-        c = ciphertext[i:i+BLOCK_SIZE]
-        block = decrypt_block(c, keys, inv_sbox, inv_player)
-        block = xor_bytes(block, prev)
-        plaintext_padded += block
-        prev = c
-    plaintext = pkcs7_unpad(bytes(plaintext_padded))
-    with open(outfile, "wb") as f:
-        f.write(plaintext)
+        head = f.read(32)
+    version = head[4] if len(head) >= 5 and head[:4] == HEADER_MAGIC else None
+    if version == SEGMENTED_VERSION:
+        import emo_segment
+        mode, piece = emo_segment.parse_header(head)
+    elif version == APPEND_VERSION:
+        import emo_append
+        mode, piece = emo_append.parse_header(head), emo_append.RECORD_SIZE
+    else:
+        header = parse_header(head)
+        mode, piece = (header[0] if header else MODE_CBC), chunk_size
+    return resolve_engine(engine, min(size, piece), "ctr" if mode == MODE_CTR else "cbc_decrypt")
+
+def _stream_tag(fin, cipher, flags, length, workers, chunk_size):
+    # tag over the next `length` bytes of fin
+    mac = mac_init(cipher, flags, workers)
+    for chunk in _read_range(fin, length, chunk_size):
+        mac.update(chunk)
+    return mac_final(cipher, mac)
+
+def verify_file(infile, master_key, workers=1, chunk_size=STREAM_CHUNK_SIZE, use_mmap=True):
+    """
+    Authenticate an encrypted file without decrypting it or writing any
+    plaintext; raises ValueError if it does not verify. Any format is
+    accepted: single-tag files (HMAC or tree MAC, whose leaves go to
+    `workers` threads), segmented containers and append logs.
+    use_mmap: MAC the mapped file in place instead of reading chunks.
+    """
+    with instrument.operation("verify_file"):
+        with instrument.phase("key_setup"):
+            cipher = get_cipher(master_key)
+        version = _file_version(infile)
+        if version == SEGMENTED_VERSION:
+            import emo_segment
+            with emo_segment.SegmentedFile(infile, master_key, workers=workers) as sf:
+                sf.verify()
+            return
+        if version == APPEND_VERSION:
+            import emo_append
+            with emo_append.AppendLog(infile, master_key) as log:
+                log.verify()
+            return
+        size = os.path.getsize(infile)
+        with open(infile, "rb") as fin:
+            header = parse_header(fin.read(HEADER_SIZE))
+            if size < (HEADER_SIZE if header else 0) + 16 + 32:
+                raise ValueError("Ciphertext too short")
+            flags = _header_flags(header)
+            instrument.count("bytes_in", size)
+            with instrument.phase("verify"):
+                if use_mmap:
+                    src = _map_input(fin)
+                    try:
+                        view = memoryview(src)
+                        valid = compute_tag(cipher, view[:-32], flags, workers) == view[-32:]
+                        view.release()
+                    finally:
+                        _close_maps(src)
+                else:
+                    fin.seek(0)
+                    valid = (_stream_tag(fin, cipher, flags, size - 32, workers, _chunk_size(chunk_size))
+                             == fin.read(32))
+        if not valid:
+            instrument.count("mac_failures")
+            raise ValueError("MAC verification failed")
+
+def _file_version(path):
+    with open(path, "rb") as f:
+        head = f.read(5)
+    return head[4] if len(head) == 5 and head[:4] == HEADER_MAGIC else None
+
+def is_segmented_file(path):
+    return _file_version(path) == SEGMENTED_VERSION
+
+def is_append_log(path):
+    return _file_version(path) == APPEND_VERSION
+
+def _decrypt_file_stream(infile, outfile, cipher, size, engine, workers, chunk_size):
+    with open(infile, "rb") as fin:
+        header = parse_header(fin.read(HEADER_SIZE))
+        offset = HEADER_SIZE if header else 0
+        ctr = header is not None and header[0] == MODE_CTR
+        flags = _header_flags(header)
+        if size < offset + 16 + 32:
+            raise ValueError("Ciphertext too short")
+        body = size - offset - 16 - 32
+        fin.seek(0)
+        head = fin.read(offset + 16)
+        iv = head[offset:]
+        fin.seek(0)
+        with instrument.phase("verify"):
+            valid = _stream_tag(fin, cipher, flags, size - 32, workers, chunk_size) == fin.read(32)
+        fin.seek(size - 32)
+        tag = fin.read(32)
+        if not valid:
+            instrument.count("mac_failures")
+            raise ValueError("MAC verification failed")
+        if not ctr and (body == 0 or body % BLOCK_SIZE):
+            raise ValueError("Invalid padding length")
+        instrument.count("bytes_in", size)
+        instrument.count("blocks", body // BLOCK_SIZE)
+        fin.seek(offset + 16)
+        mac = mac_init(cipher, flags, workers)
+        mac.update(head)
+        prev = iv
+        counter = 0
+        remaining = body
+        try:
+            with open(outfile, "wb") as fout:
+                chunks = _read_range(fin, body, chunk_size)
+                while True:
+                    with instrument.phase("read"):
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    with instrument.phase("mac"):
+                        mac.update(chunk)
+                    remaining -= len(chunk)
+                    with instrument.phase("rounds"):
+                        if ctr:
+                            p = ctr_xor(cipher, iv, chunk, counter, workers, engine)
+                            counter += len(chunk) // BLOCK_SIZE
+                        else:
+                            p = cbc_decrypt_parallel(cipher, chunk, prev, workers, engine)
+                            prev = chunk[-BLOCK_SIZE:]
+                            if remaining == 0:
+                                p = pkcs7_unpad(p)
+                    instrument.count("bytes_out", len(p))
+                    with instrument.phase("write"):
+                        fout.write(p)
+            if mac_final(cipher, mac) != tag:
+                instrument.count("mac_failures")
+                raise ValueError("MAC verification failed")
+        except BaseException:
+            os.remove(outfile)
+            raise
 
 def test_basic_flow():
     print("Running basic flow test...")
@@ -240,18 +1964,92 @@ def test_avalanche(n=100):
     print("Average differing bits (per block):", avg)
     print("Sample diffs (first 10):", diffs[:10])
 
+def generate_master_key(check=None, attempts=64):
+    """
+    A random master key. check(master_key) lists what is wrong with a key
+    (e.g. emo_quality.key_problems, weak S-box or P-layer); keys with any
+    problem are drawn again.
+    """
+    for _ in range(attempts):
+        master_key = os.urandom(MASTER_KEY_SIZE)
+        if check is None or not check(master_key):
+            return master_key
+    raise ValueError(f"No acceptable master key in {attempts} attempts")
+
 def cmd_init(args):
     ensure_dirs()
-    master_key = os.urandom(MASTER_KEY_SIZE)
+    check = None
+    if not args.no_key_check:
+        try:
+            import emo_quality
+            check = emo_quality.key_problems
+        except ImportError:
+            print("Key check skipped (numpy not installed)")
+    master_key = generate_master_key(check)
     passphrase = args.passphrase or input("Escrow passphrase: ")
     escrow_path = os.path.join(ESCROW_DIR, "recovery.enc")
-    create_escrow(master_key, passphrase, escrow_path)
     keyfile = os.path.join(SANDBOX_DIR, "key.bin.enc")
-    create_escrow(master_key, passphrase, keyfile)
+    create_escrows(master_key, passphrase, [escrow_path, keyfile])
     print("Init complete.")
     print("Escrow at:", escrow_path)
     print("Encrypted key in sandbox at:", keyfile)
 
+def cmd_calibrate(args):
+    ensure_dirs()
+    params, seconds = calibrate_kdf(args.kdf, args.target_ms / 1000, args.max_mem_mb << 20)
+    print("KDF params:", params)
+    print(f"Unlock time: {seconds * 1000:.0f} ms")
+    if args.save:
+        print("Saved for new escrows at:", save_kdf_params(params))
+
+def cmd_rewrap(args):
+    # re-encrypt the master key under the current KDF params (see calibrate)
+    ensure_dirs()
+    passphrase = args.passphrase or input("Escrow passphrase: ")
+    with instrument.phase("unlock"):
+        master_key = recover_from_escrow(passphrase, args.escrow)
+    keyfile = os.path.join(SANDBOX_DIR, "key.bin.enc")
+    params = load_kdf_params()
+    create_escrows(master_key, passphrase, [args.escrow, keyfile], params)
+    print("Escrow rewrapped with:", params)
+
+def load_master_key(args):
+    # unlock the master key from --escrow, or from the sandbox key file;
+    # its expanded-key file (expand-key), if any, replaces the key setup
+    if args.escrow:
+        passphrase = args.passphrase or input("Escrow passphrase: ")
+        path = args.escrow
+    else:
+        path = os.path.join(SANDBOX_DIR, "key.bin.enc")
+        if not os.path.exists(path):
+            raise FileNotFoundError("No key found; run init or provide --escrow")
+        passphrase = args.passphrase or input("Sandbox key passphrase: ")
+    with instrument.phase("unlock"):
+        master_key = recover_from_escrow(passphrase, path)
+    with instrument.phase("preload"):
+        preload_cipher(master_key)
+    return master_key
+
+def cmd_expand_key(args):
+    ensure_dirs()
+    master_key = load_master_key(args)
+    path = save_expanded_key(get_cipher(master_key), args.out)
+    print("Expanded key at:", path)
+
+def _agent_for(args, infile):
+    # a running key agent handles small files without unlocking the escrow.
+    # Key material named on the command line (-p, another --escrow) need not
+    # be the key the agent holds, so those calls stay on the local path.
+    if args.no_agent or args.passphrase:
+        return None
+    default = os.path.join(ESCROW_DIR, "recovery.enc")
+    if not args.escrow or os.path.abspath(args.escrow) != os.path.abspath(default):
+        return None
+    import emo_agent
+    if os.path.getsize(infile) > emo_agent.AGENT_MAX_PAYLOAD:
+        return None
+    return emo_agent.find_agent()
+
 def cmd_encrypt(args):
     ensure_dirs()
     infile = args.infile
@@ -261,16 +2059,18 @@ def cmd_encrypt(args):
         return
     abort_if_not_in_sandbox(infile)
     abort_if_not_in_sandbox(outfile)
-    if args.escrow:
-        passphrase = args.passphrase or input("Escrow passphrase: ")
-        master_key = recover_from_escrow(passphrase, args.escrow)
-    else:
-        keyfile = os.path.join(SANDBOX_DIR, "key.bin.enc")
-        if not os.path.exists(keyfile):
-            raise FileNotFoundError("No key found; run init or provide --escrow")
-        passphrase = args.passphrase or input("Sandbox key passphrase: ")
-        master_key = recover_from_escrow(passphrase, keyfile)
-    encrypt_file(infile, outfile, master_key)
+    agent = None if args.segment_size or args.tree_mac else _agent_for(args, infile)
+    if agent:
+        with agent, open(infile, "rb") as f:
+            blob = agent.encrypt(f.read(), args.mode)
+        with open(outfile, "wb") as f:
+            f.write(blob)
+        print("Encrypted", infile, "->", outfile, "(agent)")
+        return
+    master_key = load_master_key(args)
+    encrypt_file(infile, outfile, master_key, engine=args.engine, chunk_size=args.buffer_size,
+                 mode=args.mode, workers=args.workers, use_mmap=not args.no_mmap,
+                 segment_size=args.segment_size, tree_mac=args.tree_mac)
     print("Encrypted", infile, "->", outfile)
 
 def cmd_decrypt(args):
@@ -282,18 +2082,104 @@ def cmd_decrypt(args):
         return
     abort_if_not_in_sandbox(infile)
     abort_if_not_in_sandbox(outfile)
-    if args.escrow:
-        passphrase = args.passphrase or input("Escrow passphrase: ")
-        master_key = recover_from_escrow(passphrase, args.escrow)
-    else:
-        keyfile = os.path.join(SANDBOX_DIR, "key.bin.enc")
-        if not os.path.exists(keyfile):
-            raise FileNotFoundError("No key found; run init or provide --escrow")
-        passphrase = args.passphrase or input("Sandbox key passphrase: ")
-        master_key = recover_from_escrow(passphrase, keyfile)
-    decrypt_file(infile, outfile, master_key)
+    container = _file_version(infile) in (SEGMENTED_VERSION, APPEND_VERSION)
+    agent = None if container else _agent_for(args, infile)
+    if agent:
+        with agent, open(infile, "rb") as f:
+            plaintext = agent.decrypt(f.read())
+        with open(outfile, "wb") as f:
+            f.write(plaintext)
+        print("Decrypted", infile, "->", outfile, "(agent)")
+        return
+    master_key = load_master_key(args)
+    decrypt_file(infile, outfile, master_key, engine=args.engine, workers=args.workers,
+                 chunk_size=args.buffer_size, use_mmap=not args.no_mmap)
     print("Decrypted", infile, "->", outfile)
 
+def cmd_engines(args):
+    ensure_dirs()
+    profile = measure_engines()
+    # the profile carries the known-answer results of the candidates;
+    # only the engines auto never picks (reference) are checked here
+    kat = dict(profile["kat"])
+    kat.update(check_engines([name for name in ENGINES if name not in kat]))
+    for name in ENGINES:
+        reason = kat[name]
+        print(f"{name:10s} {'OK' if reason is None else reason}")
+    sizes = [1 << k for k in range(4, 27, 2)]
+    print("bytes     " + " ".join(f"{op:>12s}" for op in ENGINE_OPS))
+    for n in sizes:
+        print(f"{n:<9d} " + " ".join(f"{select_engine(n, op, profile):>12s}" for op in ENGINE_OPS))
+    if os.environ.get(ENGINE_ENV):
+        print(f"Pinned by ${ENGINE_ENV}:", os.environ[ENGINE_ENV])
+    if args.save:
+        print("Profile saved at:", save_engine_profile(profile))
+
+def cmd_verify(args):
+    ensure_dirs()
+    for path in args.files:
+        abort_if_not_in_sandbox(path)
+    master_key = load_master_key(args)
+    failed = 0
+    for path in args.files:
+        try:
+            verify_file(path, master_key, workers=args.workers, chunk_size=args.buffer_size,
+                        use_mmap=not args.no_mmap)
+            print("OK", path)
+        except (ValueError, OSError) as e:
+            failed += 1
+            print("FAILED", path + ":", e)
+    if failed:
+        sys.exit(1)
+
+def cmd_append(args):
+    import emo_append
+    ensure_dirs()
+    abort_if_not_in_sandbox(args.infile)
+    abort_if_not_in_sandbox(args.logfile)
+    master_key = load_master_key(args)
+    if args.recover and os.path.exists(args.logfile):
+        count, length = emo_append.recover(args.logfile, master_key, args.engine)
+        print("Recovered", args.logfile, f"({count} records, {length} bytes)")
+    with instrument.operation("append"):
+        count, length = emo_append.append_file(args.infile, args.logfile, master_key, args.mode,
+                                               args.engine, args.record_size)
+    print("Appended", args.infile, "->", args.logfile, f"({count} records, {length} bytes)")
+
+def cmd_read_range(args):
+    import emo_segment
+    ensure_dirs()
+    abort_if_not_in_sandbox(args.infile)
+    if args.out:
+        abort_if_not_in_sandbox(args.out)
+    master_key = load_master_key(args)
+    data = emo_segment.read_range(args.infile, args.offset, args.length, master_key,
+                                  engine=args.engine, workers=args.workers)
+    if args.out:
+        with open(args.out, "wb") as f:
+            f.write(data)
+        print(f"Read {len(data)} bytes at {args.offset} ->", args.out)
+    else:
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+
+def cmd_tree(args):
+    import emo_bulk
+    ensure_dirs()
+    op = "encrypt" if args.cmd == "encrypt-tree" else "decrypt"
+    master_key = load_master_key(args)  # unlocked once for every file
+    counts = emo_bulk.process_tree(op, args.source, args.dest, master_key, workers=args.workers,
+                                   engine=args.engine, mode=getattr(args, "mode", "cbc"),
+                                   manifest=args.manifest,
+                                   max_inflight_bytes=args.max_inflight_mb * 1024 * 1024)
+    print(f"{op}-tree: {counts['ok']} ok, {counts['skipped']} skipped, {counts['error']} failed")
+
+def cmd_agent(args):
+    import emo_agent
+    ensure_dirs()
+    master_key = load_master_key(args)
+    emo_agent.serve(master_key, args.socket, window=args.window_ms / 1000.0)
+
 def cmd_test(args):
     ensure_dirs()
     test_basic_flow()
@@ -301,36 +2187,178 @@ def cmd_test(args):
 
 def main():
     parser = argparse.ArgumentParser(prog="emo_spn")
+    parser.add_argument("--metrics", default=os.environ.get(METRICS_ENV),
+                        help="instrumentation sinks: stats, jsonl:PATH, prom:PATH, comma "
+                             "separated (default: $EMO_METRICS)")
     sub = parser.add_subparsers(dest="cmd")
     p_init = sub.add_parser("init")
     p_init.add_argument("--passphrase", "-p", help="passphrase for escrow")
+    p_init.add_argument("--no-key-check", action="store_true",
+                        help="accept any key, skipping the S-box / P-layer screen (emo_quality)")
     p_enc = sub.add_parser("encrypt")
     p_enc.add_argument("infile")
     p_enc.add_argument("outfile")
     p_enc.add_argument("--escrow", help="path to escrow file (default: escrow/recovery.enc)",
                        default=os.path.join(ESCROW_DIR, "recovery.enc"))
     p_enc.add_argument("--passphrase", "-p", help="passphrase to unlock escrow/key")
+    p_enc.add_argument("--engine", choices=sorted(ENGINES) + [AUTO_ENGINE], default=AUTO_ENGINE,
+                       help="block engine; auto picks the fastest for the size, see the engines "
+                            "command and $EMO_ENGINE (default: %(default)s)")
+    p_enc.add_argument("--buffer-size", type=int, default=STREAM_CHUNK_SIZE,
+                       help="streaming buffer in bytes, used with --no-mmap (default: %(default)s)")
+    p_enc.add_argument("--no-mmap", action="store_true",
+                       help="stream through a bounded buffer instead of mapping the files")
+    p_enc.add_argument("--mode", choices=sorted(MODES), default="cbc",
+                       help="cipher mode (default: %(default)s)")
+    p_enc.add_argument("--workers", "-j", type=int, default=1,
+                       help="processes for CTR keystream generation (0 = one per core)")
+    p_enc.add_argument("--segment-size", type=int, default=0,
+                       help="write a segmented container with this many plaintext bytes per "
+                            "segment, readable with read-range (default: single MAC format)")
+    p_enc.add_argument("--tree-mac", action="store_true",
+                       help="tag with a tree of per-MiB HMACs so verify/decrypt spread it over "
+                            "--workers threads")
     p_dec = sub.add_parser("decrypt")
     p_dec.add_argument("infile")
     p_dec.add_argument("outfile")
     p_dec.add_argument("--escrow", help="path to escrow file (default: escrow/recovery.enc)",
                        default=os.path.join(ESCROW_DIR, "recovery.enc"))
     p_dec.add_argument("--passphrase", "-p", help="passphrase to unlock escrow/key")
+    p_dec.add_argument("--engine", choices=sorted(ENGINES) + [AUTO_ENGINE], default=AUTO_ENGINE,
+                       help="block engine; auto picks the fastest for the size, see the engines "
+                            "command and $EMO_ENGINE (default: %(default)s)")
+    p_dec.add_argument("--buffer-size", type=int, default=STREAM_CHUNK_SIZE,
+                       help="streaming buffer in bytes, used with --no-mmap (default: %(default)s)")
+    p_dec.add_argument("--no-mmap", action="store_true",
+                       help="stream through a bounded buffer instead of mapping the files")
+    p_dec.add_argument("--workers", "-j", type=int, default=1,
+                       help="processes for CBC decryption / CTR keystream (0 = one per core)")
+    for p in (p_enc, p_dec):
+        p.add_argument("--no-agent", action="store_true",
+                       help="do not use a running key agent")
+    for name in ("encrypt-tree", "decrypt-tree"):
+        p_tree = sub.add_parser(name, help=f"{name.split('-')[0]} every file of a directory or glob")
+        p_tree.add_argument("source", help="directory or glob pattern under sandbox/")
+        p_tree.add_argument("dest", help="output directory under sandbox/")
+        p_tree.add_argument("--escrow", help="path to escrow file (default: escrow/recovery.enc)",
+                            default=os.path.join(ESCROW_DIR, "recovery.enc"))
+        p_tree.add_argument("--passphrase", "-p", help="passphrase to unlock escrow/key")
+        p_tree.add_argument("--workers", "-j", type=int, default=0,
+                            help="worker processes (default: one per core)")
+        p_tree.add_argument("--engine", choices=sorted(ENGINES), default=DEFAULT_ENGINE,
+                            help="block engine (default: %(default)s)")
+        p_tree.add_argument("--manifest", help="result manifest (default: <dest>/manifest.jsonl)")
+        p_tree.add_argument("--max-inflight-mb", type=int, default=256,
+                            help="input bytes queued to workers at once (default: %(default)s)")
+        if name == "encrypt-tree":
+            p_tree.add_argument("--mode", choices=sorted(MODES), default="cbc",
+                                help="cipher mode (default: %(default)s)")
+    p_agent = sub.add_parser("agent", help="keep the unlocked key in memory and serve requests")
+    p_agent.add_argument("--socket", help="Unix socket path (default: $EMO_AGENT_SOCKET or escrow/agent.sock)")
+    p_agent.add_argument("--escrow", help="path to escrow file (default: escrow/recovery.enc)",
+                         default=os.path.join(ESCROW_DIR, "recovery.enc"))
+    p_agent.add_argument("--passphrase", "-p", help="passphrase to unlock escrow/key")
+    p_agent.add_argument("--window-ms", type=float, default=2.0,
+                         help="time to wait for requests to batch together (default: %(default)s)")
+    p_expand = sub.add_parser("expand-key", help="save the expanded key so later runs skip key setup")
+    p_expand.add_argument("--escrow", help="path to escrow file (default: escrow/recovery.enc)",
+                          default=os.path.join(ESCROW_DIR, "recovery.enc"))
+    p_expand.add_argument("--passphrase", "-p", help="passphrase to unlock escrow/key")
+    p_expand.add_argument("--out", help="output path (default: escrow/expanded.key)")
+    p_engines = sub.add_parser("engines", help="check engines on known answers and profile them")
+    p_engines.add_argument("--save", action="store_true",
+                           help="save the profile for engine=auto (escrow/engines.json or "
+                                "$EMO_ENGINE_PROFILE)")
+    p_verify = sub.add_parser("verify", help="authenticate encrypted files without decrypting them")
+    p_verify.add_argument("files", nargs="+")
+    p_verify.add_argument("--escrow", help="path to escrow file (default: escrow/recovery.enc)",
+                          default=os.path.join(ESCROW_DIR, "recovery.enc"))
+    p_verify.add_argument("--passphrase", "-p", help="passphrase to unlock escrow/key")
+    p_verify.add_argument("--workers", "-j", type=int, default=1,
+                          help="threads for tree-MAC leaves, processes for segments (0 = one per core)")
+    p_verify.add_argument("--buffer-size", type=int, default=STREAM_CHUNK_SIZE,
+                          help="read buffer in bytes, used with --no-mmap (default: %(default)s)")
+    p_verify.add_argument("--no-mmap", action="store_true",
+                          help="read through a bounded buffer instead of mapping the files")
+    p_append = sub.add_parser("append", help="append a file to an encrypted log without re-encrypting it")
+    p_append.add_argument("infile")
+    p_append.add_argument("logfile", help="append log (created if missing)")
+    p_append.add_argument("--escrow", help="path to escrow file (default: escrow/recovery.enc)",
+                          default=os.path.join(ESCROW_DIR, "recovery.enc"))
+    p_append.add_argument("--passphrase", "-p", help="passphrase to unlock escrow/key")
+    p_append.add_argument("--engine", choices=sorted(ENGINES), default=DEFAULT_ENGINE,
+                          help="block engine (default: %(default)s)")
+    p_append.add_argument("--mode", choices=sorted(MODES), default="ctr",
+                          help="cipher mode of a new log (default: %(default)s)")
+    p_append.add_argument("--record-size", type=int, default=1 << 20,
+                          help="max plaintext bytes per record (default: %(default)s)")
+    p_append.add_argument("--recover", action="store_true",
+                          help="first repair a log left broken by an interrupted append")
+    p_range = sub.add_parser("read-range", help="decrypt a byte range of a segmented file")
+    p_range.add_argument("infile")
+    p_range.add_argument("offset", type=int)
+    p_range.add_argument("length", type=int)
+    p_range.add_argument("--out", help="write the bytes here (under sandbox/) instead of stdout")
+    p_range.add_argument("--escrow", help="path to escrow file (default: escrow/recovery.enc)",
+                         default=os.path.join(ESCROW_DIR, "recovery.enc"))
+    p_range.add_argument("--passphrase", "-p", help="passphrase to unlock escrow/key")
+    p_range.add_argument("--engine", choices=sorted(ENGINES), default=DEFAULT_ENGINE,
+                         help="block engine (default: %(default)s)")
+    p_range.add_argument("--workers", "-j", type=int, default=1,
+                         help="processes for the segments (0 = one per core)")
+    p_cal = sub.add_parser("calibrate", help="pick KDF params for a target unlock time on this host")
+    p_cal.add_argument("--kdf", choices=sorted(KDF_IDS), default="scrypt",
+                       help="key derivation function (default: %(default)s)")
+    p_cal.add_argument("--target-ms", type=float, default=500,
+                       help="target unlock time in milliseconds (default: %(default)s)")
+    p_cal.add_argument("--max-mem-mb", type=int, default=256,
+                       help="scrypt memory limit in MiB (default: %(default)s)")
+    p_cal.add_argument("--save", action="store_true",
+                       help="use these params for init and rewrap (escrow/kdf.json)")
+    p_rewrap = sub.add_parser("rewrap", help="rewrite the escrow and sandbox key with the current KDF params")
+    p_rewrap.add_argument("--escrow", help="path to escrow file (default: escrow/recovery.enc)",
+                          default=os.path.join(ESCROW_DIR, "recovery.enc"))
+    p_rewrap.add_argument("--passphrase", "-p", help="passphrase to unlock escrow")
     p_test = sub.add_parser("test")
     args = parser.parse_args()
     try:
-        if args.cmd == "init":
-            cmd_init(args)
-        elif args.cmd == "encrypt":
-            cmd_encrypt(args)
-        elif args.cmd == "decrypt":
-            cmd_decrypt(args)
-        elif args.cmd == "test":
-            cmd_test(args)
-        else:
-            parser.print_help()
+        instrument.configure(args.metrics)
+        with instrument.operation(f"cli.{args.cmd}"):
+            run_command(parser, args)
     except Exception as e:
         print("Error:", e)
+    finally:
+        instrument.disable()
+
+def run_command(parser, args):
+    if args.cmd == "init":
+        cmd_init(args)
+    elif args.cmd == "encrypt":
+        cmd_encrypt(args)
+    elif args.cmd == "decrypt":
+        cmd_decrypt(args)
+    elif args.cmd in ("encrypt-tree", "decrypt-tree"):
+        cmd_tree(args)
+    elif args.cmd == "agent":
+        cmd_agent(args)
+    elif args.cmd == "expand-key":
+        cmd_expand_key(args)
+    elif args.cmd == "read-range":
+        cmd_read_range(args)
+    elif args.cmd == "append":
+        cmd_append(args)
+    elif args.cmd == "verify":
+        cmd_verify(args)
+    elif args.cmd == "engines":
+        cmd_engines(args)
+    elif args.cmd == "calibrate":
+        cmd_calibrate(args)
+    elif args.cmd == "rewrap":
+        cmd_rewrap(args)
+    elif args.cmd == "test":
+        cmd_test(args)
+    else:
+        parser.print_help()
 
 if __name__ == "__main__":
     main()
@@ -344,81 +2372,95 @@ if __name__ == "__main__":
 # - Formato de salida: IV(16) || C || TAG(32)
 # ============================================================
 
-def emo_encrypt(message: str, key: str):
+def emo_encrypt(message: str, key: str, engine: str = AUTO_ENGINE, mode: str = "cbc",
+                workers: int = 1):
     """
     Cifra un mensaje (string) y devuelve (cipher_bytes, elapsed_seconds).
     El formato del resultado es: IV || C || TAG (HMAC-SHA256 with master key).
+    engine: motor de bloques a usar (ver ENGINES); "auto" elige el más rápido
+    para el tamaño (ver select_engine).
+    mode: "cbc" (formato original) o "ctr" (HEADER || NONCE || C || TAG, sin padding,
+    keystream generado en `workers` procesos).
     """
     from hashlib import sha256
-    t0 = time.perf_counter()
+    with instrument.operation("emo_encrypt") as op:
+        # Derivar clave maestra de 256 bits desde la passphrase/key
+        with instrument.phase("kdf"):
+            master_key = sha256(key.encode()).digest()  # 32 bytes
 
-    # Derivar clave maestra de 256 bits desde la passphrase/key
-    master_key = sha256(key.encode()).digest()  # 32 bytes
-
-    # Generar S-box, P-layer y subclaves
-    sbox, inv_sbox = sbox_gen(master_key)
-    player, inv_player = player_gen(master_key)
-    keys = key_schedule(master_key)
+        # S-box, P-layer y subclaves (contexto cacheado por clave)
+        with instrument.phase("key_setup"):
+            cipher = get_cipher(master_key)
 
-    # Preparar datos (padding PKCS7)
-    data = message.encode()
-    padded = pkcs7_pad(data)
+        # IV aleatorio, padding PKCS7 (CBC) y HMAC sobre todo lo anterior al TAG
+        data = message.encode()
+        engine = resolve_engine(engine, len(data), "ctr" if mode == "ctr" else "cbc_encrypt")
+        out = encrypt_bytes(data, cipher, mode, engine, workers)
+    return out, op.elapsed
 
-    # CBC-like: IV random
-    iv = os.urandom(16)
-    prev = iv
-    ciphertext = bytearray()
 
-    for i in range(0, len(padded), BLOCK_SIZE):
-        block = padded[i:i+BLOCK_SIZE]
-        block = xor_bytes(block, prev)
-        c = encrypt_block(block, keys, sbox, player)
-        ciphertext += c
-        prev = c
+def emo_encrypt_many(messages, key: str, engine: str = None, mode: str = "cbc"):
+    """
+    Cifra muchos mensajes (strings) con la misma clave y devuelve
+    (lista_de_cipher_bytes, elapsed_seconds), en el orden de entrada.
+    Cada resultado tiene el mismo formato que emo_encrypt; el bloque i de
+    todos los mensajes se cifra en una sola pasada del motor (ver encrypt_many).
+    """
+    from hashlib import sha256
+    with instrument.operation("emo_encrypt_many") as op:
+        with instrument.phase("kdf"):
+            master_key = sha256(key.encode()).digest()
+        with instrument.phase("key_setup"):
+            cipher = get_cipher(master_key)
+        out = encrypt_many([m.encode() for m in messages], cipher, mode, engine)
+    return out, op.elapsed
 
-    tag = hmac_sha256(master_key, iv + ciphertext)
-    out = bytes(iv + ciphertext + tag)
 
-    t1 = time.perf_counter()
-    return out, (t1 - t0)
+def emo_decrypt_many(ciphers, key: str, engine: str = None):
+    """
+    Descifra muchos mensajes con la misma clave y devuelve
+    (resultados, elapsed_seconds). Cada resultado es el texto (str) o el
+    ValueError de ese elemento (MAC inválida, padding incorrecto): un
+    elemento malo no aborta el lote.
+    """
+    from hashlib import sha256
+    with instrument.operation("emo_decrypt_many") as op:
+        with instrument.phase("kdf"):
+            master_key = sha256(key.encode()).digest()
+        with instrument.phase("key_setup"):
+            cipher = get_cipher(master_key)
+        results = decrypt_many(ciphers, cipher, engine)
+        with instrument.phase("decode"):
+            results = [r if isinstance(r, ValueError) else str(r, "utf-8", "replace") for r in results]
+    return results, op.elapsed
 
 
-def emo_decrypt(cipher_bytes: bytes, key: str):
+def emo_decrypt(cipher_bytes: bytes, key: str, engine: str = AUTO_ENGINE, workers: int = 1):
     """
-    Descifra bytes (en formato IV||C||TAG) y devuelve (plaintext_str, elapsed_seconds).
+    Descifra bytes (en formato IV||C||TAG o con cabecera CTR) y devuelve
+    (plaintext_str, elapsed_seconds).
     Lanza ValueError si MAC inválida o padding incorrecto.
+    engine: motor de bloques a usar (ver ENGINES); "numpy" descifra todos los bloques en lote,
+    "auto" elige el más rápido para el tamaño y el modo.
+    workers: procesos para descifrar rangos de bloques en paralelo (0 = uno por núcleo).
+    La MAC se verifica antes de descifrar.
     """
     from hashlib import sha256
-    t0 = time.perf_counter()
-
-    if len(cipher_bytes) < 16 + 32:
-        raise ValueError("Ciphertext demasiado corto")
-
-    master_key = sha256(key.encode()).digest()
+    with instrument.operation("emo_decrypt") as op:
+        if len(cipher_bytes) < 16 + 32:
+            raise ValueError("Ciphertext demasiado corto")
 
-    iv = cipher_bytes[:16]
-    tag = cipher_bytes[-32:]
-    ciphertext = cipher_bytes[16:-32]
+        with instrument.phase("kdf"):
+            master_key = sha256(key.encode()).digest()
 
-    # Verificar MAC
-    if hmac_sha256(master_key, iv + ciphertext) != tag:
-        raise ValueError("MAC verification failed")
-
-    # Regenerar S-box, P-layer y subclaves
-    sbox, inv_sbox = sbox_gen(master_key)
-    player, inv_player = player_gen(master_key)
-    keys = key_schedule(master_key)
-
-    prev = iv
-    plaintext_padded = bytearray()
-
-    for i in range(0, len(ciphertext), BLOCK_SIZE):
-        c = ciphertext[i:i+BLOCK_SIZE]
-        block = decrypt_block(c, keys, inv_sbox, inv_player)
-        block = xor_bytes(block, prev)
-        plaintext_padded += block
-        prev = c
+        # Contexto cacheado: S-box, P-layer, subclaves y estados HMAC
+        with instrument.phase("key_setup"):
+            cipher = get_cipher(master_key)
 
-    plaintext = pkcs7_unpad(bytes(plaintext_padded))
-    t1 = time.perf_counter()
-    return plaintext.decode(errors="replace"), (t1 - t0)
+        # Descifrar directo a un buffer y decodificar sin copias intermedias
+        engine = resolve_engine(engine, len(cipher_bytes), _decrypt_op(cipher_bytes))
+        out = bytearray(len(cipher_bytes))
+        n = decrypt_into(cipher_bytes, out, cipher, engine, workers)
+        with instrument.phase("decode"):
+            plaintext = str(memoryview(out)[:n], "utf-8", "replace")
+    return plaintext, op.elapsed
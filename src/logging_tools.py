@@ -1,68 +1,170 @@
-import matplotlib.pyplot as plt
-import numpy as np
+# Métricas y log de ejecución. numpy se importa en la primera métrica y
+# matplotlib solo en plotting_tools, así que importar este módulo es barato
+# (ver IMPORT_BUDGET_S en emo_bench).
+import os
 import time
 import math
+import mmap
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+import emo_instrument
+
+np = None  # numpy, cargado por _numpy()
+
+def _numpy():
+    global np, POPCOUNT, BYTE_BITS
+    if np is None:
+        import numpy
+        POPCOUNT = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.uint8)
+        BYTE_BITS = numpy.unpackbits(numpy.arange(256, dtype=numpy.uint8)[:, None],
+                                     axis=1).astype(numpy.int64)  # (256, 8), MSB primero
+        np = numpy
+    return np
+
+_PLOTS = ("plot_histogram", "plot_avalanche", "plot_performance_entropy")
+
+def __getattr__(name):
+    # compatibilidad: los gráficos viven en plotting_tools, las tablas se
+    # crean junto con numpy
+    if name in _PLOTS:
+        import plotting_tools
+        return getattr(plotting_tools, name)
+    if name in ("POPCOUNT", "BYTE_BITS"):
+        _numpy()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # ------------------------------------------
 # LOG BÁSICO
 # ------------------------------------------
+LOG_FILE = "execution.log"
+LOG_BATCH = 64  # líneas por escritura
+
+_log_writer = None
+
+def configure_log(path=LOG_FILE, batch=LOG_BATCH, background=False):
+    """
+    Destino de log(): las líneas se acumulan y se escriben por lotes
+    (emo_instrument.BatchWriter); background=True las escribe desde un
+    hilo aparte. Cierra el destino anterior y devuelve el nuevo.
+    """
+    global _log_writer
+    old, _log_writer = _log_writer, emo_instrument.BatchWriter(os.path.abspath(path), batch, background)
+    if old is not None:
+        old.close()
+    return _log_writer
+
+def flush_log():
+    if _log_writer is not None:
+        _log_writer.flush()
+
+def close_log():
+    global _log_writer
+    writer, _log_writer = _log_writer, None
+    if writer is not None:
+        writer.close()
+
+def _forget_log():
+    # un proceso hijo (fork) no reescribe las líneas pendientes del padre
+    global _log_writer
+    _log_writer = None
+
+atexit.register(close_log)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_log)
+
 def log(msg):
-    with open("execution.log", "a", encoding="utf-8") as f:
-        f.write(msg + "\n")
+    writer = _log_writer or configure_log()
+    writer.write(msg)
     print(msg)
 
+def format_record(record):
+    # una línea por operación: tiempo total, fases de mayor a menor y contadores
+    parts = [f"[{record['op']}] {record['elapsed']:.6f}s"]
+    for name, sec in sorted(record["phases"].items(), key=lambda kv: -kv[1]):
+        parts.append(f"{name}={sec:.6f}s")
+    parts.extend(f"{name}={n}" for name, n in sorted(record["counters"].items()))
+    if "error" in record:
+        parts.append(f"error={record['error']}")
+    return " ".join(parts)
+
+class LogSink:
+    """Sink de emo_instrument que escribe cada operación con log()."""
+    def emit(self, record):
+        log(format_record(record))
+
 # ------------------------------------------
 # MÉTRICA: TIEMPO DE EJECUCIÓN
 # ------------------------------------------
 def measure_time(func, *args, **kwargs):
-    start = time.perf_counter()
-    result = func(*args, **kwargs)
-    elapsed = time.perf_counter() - start
-    return result, elapsed
+    # con la instrumentación activa la llamada queda registrada como operación
+    with emo_instrument.operation(getattr(func, "__name__", "measure_time")) as op:
+        result = func(*args, **kwargs)
+    return result, op.elapsed
 
 # ------------------------------------------
 # MÉTRICA: ENTROPÍA DE SHANNON
 # ------------------------------------------
-def compute_entropy(data: bytes):
-    if not data:
-        return 0.0
-
-    freq = [0] * 256
-    for b in data:
-        freq[b] += 1
+def _as_array(data):
+    # bytes, bytearray, memoryview, mmap o array -> vista uint8 sin copiar
+    _numpy()
+    if isinstance(data, np.ndarray):
+        return data.reshape(-1).view(np.uint8)
+    return np.frombuffer(data, dtype=np.uint8)
 
-    entropy = 0
-    n = len(data)
+def byte_histogram(data):
+    """Frecuencia de cada valor 0-255 (np.bincount)."""
+    arr = _as_array(data)  # carga numpy antes de usar np
+    return np.bincount(arr, minlength=256)
 
-    for f in freq:
-        if f > 0:
-            p = f / n
-            entropy -= p * math.log2(p)
+def entropy_from_counts(counts):
+    _numpy()
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum()
+    if n == 0:
+        return 0.0
+    p = counts[counts > 0] / n
+    return float(-(p * np.log2(p)).sum())
 
+def compute_entropy(data: bytes):
+    if not data:
+        return 0.0
+    entropy = entropy_from_counts(byte_histogram(data))
     log(f"Entropía: {entropy:.4f} bits por byte")
     return entropy
 
 def compute_entropy_value(data: bytes):
     if not data:
         return 0.0
-    freq = [0] * 256
-    for b in data:
-        freq[b] += 1
-    entropy = 0
-    n = len(data)
-    for f in freq:
-        if f > 0:
-            p = f / n
-            entropy -= p * math.log2(p)
-    return entropy
+    return entropy_from_counts(byte_histogram(data))
+
+def chi_square_from_counts(counts):
+    """
+    Chi-cuadrado de las frecuencias contra la distribución uniforme
+    (255 grados de libertad) y su p-valor aproximado (Wilson-Hilferty).
+    """
+    _numpy()
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum()
+    if n == 0:
+        return 0.0, 1.0
+    expected = n / len(counts)
+    chi2 = float(((counts - expected) ** 2 / expected).sum())
+    k = len(counts) - 1
+    z = ((chi2 / k) ** (1 / 3) - (1 - 2 / (9 * k))) / math.sqrt(2 / (9 * k))
+    return chi2, 0.5 * math.erfc(z / math.sqrt(2))
 
 # ------------------------------------------
 # MÉTRICA: DISTANCIA DE AVALANCHA (bits distintos)
 # ------------------------------------------
+def bit_distance(c1, c2):
+    """Bits distintos entre c1 y c2 (hasta el más corto), popcount vectorizado."""
+    a, b = _as_array(c1), _as_array(c2)
+    n = min(len(a), len(b))
+    return int(POPCOUNT[a[:n] ^ b[:n]].sum(dtype=np.int64))
+
 def avalanche_distance(c1: bytes, c2: bytes):
-    dist = 0
-    for b1, b2 in zip(c1, c2):
-        dist += bin(b1 ^ b2).count("1")
+    dist = bit_distance(c1, c2)
 
     total_bits = len(c1) * 8
     percentage = (dist / total_bits) * 100 if total_bits > 0 else 0
@@ -70,58 +172,131 @@ def avalanche_distance(c1: bytes, c2: bytes):
     log(f"Avalancha (bits diferentes): {dist} ({percentage:.2f}%)")
     return dist, percentage
 
-
 # ------------------------------------------
-# GRÁFICO 1: HISTOGRAMA DE BYTES
+# MÉTRICAS EN STREAMING (archivos grandes, mmap)
 # ------------------------------------------
-def plot_histogram(data):
-    # Convertir bytes a enteros para evitar errores de unicode
-    if isinstance(data, (bytes, bytearray)):
-        data = list(data)
+STATS_BLOCK = 16  # el sesgo por bit se mide por posición dentro del bloque de 128 bits
+STATS_CHUNK = 16 * 1024 * 1024
 
-    plt.figure()
-    plt.hist(data, bins=256)
-    plt.title("Histograma de Valores del Cifrado")
-    plt.xlabel("Valor (0-255)")
-    plt.ylabel("Frecuencia")
-    plt.tight_layout()
-    plt.savefig("histograma.png")
-    plt.close()
+class ByteStats:
+    """
+    Estadísticas acumulables de un flujo de bytes: histograma, y unos por
+    cada uno de los 128 bits del bloque. update() recibe trozos
+    consecutivos de cualquier tamaño; merge() suma parciales de otros
+    rangos (p. ej. calculados por otro proceso). offset: posición del
+    primer byte en el flujo, para saber en qué byte del bloque cae.
+    """
+    def __init__(self, offset=0):
+        _numpy()
+        self.offset = offset
+        self.counts = np.zeros(256, dtype=np.int64)
+        self.ones = np.zeros(STATS_BLOCK * 8, dtype=np.int64)
+        self.per_bit = np.zeros(STATS_BLOCK * 8, dtype=np.int64)  # bits vistos por posición
+        self.n = 0
 
+    def update(self, chunk):
+        arr = _as_array(chunk)
+        if not len(arr):
+            return self
+        start = self.offset + self.n
+        for pos in range(STATS_BLOCK):
+            # histograma de los bytes en esta posición del bloque; sus unos
+            # por bit salen de la tabla BYTE_BITS sin expandir los bits
+            c = np.bincount(arr[(pos - start) % STATS_BLOCK::STATS_BLOCK], minlength=256)
+            self.counts += c
+            self.ones[pos*8:pos*8+8] += c @ BYTE_BITS
+            self.per_bit[pos*8:pos*8+8] += c.sum()
+        self.n += len(arr)
+        return self
 
-# ------------------------------------------
-# GRÁFICO 2: AVALANCHA (BARRA)
-# ------------------------------------------
-def plot_avalanche(values):
-    plt.figure(figsize=(6,4))
-    plt.bar(range(len(values)), values)
-    plt.title("Avalancha")
-    plt.xlabel("Prueba")
-    plt.ylabel("Bits cambiados")
-    outfile = "avalancha.png"
-    plt.savefig(outfile)
-    plt.close()
-    log(f"Gráfico guardado: {outfile}")
-
-def plot_performance_entropy(perf_rows, entropy_rows, outfile="perf_entropy.png"):
-    fig, axs = plt.subplots(1, 2, figsize=(14, 6))
-    axs[0].axis('off')
-    axs[1].axis('off')
-    perf_cols = ["Tamaño", "Cifrado (s)", "Descifrado (s)", "KB/s cifrado", "KB/s descifrado"]
-    perf_cells = [[f"{r[0]}", f"{r[1]:.6f}", f"{r[2]:.6f}", f"{r[3]:.2f}", f"{r[4]:.2f}"] for r in perf_rows]
-    t1 = axs[0].table(cellText=perf_cells, colLabels=perf_cols, loc='center', colWidths=[0.2,0.2,0.2,0.2,0.2])
-    t1.auto_set_font_size(False)
-    t1.set_fontsize(12)
-    t1.scale(1.2, 1.6)
-    axs[0].set_title("Performance")
-    ent_cols = ["Tamaño", "Entropía (bits/byte)"]
-    ent_cells = [[f"{r[0]}", f"{r[1]:.4f}"] for r in entropy_rows]
-    t2 = axs[1].table(cellText=ent_cells, colLabels=ent_cols, loc='center', colWidths=[0.3,0.7])
-    t2.auto_set_font_size(False)
-    t2.set_fontsize(12)
-    t2.scale(1.2, 1.6)
-    axs[1].set_title("Entropía")
-    plt.tight_layout()
-    plt.savefig(outfile, dpi=300)
-    plt.close()
-    log(f"Gráfico guardado: {outfile}")
+    def merge(self, other):
+        self.counts += other.counts
+        self.ones += other.ones
+        self.per_bit += other.per_bit
+        self.n += other.n
+        return self
+
+    def entropy(self):
+        return entropy_from_counts(self.counts)
+
+    def chi_square(self):
+        return chi_square_from_counts(self.counts)
+
+    def bit_bias(self):
+        """P(bit = 1) - 0.5 por posición de bit dentro del bloque."""
+        return np.where(self.per_bit > 0, self.ones / np.maximum(self.per_bit, 1) - 0.5, 0.0)
+
+    def to_dict(self):
+        chi2, p_value = self.chi_square()
+        bias = self.bit_bias()
+        return {"bytes": self.n, "entropy": self.entropy(), "chi2": chi2, "chi2_p": p_value,
+                "max_bit_bias": float(np.abs(bias).max()), "bit_bias": bias.tolist()}
+
+class AvalancheStats:
+    """Distancia de bits acumulable entre dos flujos alineados."""
+    def __init__(self):
+        self.diff = 0
+        self.bits = 0
+
+    def update(self, a, b):
+        self.diff += bit_distance(a, b)
+        self.bits += min(len(a), len(b)) * 8
+        return self
+
+    def merge(self, other):
+        self.diff += other.diff
+        self.bits += other.bits
+        return self
+
+    def percentage(self):
+        return self.diff / self.bits * 100 if self.bits else 0.0
+
+def _file_ranges(size, workers, chunk_size):
+    # rangos contiguos alineados a chunk_size, al menos uno por worker
+    per = max(chunk_size, -(-size // max(1, workers)))
+    per -= per % STATS_BLOCK
+    return [(a, min(a + per, size)) for a in range(0, size, per)]
+
+def _range_stats(path, start, end, chunk_size):
+    # un proceso: mmap del archivo y recorrido por trozos, memoria acotada
+    stats = ByteStats(start)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for a in range(start, end, chunk_size):
+            view = memoryview(mm)[a:min(a + chunk_size, end)]
+            stats.update(view)
+            view.release()
+    return stats
+
+def file_stats(path, workers=1, chunk_size=STATS_CHUNK):
+    """
+    ByteStats de un archivo completo sin cargarlo en memoria: cada rango
+    se mapea y recorre por trozos; con workers > 1 los rangos se procesan
+    en paralelo y los parciales se combinan.
+    """
+    size = os.path.getsize(path)
+    total = ByteStats()
+    if size == 0:
+        return total
+    chunk_size = max(STATS_BLOCK, chunk_size - chunk_size % STATS_BLOCK)
+    ranges = _file_ranges(size, workers, chunk_size)
+    if workers <= 1 or len(ranges) == 1:
+        parts = [_range_stats(path, a, b, chunk_size) for a, b in ranges]
+    else:
+        with ProcessPoolExecutor(min(workers, len(ranges))) as pool:
+            parts = list(pool.map(_range_stats, [path] * len(ranges),
+                                  [a for a, _ in ranges], [b for _, b in ranges],
+                                  [chunk_size] * len(ranges)))
+    for part in parts:
+        total.merge(part)
+    return total
+
+def file_avalanche(path1, path2, chunk_size=STATS_CHUNK):
+    """AvalancheStats entre dos archivos, leídos por trozos."""
+    stats = AvalancheStats()
+    with open(path1, "rb") as f1, open(path2, "rb") as f2:
+        while True:
+            a, b = f1.read(chunk_size), f2.read(chunk_size)
+            if not a or not b:
+                break
+            stats.update(a, b)
+    return stats
@@ -0,0 +1,75 @@
+# ------------------------------------------
+# GRÁFICOS (opcional)
+# matplotlib se importa en el primer gráfico, con el backend Agg (sin
+# pantalla), así que importar este módulo o logging_tools no lo carga.
+# ------------------------------------------
+from logging_tools import log, byte_histogram, ByteStats
+
+_plt = None
+
+def _pyplot():
+    global _plt
+    if _plt is None:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
+
+# ------------------------------------------
+# GRÁFICO 1: HISTOGRAMA DE BYTES
+# ------------------------------------------
+def plot_histogram(data):
+    # bytes/mmap/array -> bincount; también acepta un ByteStats ya acumulado
+    plt = _pyplot()
+    counts = data.counts if isinstance(data, ByteStats) else byte_histogram(
+        data if not isinstance(data, list) else bytes(data))
+
+    plt.figure()
+    plt.bar(range(256), counts, width=1.0)
+    plt.title("Histograma de Valores del Cifrado")
+    plt.xlabel("Valor (0-255)")
+    plt.ylabel("Frecuencia")
+    plt.tight_layout()
+    plt.savefig("histograma.png")
+    plt.close()
+
+
+# ------------------------------------------
+# GRÁFICO 2: AVALANCHA (BARRA)
+# ------------------------------------------
+def plot_avalanche(values):
+    plt = _pyplot()
+    plt.figure(figsize=(6,4))
+    plt.bar(range(len(values)), values)
+    plt.title("Avalancha")
+    plt.xlabel("Prueba")
+    plt.ylabel("Bits cambiados")
+    outfile = "avalancha.png"
+    plt.savefig(outfile)
+    plt.close()
+    log(f"Gráfico guardado: {outfile}")
+
+def plot_performance_entropy(perf_rows, entropy_rows, outfile="perf_entropy.png"):
+    plt = _pyplot()
+    fig, axs = plt.subplots(1, 2, figsize=(14, 6))
+    axs[0].axis('off')
+    axs[1].axis('off')
+    perf_cols = ["Tamaño", "Cifrado (s)", "Descifrado (s)", "KB/s cifrado", "KB/s descifrado"]
+    perf_cells = [[f"{r[0]}", f"{r[1]:.6f}", f"{r[2]:.6f}", f"{r[3]:.2f}", f"{r[4]:.2f}"] for r in perf_rows]
+    t1 = axs[0].table(cellText=perf_cells, colLabels=perf_cols, loc='center', colWidths=[0.2,0.2,0.2,0.2,0.2])
+    t1.auto_set_font_size(False)
+    t1.set_fontsize(12)
+    t1.scale(1.2, 1.6)
+    axs[0].set_title("Performance")
+    ent_cols = ["Tamaño", "Entropía (bits/byte)"]
+    ent_cells = [[f"{r[0]}", f"{r[1]:.4f}"] for r in entropy_rows]
+    t2 = axs[1].table(cellText=ent_cells, colLabels=ent_cols, loc='center', colWidths=[0.3,0.7])
+    t2.auto_set_font_size(False)
+    t2.set_fontsize(12)
+    t2.scale(1.2, 1.6)
+    axs[1].set_title("Entropía")
+    plt.tight_layout()
+    plt.savefig(outfile, dpi=300)
+    plt.close()
+    log(f"Gráfico guardado: {outfile}")
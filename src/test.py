@@ -1,9 +1,6 @@
 from emo_spn import emo_encrypt, emo_decrypt
-from logging_tools import (
-    log, avalanche_distance,
-    plot_histogram, plot_avalanche,
-    compute_entropy_value, plot_performance_entropy
-)
+from logging_tools import log, avalanche_distance, compute_entropy_value
+from plotting_tools import plot_histogram, plot_avalanche, plot_performance_entropy
 
 # ------------------------------
 # PRUEBA DE CIFRADO Y DESCIFRADO
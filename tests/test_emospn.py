@@ -1,16 +1,31 @@
+import argparse
 import os
+import socket
 import sys
+import tempfile
+import threading
 
 # Agregar la ruta del proyecto/src al PYTHONPATH
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
 sys.path.append(BASE_DIR)
 
 import unittest
-from emo_spn import emo_encrypt, emo_decrypt
+from unittest import mock
+import emo_spn
+from emo_spn import (
+    emo_encrypt, emo_decrypt,
+    sbox_gen, player_gen, key_schedule, encrypt_block, decrypt_block,
+    build_tables, encrypt_block_fast, decrypt_block_fast,
+    get_cipher, hmac_sha256, ENGINES, cbc_decrypt_parallel,
+    encrypt_file, decrypt_file,
+    encrypt_into, decrypt_into, encrypted_size,
+    configure_cipher_cache, cipher_cache_stats, clear_cipher_cache
+)
 from logging_tools import (
-    compute_entropy, avalanche_distance,
-    plot_histogram, plot_avalanche
+    compute_entropy, compute_entropy_value, avalanche_distance,
+    ByteStats, file_stats, bit_distance
 )
+from plotting_tools import plot_histogram, plot_avalanche
 
 class TestEmoSPN(unittest.TestCase):
 
@@ -33,6 +48,17 @@ class TestEmoSPN(unittest.TestCase):
         self.assertGreater(ent, 5.0,
                            "La entropía es demasiado baja; puede haber patrón.")
 
+        # en un intérprete nuevo numpy aún no está cargado: el orden de los
+        # tests no puede esconder una métrica que lo use antes de cargarlo
+        import subprocess
+        code = ("import logging_tools as lt, plotting_tools as pt; "
+                "print(lt.compute_entropy_value(b'hello world')); "
+                "print(lt.bit_distance(b'a', b'b'))")
+        out = subprocess.run([sys.executable, "-c", code], cwd=BASE_DIR,
+                             capture_output=True, text=True, check=True).stdout.split()
+        self.assertAlmostEqual(float(out[0]), compute_entropy_value(b"hello world"))
+        self.assertEqual(out[1], "2")
+
     def test_avalanche_effect(self):
         cifrado1, _ = emo_encrypt(self.msg, self.key)
         cifrado2, _ = emo_encrypt(self.msg_mod, self.key)
@@ -48,6 +74,767 @@ class TestEmoSPN(unittest.TestCase):
             f"Avalancha insuficiente: {pct*100:.2f}% ({bits} bits cambiados)"
         )
 
+    def test_table_engine_matches_reference(self):
+        master_key = bytes(range(32))
+        sbox, inv_sbox = sbox_gen(master_key)
+        player, inv_player = player_gen(master_key)
+        keys = key_schedule(master_key)
+        tables = build_tables(sbox, inv_sbox, player, inv_player, keys)
+
+        for i in range(8):
+            block = bytes((i * 37 + j) % 256 for j in range(16))
+            c = encrypt_block(block, keys, sbox, player)
+            self.assertEqual(encrypt_block_fast(block, tables), c)
+            self.assertEqual(decrypt_block_fast(c, tables), block)
+            self.assertEqual(decrypt_block(c, keys, inv_sbox, inv_player), block)
+
+    def test_key_expansion_and_expanded_key_file(self):
+        import hashlib
+        master_key = bytes(range(32))
+        sbox, inv_sbox, player, inv_player, keys = emo_spn.expand_key(master_key)
+        digest = hashlib.sha256(sbox + inv_sbox + bytes(player) + bytes(inv_player) + b"".join(keys))
+        self.assertEqual(digest.hexdigest(),
+                         "b3a805d75462f36befd1272c72914eb5141d28a33e29dafbc5a99e85f3253aab")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "expanded.key")
+            cipher = emo_spn.EmoCipher(master_key)
+            emo_spn.save_expanded_key(cipher, path)
+            loaded = emo_spn.load_expanded_key(master_key, path)
+            self.assertEqual(loaded.tables, cipher.tables)
+            with self.assertRaises(ValueError):
+                emo_spn.load_expanded_key(bytes(32), path)
+            self.assertFalse(emo_spn.preload_cipher(bytes(32), path))
+
+    def test_escrow_versions(self):
+        import hashlib
+        master_key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as tmp:
+            # version 1: SALT || key ^ PBKDF2(200000) || HMAC, as older init wrote it
+            legacy = os.path.join(tmp, "legacy.enc")
+            salt = bytes(16)
+            dk = hashlib.pbkdf2_hmac("sha256", b"pw", salt, 200000, dklen=32)
+            blob = bytes(a ^ b for a, b in zip(master_key, dk))
+            with open(legacy, "wb") as f:
+                f.write(salt + blob + hmac_sha256(dk, salt + blob))
+            self.assertEqual(emo_spn.recover_from_escrow("pw", legacy), master_key)
+
+            params = [{"kdf": "pbkdf2", "iterations": 1000},
+                      {"kdf": "scrypt", "n": 1024, "r": 8, "p": 1}]
+            for p in params:
+                paths = [os.path.join(tmp, f"{p['kdf']}{i}.enc") for i in range(2)]
+                emo_spn.create_escrows(master_key, "pw", paths, p)
+                for path in paths:
+                    with open(path, "rb") as f:
+                        self.assertEqual(emo_spn.escrow_params(f.read()), p)
+                    self.assertEqual(emo_spn.recover_from_escrow("pw", path), master_key)
+                    with self.assertRaises(ValueError):
+                        emo_spn.recover_from_escrow("wrong", path)
+
+            # a rewrite that dies before the rename leaves the old escrow intact
+            path = paths[0]
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            with mock.patch("os.replace", side_effect=OSError("disk full")):
+                with self.assertRaises(OSError):
+                    emo_spn.create_escrow(bytes(32), "new", path, params[0])
+            self.assertEqual(emo_spn.recover_from_escrow("pw", path), master_key)
+            self.assertFalse(os.path.exists(path + ".tmp"))
+
+            for kdf in ("pbkdf2", "scrypt"):
+                p, seconds = emo_spn.calibrate_kdf(kdf, target=0.02)
+                self.assertEqual(p["kdf"], kdf)
+                self.assertLess(seconds, 1.0)
+            path = emo_spn.save_kdf_params(p, os.path.join(tmp, "kdf.json"))
+            self.assertEqual(emo_spn.load_kdf_params(path), p)
+
+    def test_cipher_cache(self):
+        clear_cipher_cache()
+        configure_cipher_cache(max_entries=2)
+        try:
+            keys = [bytes([i]) * 32 for i in range(3)]
+            first = get_cipher(keys[0])
+            self.assertIs(get_cipher(keys[0]), first)
+            get_cipher(keys[1])
+            get_cipher(keys[2])
+            stats = cipher_cache_stats()
+            self.assertEqual((stats["hits"], stats["misses"]), (1, 3))
+            self.assertEqual((stats["entries"], stats["evictions"]), (2, 1))
+            self.assertEqual(first.hmac(b"data"), hmac_sha256(keys[0], b"data"))
+        finally:
+            configure_cipher_cache(max_entries=256)
+            clear_cipher_cache()
+
+    def test_engine_registry(self):
+        kat = emo_spn.check_engines()
+        for name in emo_spn.available_engines():
+            self.assertIsNone(kat[name], name)
+
+        profile = {"version": emo_spn.ENGINE_PROFILE_VERSION, "kat": {},
+                   "models": {op: {"table": [0.0, 1e-6], "numpy": [1e-3, 1e-8]}
+                              for op in emo_spn.ENGINE_OPS}}
+        self.assertEqual(emo_spn.select_engine(64, "ctr", profile), "table")
+        self.assertEqual(emo_spn.select_engine(1 << 20, "cbc_decrypt", profile), "numpy")
+        self.assertEqual(emo_spn.select_engine(1 << 20, "cbc_encrypt", profile), "table")
+        self.assertEqual(emo_spn.resolve_engine("reference", 1 << 20), "reference")
+
+        old_env = os.environ.pop(emo_spn.ENGINE_ENV, None)
+        try:
+            os.environ[emo_spn.ENGINE_ENV] = "reference"
+            self.assertEqual(emo_spn.resolve_engine("auto", 1 << 20), "reference")
+            os.environ[emo_spn.ENGINE_ENV] = "nope"
+            with self.assertRaises(ValueError):
+                emo_spn.resolve_engine(None, 16)
+        finally:
+            os.environ.pop(emo_spn.ENGINE_ENV, None)
+            if old_env is not None:
+                os.environ[emo_spn.ENGINE_ENV] = old_env
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "engines.json")
+            measured = emo_spn.measure_engines(("table",))
+            self.assertEqual(set(measured["models"]), set(emo_spn.ENGINE_OPS))
+            emo_spn.save_engine_profile(measured, path)
+            self.assertEqual(emo_spn.load_engine_profile(path), measured)
+            self.assertIsNone(emo_spn.load_engine_profile(os.path.join(tmp, "missing.json")))
+            profile["models"]["ctr"]["gone"] = [0, 0]
+            emo_spn.save_engine_profile(profile, path)
+            self.assertIsNone(emo_spn.load_engine_profile(path))
+
+            emo_spn.set_engine_profile(measured)
+            try:
+                for mode in ("cbc", "ctr"):
+                    blob, _ = emo_encrypt(self.msg * 200, self.key, mode=mode)
+                    self.assertEqual(emo_decrypt(blob, self.key)[0], self.msg * 200)
+            finally:
+                emo_spn.set_engine_profile(None)
+
+        # the engines command checks each engine's known answers once
+        import contextlib, io
+        checked = []
+        check = emo_spn.check_engines
+
+        def counting(names=None):
+            checked.extend(names or emo_spn.ENGINES)
+            return check(names)
+
+        with mock.patch.object(emo_spn, "check_engines", counting), \
+                contextlib.redirect_stdout(io.StringIO()) as out:
+            emo_spn.cmd_engines(argparse.Namespace(save=False))
+        self.assertEqual(sorted(checked), sorted(emo_spn.ENGINES))
+        self.assertIn("reference  OK", out.getvalue())
+
+    def test_engines_match_reference(self):
+        cipher = get_cipher(bytes(range(32)))
+        data = bytes(range(256)) * 3
+        iv = bytes(16)
+        expected = cipher.encrypt_blocks(data, "reference")
+        for engine in ENGINES:
+            self.assertEqual(cipher.encrypt_blocks(data, engine), expected, engine)
+            self.assertEqual(cipher.decrypt_blocks(expected, engine), data, engine)
+            ct = cipher.cbc_encrypt(data, iv, engine)
+            self.assertEqual(ct, cipher.cbc_encrypt(data, iv), engine)
+            self.assertEqual(cipher.cbc_decrypt(ct, iv, engine), data, engine)
+
+        cifrado, _ = emo_encrypt(self.msg, self.key, engine="numpy")
+        descifrado, _ = emo_decrypt(cifrado, self.key, engine="numpy")
+        self.assertEqual(descifrado, self.msg)
+
+    def test_bitslice_engine(self):
+        cipher = get_cipher(bytes(range(32)))
+        data = os.urandom(16 * 300)
+        expected = cipher.encrypt_blocks(data, "table")
+        for lanes in (1, 64, 128, 512):
+            self.assertEqual(emo_spn.bitslice_encrypt_blocks(data, cipher, lanes), expected, lanes)
+            self.assertEqual(emo_spn.bitslice_decrypt_blocks(expected, cipher, lanes), data, lanes)
+        planes, n = emo_spn.bitslice_load(data)
+        self.assertEqual((len(planes), n), (128, 300))
+        self.assertEqual(emo_spn.bitslice_store(planes, n), data)
+        nonce = bytes(range(16))
+        self.assertEqual(emo_spn.ctr_keystream(cipher, nonce, 5, 70, "bitslice"),
+                         emo_spn.ctr_keystream(cipher, nonce, 5, 70, "table"))
+
+    def test_many_messages(self):
+        mensajes = ["", "a", "x" * 15, "y" * 16, self.msg * 20, self.msg_mod]
+        for mode in ("cbc", "ctr"):
+            for engine in (None, "table", "bitslice"):
+                cifrados, _ = emo_spn.emo_encrypt_many(mensajes, self.key, engine, mode)
+                self.assertEqual([emo_decrypt(c, self.key)[0] for c in cifrados], mensajes)
+                cifrados[2] = cifrados[2][:-1] + bytes([cifrados[2][-1] ^ 1])
+                cifrados.append(b"corto")
+                resultados, _ = emo_spn.emo_decrypt_many(cifrados, self.key, engine)
+                self.assertIsInstance(resultados[2], ValueError)
+                self.assertIsInstance(resultados[-1], ValueError)
+                self.assertEqual(resultados[:2] + resultados[3:-1], mensajes[:2] + mensajes[3:])
+
+    def test_parallel_cbc_decrypt(self):
+        cipher = get_cipher(bytes(range(32)))
+        data = bytes(range(256)) * 8
+        iv = bytes(16)
+        ct = cipher.cbc_encrypt(data, iv)
+        old = emo_spn.PARALLEL_MIN_BLOCKS
+        emo_spn.PARALLEL_MIN_BLOCKS = 8
+        try:
+            for engine in ("table", "numpy"):
+                self.assertEqual(cbc_decrypt_parallel(cipher, ct, iv, 2, engine), data)
+        finally:
+            emo_spn.PARALLEL_MIN_BLOCKS = old
+
+    def test_ctr_mode(self):
+        cifrado, _ = emo_encrypt(self.msg, self.key, mode="ctr")
+        self.assertEqual(len(cifrado), 8 + 16 + len(self.msg) + 32)
+        descifrado, _ = emo_decrypt(cifrado, self.key, engine="numpy")
+        self.assertEqual(descifrado, self.msg)
+
+        alterado = bytearray(cifrado)
+        alterado[30] ^= 1
+        with self.assertRaises(ValueError):
+            emo_decrypt(bytes(alterado), self.key)
+
+    def test_buffer_api(self):
+        cipher = get_cipher(bytes(range(32)))
+        data = bytearray(os.urandom(100))
+        for mode in ("cbc", "ctr"):
+            out = bytearray(encrypted_size(len(data), mode))
+            n = encrypt_into(memoryview(data), out, cipher, mode)
+            self.assertEqual(n, len(out))
+            plain = bytearray(len(out))
+            m = decrypt_into(out, plain, cipher)
+            self.assertEqual(plain[:m], data)
+        with self.assertRaises(ValueError):
+            encrypt_into(data, bytearray(10), cipher)
+
+    @unittest.skipUnless(hasattr(__import__("socket"), "AF_UNIX"), "requires Unix sockets")
+    def test_key_agent(self):
+        import emo_agent
+        master_key = bytes(range(32))
+        cipher = get_cipher(master_key)
+        with tempfile.TemporaryDirectory() as tmp:
+            server = emo_agent.AgentServer(os.path.join(tmp, "agent.sock"), master_key)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                with emo_agent.find_agent(server.path) as client:
+                    for mode in ("cbc", "ctr"):
+                        blob = client.encrypt(b"Hola EMO-SPN", mode)
+                        self.assertEqual(emo_spn.decrypt_bytes(blob, cipher), b"Hola EMO-SPN")
+                        self.assertEqual(client.decrypt(blob), b"Hola EMO-SPN")
+                        self.assertTrue(client.verify(blob))
+                        self.assertFalse(client.verify(blob[:-1] + bytes([blob[-1] ^ 1])))
+                # the CLI only hands work to the agent when no key material is named
+                infile = os.path.join(tmp, "in.bin")
+                with open(infile, "wb") as f:
+                    f.write(b"Hola EMO-SPN")
+                default = os.path.join(emo_spn.ESCROW_DIR, "recovery.enc")
+                old_env = os.environ.get(emo_agent.AGENT_SOCKET_ENV)
+                os.environ[emo_agent.AGENT_SOCKET_ENV] = server.path
+                try:
+                    for escrow, passphrase, used in ((default, None, True), (default, "x", False),
+                                                     (os.path.join(tmp, "other.enc"), None, False)):
+                        args = argparse.Namespace(no_agent=False, escrow=escrow, passphrase=passphrase)
+                        agent = emo_spn._agent_for(args, infile)
+                        self.assertEqual(agent is not None, used)
+                        if agent:
+                            agent.close()
+                finally:
+                    os.environ.pop(emo_agent.AGENT_SOCKET_ENV)
+                    if old_env is not None:
+                        os.environ[emo_agent.AGENT_SOCKET_ENV] = old_env
+                # a second agent leaves a live socket alone
+                with self.assertRaises(FileExistsError):
+                    emo_agent.AgentServer(server.path, master_key)
+                with emo_agent.find_agent(server.path) as client:
+                    self.assertIn("requests", client.ping())
+            finally:
+                server.shutdown()
+                server.server_close()
+            # but replaces a stale one
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stale.bind(server.path)
+            stale.close()
+            server = emo_agent.AgentServer(server.path, master_key)
+            server.server_close()
+
+    def test_tree_commands_resume(self):
+        import emo_bulk
+        master_key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as tmp:
+            old = emo_spn.SANDBOX_DIR
+            emo_spn.SANDBOX_DIR = tmp
+            try:
+                src = os.path.join(tmp, "in")
+                os.makedirs(os.path.join(src, "sub"))
+                for name in ("a.txt", os.path.join("sub", "b.txt")):
+                    with open(os.path.join(src, name), "wb") as f:
+                        f.write(name.encode() * 10)
+                out = os.path.join(tmp, "out")
+                back = os.path.join(tmp, "back")
+                counts = emo_bulk.process_tree("encrypt", src, out, master_key, workers=1)
+                self.assertEqual(counts, {"ok": 2, "skipped": 0, "error": 0})
+                counts = emo_bulk.process_tree("encrypt", src, out, master_key, workers=1)
+                self.assertEqual(counts, {"ok": 0, "skipped": 2, "error": 0})
+                emo_bulk.process_tree("decrypt", os.path.join(out, "**", "*.enc"), back,
+                                      master_key, workers=1)
+                with open(os.path.join(back, "sub", "b.txt"), "rb") as f:
+                    self.assertEqual(f.read(), b"sub/b.txt" * 10)
+            finally:
+                emo_spn.SANDBOX_DIR = old
+
+    def test_streaming_file_roundtrip(self):
+        master_key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as tmp:
+            old = emo_spn.SANDBOX_DIR
+            emo_spn.SANDBOX_DIR = tmp
+            try:
+                src = os.path.join(tmp, "in.bin")
+                enc = os.path.join(tmp, "in.enc")
+                dec = os.path.join(tmp, "in.dec")
+                for mode in ("ctr", "cbc"):
+                    for size in (0, 16, 100, 1000):
+                        data = os.urandom(size)
+                        with open(src, "wb") as f:
+                            f.write(data)
+                        encrypt_file(src, enc, master_key, chunk_size=32, mode=mode)
+                        decrypt_file(enc, dec, master_key, chunk_size=48)
+                        with open(dec, "rb") as f:
+                            self.assertEqual(f.read(), data)
+                        decrypt_file(enc, dec, master_key, use_mmap=True)
+                        with open(dec, "rb") as f:
+                            self.assertEqual(f.read(), data)
+
+                with open(enc, "r+b") as f:
+                    f.seek(20)
+                    b = f.read(1)
+                    f.seek(20)
+                    f.write(bytes([b[0] ^ 1]))
+                os.remove(dec)
+                with self.assertRaises(ValueError):
+                    decrypt_file(enc, dec, master_key)
+                self.assertFalse(os.path.exists(dec))
+            finally:
+                emo_spn.SANDBOX_DIR = old
+
+    def test_tree_mac_and_verify(self):
+        master_key = bytes(range(32))
+        cipher = get_cipher(master_key)
+        data = os.urandom(1000)
+        whole = emo_spn.TreeMac(cipher, leaf_size=64)
+        whole.update(data)
+        tag = whole.digest()
+        pieces = emo_spn.TreeMac(cipher, workers=3, leaf_size=64)
+        for a in range(0, 1000, 37):
+            pieces.update(data[a:a+37])
+        self.assertEqual(pieces.digest(), tag)
+        self.assertNotEqual(tag, cipher.hmac(data))
+
+        old_leaf, emo_spn.TREE_LEAF_SIZE = emo_spn.TREE_LEAF_SIZE, 64
+        with tempfile.TemporaryDirectory() as tmp:
+            old = emo_spn.SANDBOX_DIR
+            emo_spn.SANDBOX_DIR = tmp
+            try:
+                src = os.path.join(tmp, "in.bin")
+                enc = os.path.join(tmp, "in.enc")
+                dec = os.path.join(tmp, "in.dec")
+                with open(src, "wb") as f:
+                    f.write(data)
+                for mode in ("ctr", "cbc"):
+                    for tree, use_mmap in ((False, False), (True, False), (True, True)):
+                        encrypt_file(src, enc, master_key, chunk_size=48, mode=mode,
+                                     tree_mac=tree, use_mmap=use_mmap)
+                        self.assertEqual(emo_spn.parse_header(open(enc, "rb").read(8)) is not None,
+                                         tree or mode == "ctr")
+                        for workers in (1, 2):
+                            emo_spn.verify_file(enc, master_key, workers=workers)
+                            emo_spn.verify_file(enc, master_key, workers=workers, chunk_size=32,
+                                                use_mmap=False)
+                        decrypt_file(enc, dec, master_key, chunk_size=32, workers=2)
+                        with open(dec, "rb") as f:
+                            self.assertEqual(f.read(), data)
+                    blob = emo_spn.encrypt_bytes(data, cipher, mode, tree_mac=True)
+                    self.assertTrue(emo_spn.verify_bytes(blob, cipher, workers=2))
+                    self.assertEqual(emo_spn.decrypt_bytes(blob, cipher), data)
+                    self.assertEqual(emo_spn.decrypt_many([blob], cipher), [data])
+
+                with open(enc, "r+b") as f:
+                    f.seek(500)
+                    b = f.read(1)
+                    f.seek(500)
+                    f.write(bytes([b[0] ^ 1]))
+                for use_mmap in (True, False):
+                    with self.assertRaises(ValueError):
+                        emo_spn.verify_file(enc, master_key, use_mmap=use_mmap)
+
+                encrypt_file(src, enc, master_key, segment_size=256)
+                emo_spn.verify_file(enc, master_key)
+                import emo_append
+                log = os.path.join(tmp, "log.enc")
+                emo_append.append(log, data, master_key)
+                emo_spn.verify_file(log, master_key)
+                with open(log, "ab") as f:
+                    f.write(b"x")
+                with self.assertRaises(ValueError):
+                    emo_spn.verify_file(log, master_key)
+            finally:
+                emo_spn.SANDBOX_DIR = old
+                emo_spn.TREE_LEAF_SIZE = old_leaf
+
+    def test_segmented_container(self):
+        import emo_segment
+        master_key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as tmp:
+            old = emo_spn.SANDBOX_DIR
+            emo_spn.SANDBOX_DIR = tmp
+            try:
+                src = os.path.join(tmp, "in.bin")
+                enc = os.path.join(tmp, "in.enc")
+                dec = os.path.join(tmp, "in.dec")
+                data = os.urandom(1000)
+                with open(src, "wb") as f:
+                    f.write(data)
+                for mode in ("ctr", "cbc"):
+                    encrypt_file(src, enc, master_key, mode=mode, segment_size=256)
+                    self.assertEqual(os.path.getsize(enc),
+                                     emo_segment.container_size(1000, 256, emo_spn.MODES[mode]))
+                    decrypt_file(enc, dec, master_key)
+                    with open(dec, "rb") as f:
+                        self.assertEqual(f.read(), data)
+                    for offset, length in ((0, 1), (250, 20), (700, 1000), (1000, 5)):
+                        self.assertEqual(emo_segment.read_range(enc, offset, length, master_key),
+                                         data[offset:offset+length])
+
+                with open(enc, "rb") as f:
+                    blob = f.read()
+                header, record = 28, emo_segment.record_size(emo_spn.MODE_CBC, 256)
+                swapped = (blob[:header] + blob[header+record:header+2*record]
+                           + blob[header:header+record] + blob[header+2*record:])
+                for bad in (swapped, blob[:-1], blob[:header+record] + blob[header+2*record:]):
+                    with open(enc, "wb") as f:
+                        f.write(bad)
+                    with self.assertRaises(ValueError):
+                        emo_segment.read_range(enc, 0, 10, master_key)
+                    with self.assertRaises(ValueError):
+                        decrypt_file(enc, dec, master_key)
+                    self.assertFalse(os.path.exists(dec))
+            finally:
+                emo_spn.SANDBOX_DIR = old
+
+    def test_append_log(self):
+        import emo_append
+        master_key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as tmp:
+            old = emo_spn.SANDBOX_DIR
+            emo_spn.SANDBOX_DIR = tmp
+            try:
+                log = os.path.join(tmp, "app.log.enc")
+                dec = os.path.join(tmp, "app.log")
+                for mode in ("ctr", "cbc"):
+                    if os.path.exists(log):
+                        os.remove(log)
+                    parts = [os.urandom(n) for n in (0, 100, 1000, 17)]
+                    sizes = []
+                    for part in parts:
+                        emo_append.append(log, part, master_key, mode=mode, record_size=256)
+                        sizes.append(os.path.getsize(log))
+                    # each append only adds its own records to the file
+                    self.assertEqual(sizes[0], 24 + 52)
+                    self.assertLess(sizes[3] - sizes[2], 100)
+                    with emo_append.AppendLog(log, master_key) as a:
+                        self.assertEqual((a.count, a.length), (1 + 4 + 1, 1117))
+                        self.assertEqual(a.mode, emo_spn.MODES[mode])
+                    decrypt_file(log, dec, master_key)
+                    with open(dec, "rb") as f:
+                        self.assertEqual(f.read(), b"".join(parts))
+
+                with open(log, "rb") as f:
+                    blob = f.read()
+                first = 24 + 4 + 16 + 112 + 32
+                second = first + 4 + 16 + 272 + 32
+                os.remove(dec)
+                dropped = blob[:first] + blob[second:]
+                flipped = blob[:30] + bytes([blob[30] ^ 1]) + blob[31:]
+                for bad in (blob[:-1], blob[:first] + blob[-52:], dropped, flipped):
+                    with open(log, "wb") as f:
+                        f.write(bad)
+                    with self.assertRaises(ValueError):
+                        decrypt_file(log, dec, master_key)
+                    self.assertFalse(os.path.exists(dec))
+                with open(log, "wb") as f:
+                    f.write(blob[:-1])
+                with self.assertRaises(ValueError):
+                    emo_append.append(log, b"more", master_key)
+            finally:
+                emo_spn.SANDBOX_DIR = old
+
+    def test_append_log_recover(self):
+        import emo_append
+        master_key = bytes(range(32))
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, "app.log.enc")
+            first, more = os.urandom(300), os.urandom(600)
+            emo_append.append(log, first, master_key, record_size=256)
+            with open(log, "rb") as f:
+                before = f.read()
+            emo_append.append(log, more, master_key, record_size=256)
+            with open(log, "rb") as f:
+                after = f.read()
+            # the append starts writing where the old trailer was
+            base = len(before) - 52
+            record = 4 + 16 + 256 + 32
+            cases = [
+                (after[:base + 10], (2, 300)),                           # cut inside the first new record
+                (after[:base + 10] + before[base + 10:], (2, 300)),      # old trailer partly overwritten
+                (after[:base + record + 10], (3, 556)),                  # one new record made it
+                (after[:-20], (5, 900)),                                 # cut inside the new trailer
+            ]
+            for broken, expected in cases:
+                with open(log, "wb") as f:
+                    f.write(broken)
+                with self.assertRaises(ValueError):
+                    emo_append.append(log, b"more", master_key)
+                self.assertEqual(emo_append.recover(log, master_key), expected)
+                self.assertEqual(emo_append.read_log(log, master_key), (first + more)[:expected[1]])
+                emo_append.append(log, b"tail", master_key)
+                self.assertEqual(emo_append.read_log(log, master_key),
+                                 (first + more)[:expected[1]] + b"tail")
+            # recovering a healthy log keeps it as it is
+            self.assertEqual(emo_append.recover(log, master_key), (expected[0] + 1, expected[1] + 4))
+
+    def test_pipe_mode(self):
+        import subprocess
+        script = os.path.join(BASE_DIR, "emo.py")
+        data = os.urandom(5000)
+        for extra in (["--base64", "-j", "2"], []):
+            opts = ["--key", self.key, "--segment-size", "1024"] + extra
+            enc = subprocess.run([sys.executable, script, "encrypt", "-"] + opts, input=data,
+                                 capture_output=True, check=True).stdout
+            dec = subprocess.run([sys.executable, script, "decrypt", "-"] + opts, input=enc,
+                                 capture_output=True, check=True).stdout
+            self.assertEqual(dec, data)
+        cut = subprocess.run([sys.executable, script, "decrypt", "-", "--key", self.key],
+                             input=enc[:-10], capture_output=True)  # binary, truncated
+        self.assertEqual(cut.returncode, 1)
+
+    def test_async_api(self):
+        import asyncio
+        import emo_async
+        master_key = bytes(range(32))
+
+        async def run(tmp):
+            messages = [f"mensaje {i} 😀" for i in range(8)]
+            sealed = await asyncio.gather(*(emo_async.emo_encrypt_async(m, "clave") for m in messages))
+            opened = await asyncio.gather(*(emo_async.emo_decrypt_async(c, "clave") for c, _ in sealed))
+            self.assertEqual([p for p, _ in opened], messages)
+            src = os.path.join(tmp, "in.bin")
+            enc = os.path.join(tmp, "in.enc")
+            dec = os.path.join(tmp, "in.dec")
+            data = os.urandom(1000)
+            with open(src, "wb") as f:
+                f.write(data)
+            for mode in ("ctr", "cbc"):
+                await emo_async.encrypt_file_async(src, enc, master_key, mode=mode, chunk_size=64)
+                await emo_async.decrypt_file_async(enc, dec, master_key, chunk_size=48)
+                with open(dec, "rb") as f:
+                    self.assertEqual(f.read(), data)
+            for opts in ({"tree_mac": True}, {"segment_size": 256}):
+                os.remove(dec)
+                emo_spn.encrypt_file(src, enc, master_key, **opts)
+                await emo_async.decrypt_file_async(enc, dec, master_key, chunk_size=48)
+                with open(dec, "rb") as f:
+                    self.assertEqual(f.read(), data)
+            import emo_append
+            log = os.path.join(tmp, "log.enc")
+            emo_append.append(log, data[:300], master_key, record_size=128)
+            emo_append.append(log, data[300:], master_key, record_size=128)
+            os.remove(dec)
+            await emo_async.decrypt_file_async(log, dec, master_key)
+            with open(dec, "rb") as f:
+                self.assertEqual(f.read(), data)
+            # an output that cannot be opened is reported, not removed
+            await emo_async.encrypt_file_async(src, enc, master_key)
+            real_open = open
+
+            def no_write(path, mode="r", *args):
+                if path == dec and "w" in mode:
+                    raise PermissionError("denied")
+                return real_open(path, mode, *args)
+
+            with mock.patch("emo_async.open", no_write, create=True):
+                for call, args in ((emo_async.encrypt_file_async, (src, dec, master_key)),
+                                   (emo_async.decrypt_file_async, (enc, dec, master_key))):
+                    with self.assertRaises(PermissionError):
+                        await call(*args)
+                    self.assertTrue(os.path.exists(dec))
+            # the default engine is "auto", resolved by the registry
+            old_env = os.environ.get(emo_spn.ENGINE_ENV)
+            os.environ[emo_spn.ENGINE_ENV] = "nope"
+            try:
+                with self.assertRaises(ValueError):
+                    await emo_async.encrypt_file_async(src, enc, master_key)
+                with self.assertRaises(ValueError):
+                    await emo_async.decrypt_file_async(enc, dec, master_key)
+            finally:
+                os.environ.pop(emo_spn.ENGINE_ENV)
+                if old_env is not None:
+                    os.environ[emo_spn.ENGINE_ENV] = old_env
+
+        with tempfile.TemporaryDirectory() as tmp:
+            old = emo_spn.SANDBOX_DIR
+            emo_spn.SANDBOX_DIR = tmp
+            try:
+                asyncio.run(run(tmp))
+            finally:
+                emo_spn.SANDBOX_DIR = old
+
+    def test_streaming_metrics(self):
+        data = os.urandom(5000)
+        other = os.urandom(5000)
+        self.assertEqual(bit_distance(data, other),
+                         sum(bin(a ^ b).count("1") for a, b in zip(data, other)))
+        whole = ByteStats().update(data)
+        parts = ByteStats()
+        for i in range(0, len(data), 333):
+            parts.update(data[i:i+333])
+        self.assertEqual(whole.counts.tolist(), parts.counts.tolist())
+        self.assertEqual(whole.ones.tolist(), parts.ones.tolist())
+        first_bit_ones = sum(b >> 7 for b in data[::16])
+        self.assertEqual(int(whole.ones[0]), first_bit_ones)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "data.bin")
+            with open(path, "wb") as f:
+                f.write(data)
+            merged = file_stats(path, workers=2, chunk_size=1024)
+        self.assertEqual(merged.ones.tolist(), whole.ones.tolist())
+        self.assertAlmostEqual(merged.entropy(), whole.entropy())
+        chi2, p_value = whole.chi_square()
+        self.assertTrue(0.0 <= p_value <= 1.0)
+
+    def test_sac_harness(self):
+        import emo_sac
+        result = emo_sac.run_sac(keys=2, blocks=256, workers=1, chunk=128)
+        self.assertEqual(len(result["keys"]), 2)
+        self.assertEqual(len(result["matrix"]), 128)
+        agg = result["aggregate"]
+        self.assertEqual(agg["blocks"], 512)
+        self.assertAlmostEqual(agg["avalanche_mean_bits"], 64, delta=2)
+        self.assertLess(agg["sac_max_deviation"], 0.2)
+        self.assertLess(agg["bic_max_correlation"], 0.5)
+        # the float32 BIC counts are summed in slabs: same counts either way
+        cross = emo_sac.sac_chunk(bytes(range(32)), 1, 200)[1]
+        old = emo_sac.BIC_SLAB
+        emo_sac.BIC_SLAB = 64
+        try:
+            self.assertTrue((emo_sac.sac_chunk(bytes(range(32)), 1, 200)[1] == cross).all())
+        finally:
+            emo_sac.BIC_SLAB = old
+        with self.assertRaises(ValueError):
+            emo_sac.run_sac(keys=1, blocks=16, chunk=0)
+
+    def test_quality_analyzer(self):
+        import emo_quality
+        S, P = emo_quality.instances([bytes(range(32))])
+        sbox, player = list(S[0]), list(P[0])
+        ddt, lat = emo_quality.ddt(S)[0], emo_quality.lat(S)[0]
+        parity = lambda v: bin(v).count("1") & 1
+        for a in (1, 37, 255):
+            for b in (0, 5, 200):
+                self.assertEqual(ddt[a, b], sum(1 for x in range(256) if sbox[x] ^ sbox[x ^ a] == b))
+                self.assertEqual(lat[a, b], sum(1 for x in range(256)
+                                                if parity(a & x) == parity(b & sbox[x])) - 128)
+        m = emo_quality.analyze([bytes(range(32))])
+        self.assertEqual(m["differential_uniformity"][0], ddt[1:].max())
+        self.assertEqual(m["fixed_points"][0], sum(sbox[x] == x for x in range(256)))
+        self.assertEqual(m["same_byte_bits"][0], sum(player[i] // 8 == i // 8 for i in range(128)))
+
+        result = emo_quality.run_screen(keys=40, workers=1, batch=16)
+        self.assertEqual(result["params"]["keys"], 40)
+        for name in ("nonlinearity", "differential_uniformity", "diffusion_rounds"):
+            dist = result["distribution"][name]
+            self.assertEqual(sum(dist["histogram"].values()), 40)
+        self.assertLessEqual(result["distribution"]["diffusion_rounds"]["max"], 4)
+        self.assertGreaterEqual(result["distribution"]["nonlinearity"]["min"], 80)
+
+        # the init hook redraws keys the check rejects
+        strict = {"nonlinearity": ("min", 200)}
+        self.assertTrue(emo_quality.key_problems(bytes(32), strict))
+        seen = []
+        check = lambda key: seen.append(key) or (["weak"] if len(seen) < 3 else [])
+        key = emo_spn.generate_master_key(check)
+        self.assertEqual((len(seen), key), (3, seen[-1]))
+        with self.assertRaises(ValueError):
+            emo_spn.generate_master_key(lambda key: emo_quality.key_problems(key, strict), 2)
+
+    def test_instrumentation(self):
+        import io
+        import json
+        import emo_instrument
+        registry = emo_instrument.StatsRegistry()
+        stream = io.StringIO()
+        emo_instrument.enable(registry, emo_instrument.JsonLinesSink(stream))
+        try:
+            cifrado, elapsed = emo_encrypt(self.msg, self.key)
+            emo_decrypt(cifrado, self.key)
+            with self.assertRaises(ValueError):
+                emo_decrypt(cifrado[:-1] + bytes([cifrado[-1] ^ 1]), self.key)
+        finally:
+            emo_instrument.disable()
+        stats = registry.snapshot()
+        self.assertEqual(stats["emo_encrypt"]["calls"], 1)
+        self.assertIn("kdf", stats["emo_encrypt"]["phases"])
+        self.assertEqual(stats["emo_encrypt"]["counters"]["bytes_in"], len(self.msg))
+        self.assertEqual(stats["emo_decrypt"]["errors"], 1)
+        self.assertEqual(stats["emo_decrypt"]["counters"]["mac_failures"], 1)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([r["op"] for r in records], ["emo_encrypt", "emo_decrypt", "emo_decrypt"])
+        self.assertEqual(records[0]["elapsed"], elapsed)
+        text = emo_instrument.prometheus_text(registry)
+        self.assertIn('emo_mac_failures_total{op="emo_decrypt"} 1', text)
+
+        emo_encrypt(self.msg, self.key)  # disabled again: nothing recorded
+        self.assertEqual(registry.snapshot()["emo_encrypt"]["calls"], 1)
+
+    def test_import_budget(self):
+        import emo_bench
+        # heavy modules load lazily; the time against the budget is a bench report
+        for module in emo_bench.IMPORT_BUDGET_S:
+            _, loaded = emo_bench.import_time(module, 1)
+            self.assertEqual(loaded, [], module)
+
+    def test_batched_log(self):
+        import logging_tools
+        import emo_instrument
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "execution.log")
+            for background in (False, True):
+                writer = logging_tools.configure_log(path, batch=4, background=background)
+                threads = [threading.Thread(target=lambda i=i: [writer.write(f"{i}:{j}") for j in range(50)])
+                           for i in range(4)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                logging_tools.close_log()
+                with open(path, encoding="utf-8") as f:
+                    lines = f.read().splitlines()
+                self.assertEqual(len(lines), 200)
+                self.assertEqual([l for l in lines if l.startswith("2:")], [f"2:{j}" for j in range(50)])
+                os.remove(path)
+            writer = emo_instrument.BatchWriter(path, batch=10)
+            writer.write("a")
+            self.assertFalse(os.path.exists(path))  # still buffered
+            writer.close()
+            with open(path, encoding="utf-8") as f:
+                self.assertEqual(f.read(), "a\n")
+
+    def test_benchmark_suite(self):
+        import emo_bench
+        report = emo_bench.run_suite(engines=["table"], sizes=[1024], modes=["ctr"],
+                                     repeat=2, warmup=0, cli=False)
+        names = [r["name"] for r in report["results"]]
+        self.assertIn("key_setup", names)
+        self.assertIn("bulk/decrypt/ctr/table/1024", names)
+        self.assertIn("python", report["meta"])
+        slower = {"meta": {}, "results": [dict(r, median_s=r["median_s"] * 2)
+                                          for r in report["results"]]}
+        statuses = {row[4] for row in emo_bench.compare(report, slower)}
+        self.assertEqual(statuses, {"regression"})
+
     def test_generate_graphs(self):
         cifrado, _ = emo_encrypt(self.msg, self.key)
 